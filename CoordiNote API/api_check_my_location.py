@@ -1,11 +1,13 @@
 from flask import Flask, request, jsonify
 import psycopg2 
-from psycopg2.extras import RealDictCursor 
-from psycopg2.pool import SimpleConnectionPool 
 from passlib.hash import bcrypt 
 import uuid 
 from datetime import datetime, timedelta 
 import json 
+from db import PoolTimeout, get_pool
+from json_provider import install_json_provider
+from nearby import parse_nearby_args, fetch_nearby_messages
+from locations import parse_location_filters, fetch_locations_featurecollection, stream_locations_response
 
 # DATABASE CONFIGURATION
 
@@ -17,41 +19,24 @@ DB_CONFIG = {
     "port": "5432"
 }
 
-# Create a connection pool to handle multiple simultaneous requests efficiently
-db_pool = SimpleConnectionPool(
-    minconn=1,
-    maxconn=10,
-    database=DB_CONFIG["database"],
-    user=DB_CONFIG["user"],
-    password=DB_CONFIG["password"],
-    host=DB_CONFIG["host"],
-    port=DB_CONFIG["port"],
-    cursor_factory=RealDictCursor
-)
+# Connection pool shared with the other modules of this process (thread safe, see db.py)
+db_pool = get_pool(DB_CONFIG, minconn=1, maxconn=10)
 
 # Initialize the Flask application
 app = Flask(__name__)
+install_json_provider(app)  # orjson when installed, needed for the /locations geometry fragments
 
 # -------------------------------------------------------------------
 # HELPER FUNCTIONS
 
-def get_db_connection():
-    """Fetches a database connection from the connection pool."""
-    return db_pool.getconn()
-
-def release_db_connection(conn):
-    """Returns the database connection back to the pool."""
-    db_pool.putconn(conn)
-
 def get_current_user():
     """Extracts the token from the header and validates the user session."""
     token = request.headers.get("Authorization")
     if not token:
         return None, "Missing token"
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
         cur.execute("""
             SELECT us_id, expires_at
             FROM sessions
@@ -59,14 +44,19 @@ def get_current_user():
         """, (token,))
         session = cur.fetchone()
 
-        if not session:
-            return None, "Invalid token"
-        if session["expires_at"] < datetime.utcnow():
-            return None, "Token expired"
+    if not session:
+        return None, "Invalid token"
+    if session["expires_at"] < datetime.utcnow():
+        return None, "Token expired"
+
+    return session["us_id"], None
 
-        return session["us_id"], None
-    finally:
-        release_db_connection(conn)
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    """All database connections stayed busy for the pool's timeout: ask the client to retry."""
+    response = jsonify({"error": "Server busy, try again later"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
 
 # -------------------------------------------------------------------
 # ROUTES / ENDPOINTS
@@ -96,22 +86,20 @@ def register_user():
     # Hash the password securely using bcrypt
     hashed_password = bcrypt.hash(password)
     
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
 
-    try:
-        cur.execute("""
-            INSERT INTO users (us_id, us_name, pwd)
-            VALUES (DEFAULT, %s, %s)
-            RETURNING us_id;
-        """, (username, hashed_password))
-        us_id = cur.fetchone()["us_id"]
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        release_db_connection(conn)
+        try:
+            cur.execute("""
+                INSERT INTO users (us_id, us_name, pwd)
+                VALUES (DEFAULT, %s, %s)
+                RETURNING us_id;
+            """, (username, hashed_password))
+            us_id = cur.fetchone()["us_id"]
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
 
     return jsonify({"message": "User created successfully", "us_id": us_id}), 201
 
@@ -124,51 +112,27 @@ def get_locations():
     """
     Fetches Points of Interest (POIs) from the database and returns them 
     in a standard GeoJSON FeatureCollection format for frontend map libraries.
+
+    Optional filters: ?category=metro and ?bbox=minx,miny,maxx,maxy
+    With ?stream=true the features are built by PostGIS and streamed in chunks,
+    which keeps memory flat for big regions.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
+    filters, error = parse_location_filters(request.args)
+    if error:
+        return jsonify({"error": error}), 400
 
-    try:
-        # Optional: Frontend can filter by category (e.g., ?category=metro)
-        category_filter = request.args.get("category")
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        # The connection goes back to the pool when the response is closed
+        return stream_locations_response(db_pool, filters)
 
-        if category_filter:
-            cur.execute("""
-                SELECT location_id, l_name, category, ST_AsGeoJSON(geom) as geometry
-                FROM locations
-                WHERE category = %s;
-            """, (category_filter,))
-        else:
-            cur.execute("""
-                SELECT location_id, l_name, category, ST_AsGeoJSON(geom) as geometry
-                FROM locations;
-            """)
-            
-        locations = cur.fetchall()
-        
-        # Build the GeoJSON structure
-        features = []
-        for loc in locations:
-            feature = {
-                "type": "Feature",
-                "geometry": json.loads(loc["geometry"]), # Parse the PostGIS string into a JSON object
-                "properties": {
-                    "location_id": loc["location_id"],
-                    "name": loc["l_name"],
-                    "category": loc["category"]
-                }
-            }
-            features.append(feature)
-            
-        return jsonify({
-            "type": "FeatureCollection",
-            "features": features
-        }), 200
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        release_db_connection(conn)
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+
+        try:
+            return jsonify(fetch_locations_featurecollection(cur, filters)), 200
+
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
 
 
 # -------------------------------------------------------------------
@@ -177,71 +141,24 @@ def get_locations():
 @app.route("/messages/nearby", methods=["GET"])
 def nearby_messages():
     """
-    Retrieves messages within a search radius.
+    Retrieves messages within a search radius, closest first.
     Checks user's distance against the message's specific unlock radius (unl_rad).
     If the user is too far, the message content is hidden for security.
+    Optional parameters: radius (meters, default 1000) and limit (default 100).
     """
-    lat = request.args.get("lat")
-    lon = request.args.get("lon")
-    uni_id = request.args.get("uni_id")
-    
-    # Default search radius for map visibility is 1000 meters
-    search_radius = request.args.get("radius", 1000)
+    params, error = parse_nearby_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
 
-    if not lat or not lon or not uni_id:
-        return jsonify({"error": "lat, lon and uni_id are required parameters"}), 400
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+        try:
+            messages_list = fetch_nearby_messages(cur, **params)
+            return jsonify(messages_list), 200
 
-    try:
-        cur.execute("""
-            SELECT 
-                m.m_id, 
-                m.m_type, 
-                m.unl_rad,
-                m.view_once,
-                l.location_id,
-                l.l_name as location_name,
-                
-                -- Calculate the exact distance in meters using PostGIS
-                ST_Distance(
-                    m.geom::geography, 
-                    ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography
-                ) as distance_meters,
-                
-                -- Determine if the user is close enough to unlock the message
-                CASE 
-                    WHEN ST_Distance(m.geom::geography, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography) <= m.unl_rad 
-                    THEN true 
-                    ELSE false 
-                END as can_open,
-
-                -- SECURITY SHIELD: Hide actual content if the user is outside the unlock radius
-                CASE 
-                    WHEN ST_Distance(m.geom::geography, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography) <= m.unl_rad 
-                    THEN m.m_txt 
-                    ELSE 'This message is locked. Get closer to read it!' 
-                END as m_txt
-
-            FROM messages m
-            JOIN locations l ON m.location_id = l.location_id
-            WHERE m.uni_id = %s
-            -- Only fetch messages within the general search radar (e.g., 1000m)
-            AND ST_DWithin(
-                m.geom::geography,
-                ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography,
-                %s
-            );
-        """, (lon, lat, lon, lat, lon, lat, uni_id, lon, lat, search_radius))
-        
-        messages_list = cur.fetchall()
-        return jsonify(messages_list), 200
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        release_db_connection(conn)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
 
 # -------------------------------------------------------------------
 # SERVER EXECUTION
@@ -1,14 +1,30 @@
 from flask import (
     Flask,
+    Response,
     request,
     jsonify,
     )
 import psycopg2 # PostgreSQL adapter for Python
-from psycopg2.extras import RealDictCursor # This allows us to get query results as dictionaries instead of tuples
-from psycopg2.pool import SimpleConnectionPool # This allows us to create a pool of database connections that can be reused, improving performance
 from psycopg2 import errors # This module contains exceptions that can be raised by psycopg2, we're using it to handle duplicates uni_name error 
-from passlib.hash import bcrypt # This is a library for hashing passwords securely, we will use it to hash user passwords before storing them in the database
+from passwords import HashingBusy, PasswordHasher # bcrypt hashing in a separate process pool, so it doesn't block the request threads
 # from utils import format_geojson
+from cache import TTLCache
+from db import PoolTimeout, all_pool_metrics, get_pool # Shared, thread-safe connection pool (rows are returned as dictionaries)
+from events import EventBroker
+from json_provider import install_json_provider
+from metrics import CONTENT_TYPE, REGISTRY, TimingTupleCursor, instrument_app
+from slow_queries import slow_query_log
+from sessions import SessionReaper, enforce_session_cap, notify_sessions_revoked
+from nearby import parse_nearby_args, NearbyTileCache
+from viewport import fetch_viewport_messages, parse_bbox_args
+from message_changes import fetch_message_changes, parse_changes_args
+from messages_page import fetch_messages_page, messages_page_sql, parse_page_args, stream_messages_array
+from message_open import MAX_M_ID, OPEN_STATUS_CODES, open_messages, parse_open_ids
+from locations import parse_location_filters, fetch_locations_featurecollection, stream_locations_response
+from tiles import LAYERS, TileCache, fetch_tile, valid_category, valid_tile
+from versions import DatasetVersions, ResponseBodyCache, make_etag
+import hmac
+import os
 import uuid # for generating unique identifiers, we will use it to generate unique IDs for users and notes
 from datetime import datetime, timedelta # for working with dates and times, we will use it to set expiration times for authentication tokens
 from utils import format_geojson
@@ -24,40 +40,115 @@ DB_CONFIG = {
 }
 
 
-# Create connection pool
+# Connection pool, shared with every other module of this process that uses the same database (see db.py).
+# Use `with db_pool.connection() as conn:` so the connection always goes back to the pool.
 
-db_pool = SimpleConnectionPool(
-    minconn=1,
-    maxconn=10,
-    database=DB_CONFIG["database"],
-    user=DB_CONFIG["user"],
-    password=DB_CONFIG["password"],
-    host=DB_CONFIG["host"],
-    port=DB_CONFIG["port"],
-    cursor_factory=RealDictCursor
-)
+db_pool = get_pool(DB_CONFIG, minconn=1, maxconn=10)
 
 # Create Flask app
 app = Flask(__name__)
 
+# jsonify() with orjson when installed: ISO 8601 dates, Decimal/UUID support (see json_provider.py)
+install_json_provider(app)
+
+# Latency/size histograms per route and in-flight requests for /metrics (see metrics.py)
+instrument_app(app)
+
+# In-process cache of session tokens -> (us_id, error), so authenticated routes
+# don't need a database round trip just to look up the token.
+# Valid sessions are never cached past their expires_at, and revocations (logout,
+# session cap) reach every worker through the "sessions_revoked" event (sessions.py).
+# Unknown / expired tokens are cached for a short time in their own small cache, so
+# a client retrying a bad token can't hammer the db, and a flood of bad tokens
+# can't evict the sessions of real users.
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 300  # seconds
+INVALID_TOKEN_CACHE_SIZE = 1000
+INVALID_TOKEN_CACHE_TTL = 10  # seconds
+
+session_cache = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+invalid_token_cache = TTLCache(maxsize=INVALID_TOKEN_CACHE_SIZE, ttl=INVALID_TOKEN_CACHE_TTL)
+
+# In-process cache of universe memberships: us_id -> frozenset of uni_ids.
+# join/leave/universe creation drop the user's entry right away; the TTL bounds how
+# long another worker process may keep an old set after such a change.
+MEMBERSHIP_CACHE_SIZE = 10000
+MEMBERSHIP_CACHE_TTL = 60  # seconds
+
+membership_cache = TTLCache(maxsize=MEMBERSHIP_CACHE_SIZE, ttl=MEMBERSHIP_CACHE_TTL)
+
+# Cache of nearby-message candidates per (universe, ~100 m grid cell, radius bucket),
+# see nearby.py. Cells are invalidated when a message is created in them, by this
+# worker directly and by the others through the NOTIFY events (on_database_event).
+nearby_cache = NearbyTileCache(maxsize=5000, ttl=60, max_bytes=64 * 1024 * 1024)
+
+# Vector tiles cached on disk, shared with the ETL which clears them on reload (see tiles.py)
+tile_cache = TileCache()
+
+# Version tokens of read-heavy datasets + their serialized responses, for ETag / 304 (see versions.py)
+dataset_versions = DatasetVersions()
+response_cache = ResponseBodyCache(maxsize=1000, ttl=3600, max_bytes=128 * 1024 * 1024)
+
+# New messages and poll votes pushed to the clients of a universe (SSE), from one LISTEN connection (see events.py)
+event_broker = EventBroker(DB_CONFIG)
+
+
+def on_database_event(event):
+    """Keeps the caches of this worker in step with writes made by other workers / app_async.py."""
+    if event.get("type") == "message" and event.get("latitude") is not None:
+        nearby_cache.invalidate_point(int(event["uni_id"]), event["latitude"], event["longitude"])
+    elif event.get("type") == "sessions_revoked":
+        invalidate_user_sessions(int(event["us_id"]))
+    elif event.get("type") == "resync":
+        if event.get("uni_id") is None:
+            # Listener reconnect (revocations may have been missed) or bulk insert
+            nearby_cache.invalidate_all()
+            session_cache.clear()
+        else:
+            nearby_cache.invalidate_universe(int(event["uni_id"]))
+
+
+event_broker.add_listener(on_database_event)
+
+
+# Every worker must follow the invalidations (cached sessions, nearby cells), also
+# when it was forked after the listener thread was started
+@app.before_request
+def start_event_listener():
+    event_broker.start()
+
+
+# Expired sessions are deleted in the background, in small batches (see sessions.py)
+session_reaper = SessionReaper(db_pool)
+session_reaper.start()
+
+# Password hashes/verifications run in a bounded process pool (see passwords.py)
+password_hasher = PasswordHasher()
+
+
+# Token for the /admin routes (env COORDINOTE_ADMIN_TOKEN). Without one they only
+# answer requests from the machine itself.
+ADMIN_TOKEN = os.environ.get("COORDINOTE_ADMIN_TOKEN")
+
 
 # Helper functions
-def get_db_connection():
-    return db_pool.getconn()
-# To release a db connection back to the pool after it's been used. It takes a connection object as an argument and calls the putconn method of the connection pool to return the connection to the pool for reuse.
-def release_db_connection(conn):
-    db_pool.putconn(conn)
+def is_admin_request():
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN)
+    return request.remote_addr in ("127.0.0.1", "::1")
 
-def get_current_user():
-    token = request.headers.get("Authorization")
+def get_current_user(token=None):
+    token = token or request.headers.get("Authorization")
 
     if not token:
         return None, "Missing token"
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    cached = session_cache.get(token) or invalid_token_cache.get(token)
+    if cached is not None:
+        return cached
 
-    try:
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
         cur.execute("""
             SELECT us_id, expires_at
             FROM sessions
@@ -65,16 +156,88 @@ def get_current_user():
         """, (token,))
         session = cur.fetchone()
 
-        if not session:
-            return None, "Invalid token"
+    if not session:
+        result = (None, "Invalid token")
+        invalid_token_cache.set(token, result)
+        return result
+
+    remaining = (session["expires_at"] - datetime.utcnow()).total_seconds()
+    if remaining <= 0:
+        result = (None, "Token expired")
+        invalid_token_cache.set(token, result)
+        return result
+
+    # Cache until the token expires at the latest, then the db decides again
+    result = (session["us_id"], None)
+    session_cache.set(token, result, ttl=remaining)
+    return result
+
+# Returns a JSON response for a versioned dataset with a strong ETag.
+# A conditional GET with a matching If-None-Match gets a 304 straight away, and the
+# serialized body is reused until the dataset's version changes, so build() (which
+# queries the database) only runs after a write.
+def versioned_json_response(dataset, variant, build):
+    token = dataset_versions.current(dataset)
+    etag = make_etag(dataset, variant, token)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = response_cache.get(dataset, variant, token)
+        if body is None:
+            body = app.json.dumps_bytes(build())
+            response_cache.set(dataset, variant, token, body)
+        response = Response(body, mimetype="application/json")
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"  # clients must revalidate, which is cheap now
+    return response
+
+# Universes the user is a member of, from the membership cache or one query
+def get_user_universes(us_id):
+    universes = membership_cache.get(us_id)
+    if universes is not None:
+        return universes
+
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT uni_id FROM user_univ
+            WHERE us_id = %s;
+        """, (us_id,))
+        universes = frozenset(row["uni_id"] for row in cur.fetchall())
+
+    membership_cache.set(us_id, universes)
+    return universes
+
+def is_member(us_id, uni_id):
+    return uni_id in get_user_universes(us_id)
+
+# Call after every change to a user's rows in user_univ (once committed)
+def invalidate_membership(us_id):
+    membership_cache.invalidate(us_id)
 
-        if session["expires_at"] < datetime.utcnow():
-            return None, "Token expired"
+# Invalidation hooks for the session cache, call these whenever sessions are removed or revoked
+def invalidate_session(token):
+    session_cache.invalidate(token)
 
-        return session["us_id"], None
+def invalidate_user_sessions(us_id):
+    session_cache.invalidate_where(lambda token, result: result[0] == us_id)
 
-    finally:
-        release_db_connection(conn)
+# All connections are busy and none became free in time: tell the client to retry
+# instead of queueing requests forever
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    response = jsonify({"error": "Server busy, try again later"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+# Too many logins/registrations are being hashed already: fail fast instead of queueing
+@app.errorhandler(HashingBusy)
+def hashing_busy(e):
+    response = jsonify({"error": "Server busy, try again later"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
 
 # Test route
 @app.route("/")
@@ -84,14 +247,12 @@ def home():
 # Test database connection route
 @app.route("/test-db")
 def test_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute("SELECT NOW();")
-    result = cur.fetchone()
-    
-    release_db_connection(conn)
-    
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+
+        cur.execute("SELECT NOW();")
+        result = cur.fetchone()
+
     return jsonify(result)
 
 # User registration route
@@ -113,27 +274,24 @@ def register_user():
         return jsonify({"error": "Passwords do not match"}), 400
 
     # Hash password BEFORE database logic
-    hashed_password = bcrypt.hash(password)
-
-    conn = get_db_connection()
-    cur = conn.cursor()
+    hashed_password = password_hasher.hash(password)
 
-    try:
-        cur.execute("""
-            INSERT INTO users (us_id, us_name, pwd)
-            VALUES (DEFAULT, %s, %s)
-            RETURNING us_id;
-        """, (username, hashed_password))
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
 
-        us_id = cur.fetchone()["us_id"]
-        conn.commit()
+        try:
+            cur.execute("""
+                INSERT INTO users (us_id, us_name, pwd)
+                VALUES (DEFAULT, %s, %s)
+                RETURNING us_id;
+            """, (username, hashed_password))
 
-    except Exception as e:
-        conn.rollback()
-        release_db_connection(conn)
-        return jsonify({"error": str(e)}), 500
+            us_id = cur.fetchone()["us_id"]
+            conn.commit()
 
-    release_db_connection(conn)
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
 
     return jsonify({
         "message": "User created successfully",
@@ -152,40 +310,53 @@ def login_user():
     if not username or not password:
         return jsonify({"error": "Username and password required"}), 400
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT us_id, pwd FROM users WHERE us_name = %s;", (username,))
-    user = cur.fetchone()
-    release_db_connection(conn)
+    # The connection is given back before bcrypt runs, so it is not held during hashing
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT us_id, pwd FROM users WHERE us_name = %s;", (username,))
+        user = cur.fetchone()
 
     if not user:
         return jsonify({"error": "User not found"}), 404
     
-    if bcrypt.verify(password, user["pwd"]): # Verify the provided password against the hashed password stored in the database using bcrypt's verify function. If the verification is successful, it means the provided password is correct.
+    # Verify the provided password against the stored bcrypt hash. new_hash is set when the
+    # hash was made with another cost factor than the current one, it replaces the stored hash.
+    verified, new_hash = password_hasher.verify_and_update(password, user["pwd"])
+
+    if verified:
         # Generate token
         token = str(uuid.uuid4())
 
         # Set expiration (72 hours)
         expires_at = datetime.utcnow() + timedelta(hours=72)
 
-        conn = get_db_connection()
-        cur = conn.cursor()
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
 
-        try:
-            cur.execute("""
-                INSERT INTO sessions (us_id, token, expires_at)
-                VALUES (%s, %s, %s)
-            """, (user["us_id"], token, expires_at))
+            try:
+                cur.execute("""
+                    INSERT INTO sessions (us_id, token, expires_at)
+                    VALUES (%s, %s, %s)
+                """, (user["us_id"], token, expires_at))
 
-            conn.commit()
+                if new_hash:
+                    cur.execute("""
+                        UPDATE users SET pwd = %s
+                        WHERE us_id = %s;
+                    """, (new_hash, user["us_id"]))
 
-        except Exception as e:
-            conn.rollback()
-            release_db_connection(conn)
-            return jsonify({"error": str(e)}), 500
+                # Only the user's newest sessions are kept, older tokens stop working
+                # (the other workers are told by enforce_session_cap's NOTIFY)
+                dropped_tokens = enforce_session_cap(cur, user["us_id"])
 
-        release_db_connection(conn)
+                conn.commit()
+
+            except Exception as e:
+                conn.rollback()
+                return jsonify({"error": str(e)}), 500
+
+        if dropped_tokens:
+            invalidate_user_sessions(user["us_id"])
 
         return jsonify({
             "message": "Login successful",
@@ -194,24 +365,55 @@ def login_user():
     else:
         return jsonify({"error": "Username and password do not match. Try again."}), 401
 
+# User logout route: deletes the session and drops it from the session cache
+@app.route("/users/logout", methods=["POST"])
+def logout_user():
+    token = request.headers.get("Authorization")
+    if not token:
+        return jsonify({"error": "Missing token"}), 401
+
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+
+        try:
+            cur.execute("""
+                DELETE FROM sessions
+                WHERE token = %s
+                RETURNING us_id;
+            """, (token,))
+            session = cur.fetchone()
+            if session:
+                # Delivered on commit: the other workers drop the user's cached sessions
+                notify_sessions_revoked(cur, session["us_id"])
+            conn.commit()
+
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
+
+        finally:
+            invalidate_session(token)
+
+    if session:
+        invalidate_user_sessions(session["us_id"])
+
+    return jsonify({"message": "Logged out"}), 200
+
 # show all public universes route
 @app.route("/universes/public", methods=["GET"])
 def public_universes():
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    try:
-        cur.execute("""
-            SELECT uni_name, descri
-            FROM universes
-            WHERE access = false;
-        """)
-        universes = cur.fetchall()
-        return jsonify(universes)
+    def build():
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT uni_name, descri
+                FROM universes
+                WHERE access = false;
+            """)
+            return cur.fetchall()
 
-    finally:
-        release_db_connection(conn)
+    return versioned_json_response("universes", "public", build)
 
 # Create universes route
 @app.route("/universes", methods=["GET", "POST"])
@@ -221,78 +423,74 @@ def universes():
     if error:
         return jsonify({"error": error}), 401
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    try:
-        # Create universe
-        if request.method == "POST":
-            data = request.get_json(silent=True)
-            if not data:
-                return jsonify({"error": "Invalid JSON"}), 400
-
-            name = data.get("name")
-            access = data.get("access", False)  # boolean: false = public and is default, true = private
-            descri = data.get("descri")  # can be None
-
-            if not name:
-                return jsonify({"error": "Insert universe name"}), 400
-
-            # Insert universe and get uni_id + check the uni_name is not already taken
-            try:
-                cur.execute("""
-                    INSERT INTO universes (uni_name, access, descri)
-                    VALUES (%s, %s, %s)
-                    RETURNING uni_id;
-                """, (name, access, descri))
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
 
-                conn.commit()
+        try:
+            # Create universe
+            if request.method == "POST":
+                data = request.get_json(silent=True)
+                if not data:
+                    return jsonify({"error": "Invalid JSON"}), 400
+
+                name = data.get("name")
+                access = data.get("access", False)  # boolean: false = public and is default, true = private
+                descri = data.get("descri")  # can be None
+
+                if not name:
+                    return jsonify({"error": "Insert universe name"}), 400
+
+                # Insert universe and get uni_id + check the uni_name is not already taken
+                try:
+                    cur.execute("""
+                        INSERT INTO universes (uni_name, access, descri)
+                        VALUES (%s, %s, %s)
+                        RETURNING uni_id;
+                    """, (name, access, descri))
+
+                    uni_id = cur.fetchone()["uni_id"]
+
+                    # Add creator to user_univ (same transaction as the universe)
+                    cur.execute("""
+                        INSERT INTO user_univ (us_id, uni_id)
+                        VALUES (%s, %s)
+                        ON CONFLICT DO NOTHING;
+                    """, (us_id, uni_id))
+
+                    conn.commit()
+
+                except psycopg2.errors.UniqueViolation:
+                    conn.rollback()
+                    return jsonify({
+                        "error": "Universe name already exists. Be more original."
+                    }), 400
+
+                except Exception as e:
+                    conn.rollback()
+                    return jsonify({"error": str(e)}), 500
+
+                dataset_versions.bump("universes")
+                invalidate_membership(us_id)
 
                 return jsonify({
-                    "message": "Universe created"
+                    "message": "Universe created",
+                    "uni_id": uni_id
                 }), 201
 
-            except psycopg2.errors.UniqueViolation:
-                conn.rollback()
-                return jsonify({
-                    "error": "Universe name already exists. Be more original."
-                }), 400
-
-            except Exception as e:
-                conn.rollback()
-                return jsonify({"error": str(e)}), 500
-
-            # Add creator to user_univ
+            # GET only universes the user belongs to
             cur.execute("""
-                INSERT INTO user_univ (us_id, uni_id)
-                VALUES (%s, %s)
-                ON CONFLICT DO NOTHING;
-            """, (us_id, uni_id))
+                SELECT u.uni_name, u.access, u.descri
+                FROM universes u
+                JOIN user_univ uu ON u.uni_id = uu.uni_id
+                WHERE uu.us_id = %s;
+            """, (us_id,))
+
+            universes_list = cur.fetchall()
+            return jsonify(universes_list)
             
-            conn.commit()
-
-            return jsonify({
-                "message": "Universe created",
-                "uni_id": uni_id
-            }), 201
-
-        # GET only universes the user belongs to
-        cur.execute("""
-            SELECT u.uni_name, u.access, u.descri
-            FROM universes u
-            JOIN user_univ uu ON u.uni_id = uu.uni_id
-            WHERE uu.us_id = %s;
-        """, (us_id,))
-
-        universes_list = cur.fetchall()
-        return jsonify(universes_list)
-        
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-
-    finally:
-        release_db_connection(conn)
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
 
 # Join universe route
 @app.route("/universes/join", methods=["POST"])
@@ -310,39 +508,37 @@ def join_universe():
     if not uni_name:
         return jsonify({"error": "uni_name required"}), 400
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    try:
-        # does the universe exist?
-        cur.execute("""
-            SELECT uni_id FROM universes
-            WHERE uni_name = %s;
-        """, (uni_name,))
-        universe = cur.fetchone()
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
 
-        if not universe:
-            return jsonify({"error": "Universe not found"}), 404
+        try:
+            # does the universe exist?
+            cur.execute("""
+                SELECT uni_id FROM universes
+                WHERE uni_name = %s;
+            """, (uni_name,))
+            universe = cur.fetchone()
 
-        uni_id = universe["uni_id"]
+            if not universe:
+                return jsonify({"error": "Universe not found"}), 404
 
-        # Insert membership
-        cur.execute("""
-            INSERT INTO user_univ (us_id, uni_id)
-            VALUES (%s, %s)
-            ON CONFLICT DO NOTHING;
-        """, (us_id, uni_id))
-       
-        conn.commit()
+            uni_id = universe["uni_id"]
 
-        return jsonify({"message": f"Joined {uni_name}"}), 200
+            # Insert membership
+            cur.execute("""
+                INSERT INTO user_univ (us_id, uni_id)
+                VALUES (%s, %s)
+                ON CONFLICT DO NOTHING;
+            """, (us_id, uni_id))
+           
+            conn.commit()
+            invalidate_membership(us_id)
 
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
+            return jsonify({"message": f"Joined {uni_name}"}), 200
 
-    finally:
-        release_db_connection(conn)
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
 
 # Leave universe route
 @app.route("/universes/leave", methods=["POST"])
@@ -360,10 +556,9 @@ def leave_universe():
     if not uni_name:
         return jsonify({"error": "uni_name required"}), 400
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
 
-    try:
         cur.execute("""
             SELECT uni_id FROM universes
             WHERE uni_name = %s;
@@ -382,10 +577,9 @@ def leave_universe():
 
         conn.commit()
 
-        return jsonify({"message": f"Left {uni_name}"}), 200
+    invalidate_membership(us_id)
 
-    finally:
-        release_db_connection(conn)
+    return jsonify({"message": f"Left {uni_name}"}), 200
 
 # Messages route: POST + GET
 @app.route("/messages", methods=["GET", "POST"])
@@ -395,9 +589,6 @@ def messages():
     if error:
         return jsonify({"error": error}), 401
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
     if request.method == "POST":
         data = request.get_json(silent=True)
         if not data:
@@ -412,64 +603,103 @@ def messages():
         location_id = data.get("location_id")
 
         if not m_type or unl_rad is None or view_once is None or not m_txt or not uni_id:
-            release_db_connection(conn)
             return jsonify({"error": "Missing required fields"}), 400
 
+        try:
+            uni_id = int(uni_id)
+        except (TypeError, ValueError):
+            return jsonify({"error": "uni_id must be an integer"}), 400
+
         crt_time = datetime.utcnow()
 
         # Check membership in universe
-        cur.execute("""
-            SELECT 1 FROM user_univ
-            WHERE us_id = %s AND uni_id = %s;
-        """, (us_id, uni_id))
-
-        if not cur.fetchone():
+        if not is_member(us_id, uni_id):
             return jsonify({"error": "You are not a member of this universe"}), 403
 
-        try:
-            cur.execute("""
-                INSERT INTO messages (
-                    m_type, unl_rad, crt_time, view_once, m_txt, creator, uni_id, poll, location_id
-                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                RETURNING m_id;
-            """, (m_type, unl_rad, crt_time, view_once, m_txt, us_id, uni_id, poll, location_id))
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
 
-            m_id = cur.fetchone()["m_id"]
-            conn.commit()
-            return jsonify({"message": "Message created", "m_id": m_id}), 201
+            try:
+                # Also return the coordinates of the location, to invalidate the nearby cache
+                cur.execute("""
+                    WITH new_message AS (
+                        INSERT INTO messages (
+                            m_type, unl_rad, crt_time, view_once, m_txt, creator, uni_id, poll, location_id
+                        ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                        RETURNING m_id, location_id
+                    )
+                    SELECT nm.m_id, ST_Y(l.geom) AS latitude, ST_X(l.geom) AS longitude
+                    FROM new_message nm
+                    LEFT JOIN locations l ON l.location_id = nm.location_id;
+                """, (m_type, unl_rad, crt_time, view_once, m_txt, us_id, uni_id, poll, location_id))
+
+                created = cur.fetchone()
+                conn.commit()
 
-        except Exception as e:
-            conn.rollback()
-            return jsonify({"error": str(e)}), 500
+            except Exception as e:
+                conn.rollback()
+                return jsonify({"error": str(e)}), 500
 
-        finally:
-            release_db_connection(conn)
+        dataset_versions.bump(f"messages.{uni_id}")
+
+        if created["latitude"] is not None:
+            nearby_cache.invalidate_point(uni_id, created["latitude"], created["longitude"])
+            tile_cache.invalidate("messages", uni_id)
+
+        return jsonify({"message": "Message created", "m_id": created["m_id"]}), 201
 
     # GET messages
-    uni_id = request.args.get("uni_id")
+    uni_id = request.args.get("uni_id", type=int)
     # user comes from token
 
     if not uni_id:
-        release_db_connection(conn)
         return jsonify({"error": "uni_id query parameter required"}), 400
 
-    try:
-        cur.execute("""
-            SELECT m_id, m_type, unl_rad, crt_time, view_once, m_txt, creator, uni_id, poll, location_id
-            FROM messages m
-            JOIN user_univ uu ON m.uni_id = uu.uni_id
-            WHERE m.uni_id = %s
-            AND uu.us_id = %s
-        """, (uni_id, us_id))
-        messages_list = cur.fetchall()
+    if not is_member(us_id, uni_id):
+        return jsonify({"error": "You are not a member of this universe"}), 403
 
-        return jsonify(messages_list)
+    # One page at a time: ?limit= (default 100), ?cursor= (next_cursor of the previous
+    # page), ?fields=m_id,m_txt,... and ?format=rows (see messages_page.py). Without
+    # cursor/limit/format: the whole list as a bare array, like before pagination
+    page, error = parse_page_args(request.args, uni_id)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if page["limit"] is None:
+        # Unbounded list: streamed chunk by chunk and never cached, only the ETag is kept
+        etag = make_etag(f"messages.{uni_id}", "stream|" + ",".join(page["fields"]),
+                         dataset_versions.current(f"messages.{uni_id}"))
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            sql = messages_page_sql(page["fields"])
+
+            def fetch_chunk(after, limit):
+                with db_pool.connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute(sql, {"uni_id": uni_id, "after": after, "limit": limit})
+                    return cur.fetchall()
 
-    finally:
-        release_db_connection(conn)
+            response = Response(stream_messages_array(fetch_chunk, app.json.dumps_bytes), mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    # Pages are the same for every member, so they are served per universe
+    # version (ETag / cached body)
+    variant = f"{page['after']}|{page['limit']}|{','.join(page['fields'])}|{'rows' if page['rows'] else 'objects'}"
+
+    def build():
+        with db_pool.connection() as conn:
+            # ?format=rows: tuples straight from the cursor, no dictionary per row
+            cur = conn.cursor(cursor_factory=TimingTupleCursor) if page["rows"] else conn.cursor()
+            return fetch_messages_page(cur, **page)
+
+    return versioned_json_response(f"messages.{uni_id}", variant, build)
 
 
 # Mark message as opened per user (token required)
+# Membership, view-once state and the seen insert are resolved in one statement (see message_open.py)
 @app.route("/messages/<int:m_id>/open", methods=["POST"])
 def open_message(m_id):
 
@@ -478,95 +708,292 @@ def open_message(m_id):
     if error:
         return jsonify({"error": error}), 401
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    if m_id > MAX_M_ID:
+        return jsonify({"error": "Message not found"}), 404
 
-    try:
-        # GET message
-        cur.execute("""
-            SELECT m_id, m_txt, view_once, uni_id
-            FROM messages
-            WHERE m_id = %s
-        """, (m_id,))
-        message = cur.fetchone()
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
 
-        if not message:
-            return jsonify({"error": "Message not found"}), 404
+        try:
+            result = open_messages(cur, us_id, [m_id])[0]
+            conn.commit()
 
-        # Check user is member of the universe
-        cur.execute("""
-            SELECT 1 FROM user_univ
-            WHERE us_id = %s AND uni_id = %s
-        """, (us_id, message["uni_id"]))
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
 
-        if not cur.fetchone():
-            return jsonify({"error": "Not allowed"}), 403
+    status_code = OPEN_STATUS_CODES[result["status"]]
 
-        # If message is view-once
-        if message["view_once"]:
+    if result["status"] == "not found":
+        return jsonify({"error": "Message not found"}), status_code
 
-            # Check if already seen
-            cur.execute("""
-                SELECT 1 FROM seen
-                WHERE m_id = %s AND us_id = %s
-            """, (m_id, us_id))
-            already_seen = cur.fetchone()
+    if result["status"] == "not allowed":
+        return jsonify({"error": "Not allowed"}), status_code
 
-            if already_seen:
-                return jsonify({"status": "already viewed"}), 403
+    if result["status"] == "already viewed":
+        return jsonify({"status": "already viewed"}), status_code
 
-            # First time opening -> insert into seen
-            cur.execute("""
-                INSERT INTO seen (m_id, us_id)
-                VALUES (%s, %s)
-            """, (m_id, us_id))
+    # Return message content
+    return jsonify({
+        "status": "opened",
+        "message": result["message"]
+    }), status_code
+
+# Open several messages at once, e.g. all markers at a spot: {"m_ids": [1, 2, 3]}
+# Returns one result per distinct m_id with its status ("opened", "already viewed",
+# "not allowed", "not found") and the text of the opened ones, in one round trip
+@app.route("/messages/open", methods=["POST"])
+def open_messages_batch():
+
+    us_id, error = get_current_user()
+    if error:
+        return jsonify({"error": error}), 401
+
+    m_ids, error = parse_open_ids(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
 
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+
+        try:
+            results = open_messages(cur, us_id, m_ids)
             conn.commit()
 
-        # Return message content
-        return jsonify({
-            "status": "opened",
-            "message": message["m_txt"]
-        }), 200
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
+
+    return jsonify({"results": results}), 200
+
+
+# Delta sync: messages of a universe created/updated/deleted since the client's last token.
+# ?uni_id= (required), ?since=<next_token of the last sync> (without it only a token is returned),
+# ?lat=&lon= to unlock the messages in reach (same fields as /messages/nearby, see message_changes.py)
+@app.route("/messages/changes", methods=["GET"])
+def message_changes():
+
+    us_id, error = get_current_user()
+    if error:
+        return jsonify({"error": error}), 401
+
+    params, error = parse_changes_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if not is_member(us_id, params["uni_id"]):
+        return jsonify({"error": "You are not a member of this universe"}), 403
+
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+
+        try:
+            return jsonify(fetch_message_changes(cur, **params)), 200
+
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+
+# Locations (POIs) route: GeoJSON FeatureCollection for the map
+# Optional filters: ?category=metro and ?bbox=minx,miny,maxx,maxy
+# ?stream=true builds the features in PostGIS and streams them in chunks (for big regions)
+@app.route("/locations", methods=["GET"])
+def get_locations():
+    filters, error = parse_location_filters(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # The ETL bumps the "locations" version whenever it reloads data
+    variant = f"{filters['category']}|{filters['bbox']}"
+
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        etag = make_etag("locations", "stream|" + variant, dataset_versions.current("locations"))
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            # The connection outlives this function, it goes back to the pool when the response is closed
+            response = stream_locations_response(db_pool, filters)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    def build():
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            return fetch_locations_featurecollection(cur, filters)
+
+    try:
+        return versioned_json_response("locations", variant, build)
+
+    except PoolTimeout:
+        raise
 
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 500
 
-    finally:
-        release_db_connection(conn)
+# Vector tiles route (Mapbox Vector Tiles built by PostGIS)
+# /tiles/locations/{z}/{x}/{y}.pbf[?category=metro] - POIs
+# /tiles/messages/{z}/{x}/{y}.pbf?uni_id=...        - message points of a universe (token + membership required)
+@app.route("/tiles/<layer>/<int:z>/<int:x>/<int:y>.pbf", methods=["GET"])
+def get_tile(layer, z, x, y):
+    if layer not in LAYERS:
+        return jsonify({"error": f"Unknown layer, use one of {', '.join(LAYERS)}"}), 404
+
+    if not valid_tile(z, x, y):
+        return jsonify({"error": "Invalid tile coordinates"}), 400
+
+    category = request.args.get("category")
+    if not valid_category(category):
+        return jsonify({"error": "Invalid category"}), 400
 
+    uni_id = None
 
-# Nearby messages route
+    if layer == "messages":
+        us_id, error = get_current_user()
+        if error:
+            return jsonify({"error": error}), 401
+
+        uni_id = request.args.get("uni_id", type=int)
+        if uni_id is None:
+            return jsonify({"error": "uni_id query parameter required"}), 400
+
+        if not is_member(us_id, uni_id):
+            return jsonify({"error": "You are not a member of this universe"}), 403
+
+    scope = uni_id if layer == "messages" else (category or "all")
+
+    tile = tile_cache.get(layer, scope, z, x, y)
+
+    if tile is None:
+        # Read before the query: put() drops the tile if the scope is invalidated meanwhile
+        generation = tile_cache.generation(layer, scope)
+
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+
+            try:
+                tile = fetch_tile(cur, layer, z, x, y, category=category, uni_id=uni_id)
+
+            except Exception as e:
+                conn.rollback()
+                return jsonify({"error": str(e)}), 500
+
+        tile_cache.put(layer, scope, z, x, y, tile, generation)
+
+    return Response(tile, mimetype="application/vnd.mapbox-vector-tile")
+
+# Nearby messages route: messages within the search radius, closest first.
+# Messages outside their unlock radius (unl_rad) are returned locked (text hidden).
 @app.route("/messages/nearby", methods=["GET"])
 def nearby_messages():
-    lat = request.args.get("lat")
-    lon = request.args.get("lon")
-    uni_id = request.args.get("uni_id")
+    params, error = parse_nearby_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
 
-    if not lat or not lon or not uni_id:
-        return jsonify({"error": "lat, lon and uni_id required"}), 400
+    messages_list = nearby_cache.lookup(**params)
+    if messages_list is not None:
+        return jsonify(messages_list)
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+
+        try:
+            messages_list = nearby_cache.load(cur, **params)
+            return jsonify(messages_list)
+
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+# Messages in the map viewport: single messages when zoomed in, clusters (count +
+# centroid per grid cell) when zoomed out or too dense, so the response stays small
+# /messages/bbox?uni_id=&minx=&miny=&maxx=&maxy=&zoom= (see viewport.py)
+@app.route("/messages/bbox", methods=["GET"])
+def viewport_messages():
+    us_id, error = get_current_user()
+    if error:
+        return jsonify({"error": error}), 401
+
+    params, error = parse_bbox_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if not is_member(us_id, params["uni_id"]):
+        return jsonify({"error": "You are not a member of this universe"}), 403
+
+    # Same for every member: cached per universe version like GET /messages
+    variant = "bbox|{zoom}|{minx}|{miny}|{maxx}|{maxy}".format(**params)
+
+    def build():
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            return fetch_viewport_messages(cur, **params)
 
     try:
-        cur.execute("""
-            SELECT m.m_id, m.m_txt, m.unl_rad, l.location_id
-            FROM messages m
-            JOIN locations l ON m.location_id = l.location_id
-            WHERE m.uni_id = %s
-            AND ST_DWithin(
-                l.geom::geography,
-                ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography,
-                m.unl_rad
-            );
-        """, (uni_id, lon, lat))
-        messages_list = cur.fetchall()
-        return jsonify(messages_list)
+        return versioned_json_response(f"messages.{params['uni_id']}", variant, build)
+
+    except PoolTimeout:
+        raise
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Live events of a universe as Server-Sent Events: "message" (new message, without its text),
+# "vote" (poll vote) and "resync" (events may have been missed, reload).
+# EventSource can't send an Authorization header, so the token may also be passed as ?token=
+@app.route("/universes/<int:uni_id>/events", methods=["GET"])
+def universe_events(uni_id):
+    us_id, error = get_current_user(request.args.get("token"))
+    if error:
+        return jsonify({"error": error}), 401
+
+    if not is_member(us_id, uni_id):
+        return jsonify({"error": "You are not a member of this universe"}), 403
+
+    return Response(
+        event_broker.stream(uni_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# In-process cache and connection pool statistics (hit/miss counters, connections
+# in use, waiting requests, wait times), useful when load testing
+@app.route("/stats")
+def stats():
+    return jsonify({
+        "session_cache": session_cache.stats(),
+        "invalid_token_cache": invalid_token_cache.stats(),
+        "membership_cache": membership_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "session_reaper": session_reaper.stats(),
+        "nearby_cache": nearby_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "db_pools": all_pool_metrics(),
+        "events": event_broker.stats(),
+        "slow_queries": slow_query_log.stats()
+    })
+
+# Recent slow queries, newest first, with their EXPLAIN plan when sampled
+# (enable with COORDINOTE_SLOW_QUERY_MS, see slow_queries.py)
+@app.route("/admin/slow-queries", methods=["GET"])
+def slow_queries():
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    return jsonify({
+        **slow_query_log.stats(),
+        "queries": slow_query_log.entries(limit=max(limit, 1))
+    })
 
-    finally:
-        release_db_connection(conn)
+# Prometheus metrics: request latency per route and status, query times per route,
+# pool checkout waits and pool state, in-flight requests and response sizes
+@app.route("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
 
 # Protected test route
 @app.route("/protected-test")
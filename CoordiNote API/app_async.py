@@ -0,0 +1,570 @@
+# -------------------------------------------------------------------
+# ASYNC SERVING MODE
+#
+# The same API as app.py for the hot routes (auth, universes, messages, nearby,
+# open), served by Quart (Flask's async twin) with an asyncpg connection pool.
+# While a request waits on Postgres the event loop serves other requests, so one
+# process can keep hundreds of slow mobile clients in flight instead of being
+# capped at one request per worker thread / pool connection.
+#
+# Run with:
+#   hypercorn app_async:app --bind 0.0.0.0:5001
+#
+# The other routes (locations, tiles, ...) stay on app.py.
+
+import asyncio
+import json
+import logging
+import re
+import uuid  # for generating unique session tokens
+from datetime import datetime, timedelta
+
+import asyncpg  # async PostgreSQL driver
+from asyncpg.exceptions import UniqueViolationError
+from quart import Quart, Response, request, jsonify
+
+from cache import TTLCache
+from messages_page import astream_messages_array, build_page, messages_page_sql, parse_page_args
+from message_open import MAX_M_ID, OPEN_MESSAGES_SQL, OPEN_STATUS_CODES, parse_open_ids
+from passwords import HashingBusy, PasswordHasher
+from sessions import MAX_SESSIONS_PER_USER, SESSION_CAP_SQL, SESSIONS_REVOKED_SQL
+from nearby import NEARBY_MESSAGES_SQL, LOCKED_MESSAGE_TEXT, parse_nearby_args
+from tiles import TileCache
+from versions import DatasetVersions
+
+# Database configuration (same database as app.py)
+
+DB_CONFIG = {
+    "database": "coordinote_db",
+    "user": "postgres",
+    "password": "postgres",
+    "host": "localhost",
+    "port": "5432"
+}
+
+# asyncpg pool: connections are only held while a query runs, so a few dozen
+# connections serve many more concurrent requests
+POOL_MIN_SIZE = 5
+POOL_MAX_SIZE = 50
+
+# Session caches, same settings as app.py
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 300  # seconds
+INVALID_TOKEN_CACHE_SIZE = 1000
+INVALID_TOKEN_CACHE_TTL = 10  # seconds
+
+# Session revocations of app.py arrive on the events channel (see events.py / sessions.py)
+EVENTS_CHANNEL = "coordinote_events"
+RECONNECT_DELAY_MAX = 30  # seconds
+
+logger = logging.getLogger(__name__)
+
+app = Quart(__name__)
+
+db_pool = None
+events_task = None
+session_cache = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+invalid_token_cache = TTLCache(maxsize=INVALID_TOKEN_CACHE_SIZE, ttl=INVALID_TOKEN_CACHE_TTL)
+
+# Shared (on disk) with app.py and the ETL, so writes here invalidate their caches too
+tile_cache = TileCache()
+dataset_versions = DatasetVersions()
+
+
+def connect_args():
+    return {
+        "database": DB_CONFIG["database"],
+        "user": DB_CONFIG["user"],
+        "password": DB_CONFIG["password"],
+        "host": DB_CONFIG["host"],
+        "port": int(DB_CONFIG["port"]),
+    }
+
+
+@app.before_serving
+async def create_pool():
+    global db_pool, events_task
+    db_pool = await asyncpg.create_pool(**connect_args(), min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE)
+    events_task = asyncio.get_running_loop().create_task(listen_for_events())
+
+
+@app.after_serving
+async def close_pool():
+    events_task.cancel()
+    await db_pool.close()
+    password_hasher.shutdown()
+
+
+def on_database_event(connection, pid, channel, payload):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        return
+    if isinstance(event, dict) and event.get("type") == "sessions_revoked":
+        us_id = event.get("us_id")
+        session_cache.invalidate_where(lambda token, result: result[0] == us_id)
+
+
+# One extra connection LISTENs for the whole process. Revocations sent while it is
+# down are lost, so the session cache is emptied on every (re)connect.
+async def listen_for_events():
+    delay = 1
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(**connect_args())
+            lost = asyncio.Event()
+            conn.add_termination_listener(lambda connection: lost.set())
+            await conn.add_listener(EVENTS_CHANNEL, on_database_event)
+            session_cache.clear()
+            delay = 1
+            await lost.wait()
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            logger.exception("Event listener failed, reconnecting in %s s", delay)
+
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+
+# Helper functions
+
+_PYFORMAT_PARAM = re.compile(r"%\((\w+)\)s")
+
+# asyncpg uses numbered placeholders ($1, $2, ...), this converts the %(name)s
+# queries shared with the sync app (e.g. nearby.py) into that form
+def to_asyncpg(sql, params):
+    names = []
+
+    def replace(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    return _PYFORMAT_PARAM.sub(replace, sql), [params[name] for name in names]
+
+# The version files and tile directories are on disk (bump() writes a file,
+# invalidate() runs rmtree): that I/O runs in the default thread pool instead of
+# blocking the event loop
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+# bcrypt is CPU bound, it runs in a bounded process pool so it neither blocks the
+# event loop nor competes for the GIL (see passwords.py)
+password_hasher = PasswordHasher()
+
+@app.errorhandler(HashingBusy)
+async def hashing_busy(e):
+    return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "1"}
+
+async def get_current_user():
+    token = request.headers.get("Authorization")
+
+    if not token:
+        return None, "Missing token"
+
+    cached = session_cache.get(token) or invalid_token_cache.get(token)
+    if cached is not None:
+        return cached
+
+    session = await db_pool.fetchrow("""
+        SELECT us_id, expires_at
+        FROM sessions
+        WHERE token = $1
+    """, token)
+
+    if not session:
+        result = (None, "Invalid token")
+        invalid_token_cache.set(token, result)
+        return result
+
+    remaining = (session["expires_at"] - datetime.utcnow()).total_seconds()
+    if remaining <= 0:
+        result = (None, "Token expired")
+        invalid_token_cache.set(token, result)
+        return result
+
+    result = (session["us_id"], None)
+    session_cache.set(token, result, ttl=remaining)
+    return result
+
+
+@app.route("/")
+async def home():
+    return jsonify({"message": "Coordinote API (async) is running!"})
+
+# User registration route
+@app.route("/users/register", methods=["POST"])
+async def register_user():
+    data = await request.get_json(silent=True)
+
+    if not data:
+        return jsonify({"error": "Invalid or missing JSON body"}), 400
+
+    username = data.get("username")
+    password = data.get("password")
+    repeat_password = data.get("repeat_password")
+
+    if not username or not password or not repeat_password:
+        return jsonify({"error": "All fields required"}), 400
+
+    if password != repeat_password:
+        return jsonify({"error": "Passwords do not match"}), 400
+
+    hashed_password = await password_hasher.hash_async(password)
+
+    try:
+        us_id = await db_pool.fetchval("""
+            INSERT INTO users (us_id, us_name, pwd)
+            VALUES (DEFAULT, $1, $2)
+            RETURNING us_id;
+        """, username, hashed_password)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({
+        "message": "User created successfully",
+        "us_id": us_id
+    })
+
+# User login route
+@app.route("/users/login", methods=["POST"])
+async def login_user():
+    data = await request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "Invalid or missing JSON"}), 400
+
+    username = data.get("username")
+    password = data.get("password")
+    if not username or not password:
+        return jsonify({"error": "Username and password required"}), 400
+
+    user = await db_pool.fetchrow("SELECT us_id, pwd FROM users WHERE us_name = $1;", username)
+
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    verified, new_hash = await password_hasher.verify_and_update_async(password, user["pwd"])
+    if not verified:
+        return jsonify({"error": "Username and password do not match. Try again."}), 401
+
+    token = str(uuid.uuid4())
+    expires_at = datetime.utcnow() + timedelta(hours=72)
+
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                # Stored with an older cost factor: replace it with the new hash,
+                # in the same transaction as the session
+                if new_hash:
+                    await conn.execute("UPDATE users SET pwd = $1 WHERE us_id = $2;", new_hash, user["us_id"])
+
+                await conn.execute("""
+                    INSERT INTO sessions (us_id, token, expires_at)
+                    VALUES ($1, $2, $3)
+                """, user["us_id"], token, expires_at)
+
+                # Only the user's newest sessions are kept (sessions.py)
+                sql, args = to_asyncpg(SESSION_CAP_SQL, {"us_id": user["us_id"], "keep": MAX_SESSIONS_PER_USER})
+                dropped = await conn.fetch(sql, *args)
+                if dropped:
+                    # The other processes drop the user's cached sessions once this commits
+                    sql, args = to_asyncpg(SESSIONS_REVOKED_SQL, {"us_id": user["us_id"]})
+                    await conn.execute(sql, *args)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    for row in dropped:
+        session_cache.invalidate(row["token"])
+
+    return jsonify({
+        "message": "Login successful",
+        "token": token
+    })
+
+# Universes of the user (GET) / create a universe (POST)
+@app.route("/universes", methods=["GET", "POST"])
+async def universes():
+    us_id, error = await get_current_user()
+    if error:
+        return jsonify({"error": error}), 401
+
+    if request.method == "POST":
+        data = await request.get_json(silent=True)
+        if not data:
+            return jsonify({"error": "Invalid JSON"}), 400
+
+        name = data.get("name")
+        access = data.get("access", False)  # boolean: false = public and is default, true = private
+        descri = data.get("descri")  # can be None
+
+        if not name:
+            return jsonify({"error": "Insert universe name"}), 400
+
+        # Universe + creator's membership in one transaction, like app.py
+        try:
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    uni_id = await conn.fetchval("""
+                        INSERT INTO universes (uni_name, access, descri)
+                        VALUES ($1, $2, $3)
+                        RETURNING uni_id;
+                    """, name, access, descri)
+
+                    await conn.execute("""
+                        INSERT INTO user_univ (us_id, uni_id)
+                        VALUES ($1, $2)
+                        ON CONFLICT DO NOTHING;
+                    """, us_id, uni_id)
+
+        except UniqueViolationError:
+            return jsonify({
+                "error": "Universe name already exists. Be more original."
+            }), 400
+
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+        await run_blocking(dataset_versions.bump, "universes")
+        return jsonify({
+            "message": "Universe created",
+            "uni_id": uni_id
+        }), 201
+
+    rows = await db_pool.fetch("""
+        SELECT u.uni_name, u.access, u.descri
+        FROM universes u
+        JOIN user_univ uu ON u.uni_id = uu.uni_id
+        WHERE uu.us_id = $1;
+    """, us_id)
+    return jsonify([dict(row) for row in rows])
+
+# Join universe route
+@app.route("/universes/join", methods=["POST"])
+async def join_universe():
+    us_id, error = await get_current_user()
+    if error:
+        return jsonify({"error": error}), 401
+
+    data = await request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "Invalid JSON"}), 400
+
+    uni_name = data.get("uni_name")
+    if not uni_name:
+        return jsonify({"error": "uni_name required"}), 400
+
+    async with db_pool.acquire() as conn:
+        uni_id = await conn.fetchval("SELECT uni_id FROM universes WHERE uni_name = $1;", uni_name)
+
+        if uni_id is None:
+            return jsonify({"error": "Universe not found"}), 404
+
+        await conn.execute("""
+            INSERT INTO user_univ (us_id, uni_id)
+            VALUES ($1, $2)
+            ON CONFLICT DO NOTHING;
+        """, us_id, uni_id)
+
+    return jsonify({"message": f"Joined {uni_name}"}), 200
+
+# Leave universe route
+@app.route("/universes/leave", methods=["POST"])
+async def leave_universe():
+    us_id, error = await get_current_user()
+    if error:
+        return jsonify({"error": error}), 401
+
+    data = await request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "Invalid JSON"}), 400
+
+    uni_name = data.get("uni_name")
+    if not uni_name:
+        return jsonify({"error": "uni_name required"}), 400
+
+    async with db_pool.acquire() as conn:
+        uni_id = await conn.fetchval("SELECT uni_id FROM universes WHERE uni_name = $1;", uni_name)
+
+        if uni_id is None:
+            return jsonify({"error": "Universe not found"}), 404
+
+        await conn.execute("""
+            DELETE FROM user_univ
+            WHERE us_id = $1 AND uni_id = $2;
+        """, us_id, uni_id)
+
+    return jsonify({"message": f"Left {uni_name}"}), 200
+
+# Messages route: POST + GET
+@app.route("/messages", methods=["GET", "POST"])
+async def messages():
+    us_id, error = await get_current_user()
+    if error:
+        return jsonify({"error": error}), 401
+
+    if request.method == "POST":
+        data = await request.get_json(silent=True)
+        if not data:
+            return jsonify({"error": "Invalid or missing JSON"}), 400
+
+        m_type = data.get("m_type")  # "text" or "poll"
+        unl_rad = data.get("unl_rad")
+        view_once = data.get("view_once")  # true/false
+        m_txt = data.get("m_txt")
+        uni_id = data.get("uni_id")
+        poll = data.get("poll")
+        location_id = data.get("location_id")
+
+        if not m_type or unl_rad is None or view_once is None or not m_txt or not uni_id:
+            return jsonify({"error": "Missing required fields"}), 400
+
+        try:
+            uni_id = int(uni_id)
+        except (TypeError, ValueError):
+            return jsonify({"error": "uni_id must be an integer"}), 400
+
+        async with db_pool.acquire() as conn:
+            is_member = await conn.fetchval("""
+                SELECT 1 FROM user_univ
+                WHERE us_id = $1 AND uni_id = $2;
+            """, us_id, uni_id)
+
+            if not is_member:
+                return jsonify({"error": "You are not a member of this universe"}), 403
+
+            try:
+                m_id = await conn.fetchval("""
+                    INSERT INTO messages (
+                        m_type, unl_rad, crt_time, view_once, m_txt, creator, uni_id, poll, location_id
+                    ) VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9)
+                    RETURNING m_id;
+                """, m_type, unl_rad, datetime.utcnow(), view_once, m_txt, us_id, uni_id, poll, location_id)
+
+            except Exception as e:
+                return jsonify({"error": str(e)}), 500
+
+        await run_blocking(dataset_versions.bump, f"messages.{uni_id}")
+        await run_blocking(tile_cache.invalidate, "messages", uni_id)
+        return jsonify({"message": "Message created", "m_id": m_id}), 201
+
+    # GET messages
+    uni_id = request.args.get("uni_id", type=int)
+    if not uni_id:
+        return jsonify({"error": "uni_id query parameter required"}), 400
+
+    async with db_pool.acquire() as conn:
+        is_member = await conn.fetchval("""
+            SELECT 1 FROM user_univ
+            WHERE us_id = $1 AND uni_id = $2;
+        """, us_id, uni_id)
+
+        if not is_member:
+            return jsonify({"error": "You are not a member of this universe"}), 403
+
+        # Keyset pagination, same parameters and response as app.py (messages_page.py),
+        # bare array when no pagination argument is given
+        page, error = parse_page_args(request.args, uni_id)
+        if error:
+            return jsonify({"error": error}), 400
+
+        if page["limit"] is not None:
+            sql, args = to_asyncpg(messages_page_sql(page["fields"]), page)
+            rows = await conn.fetch(sql, *args)
+
+    if page["limit"] is None:
+        # Unbounded list: streamed in keyset chunks, a pool connection per chunk
+        async def fetch_chunk(after, limit):
+            sql, args = to_asyncpg(messages_page_sql(page["fields"]), dict(page, after=after, limit=limit))
+            return [dict(row) for row in await db_pool.fetch(sql, *args)]
+
+        def dumps_bytes(rows):
+            return app.json.dumps(rows).encode()
+
+        return Response(astream_messages_array(fetch_chunk, dumps_bytes), mimetype="application/json")
+
+    if page["rows"]:
+        return jsonify(build_page([tuple(row) for row in rows], uni_id, page["limit"], columns=page["fields"]))
+    return jsonify(build_page([dict(row) for row in rows], uni_id, page["limit"]))
+
+# Mark message as opened per user (token required)
+@app.route("/messages/<int:m_id>/open", methods=["POST"])
+async def open_message(m_id):
+    us_id, error = await get_current_user()
+    if error:
+        return jsonify({"error": error}), 401
+
+    if m_id > MAX_M_ID:
+        return jsonify({"error": "Message not found"}), 404
+
+    sql, args = to_asyncpg(OPEN_MESSAGES_SQL, {"m_ids": [m_id], "us_id": us_id})
+    try:
+        result = await db_pool.fetchrow(sql, *args)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    status_code = OPEN_STATUS_CODES[result["status"]]
+
+    if result["status"] == "not found":
+        return jsonify({"error": "Message not found"}), status_code
+
+    if result["status"] == "not allowed":
+        return jsonify({"error": "Not allowed"}), status_code
+
+    if result["status"] == "already viewed":
+        return jsonify({"status": "already viewed"}), status_code
+
+    return jsonify({
+        "status": "opened",
+        "message": result["message"]
+    }), status_code
+
+# Batch open, same statement as app.py (message_open.py)
+@app.route("/messages/open", methods=["POST"])
+async def open_messages_batch():
+    us_id, error = await get_current_user()
+    if error:
+        return jsonify({"error": error}), 401
+
+    m_ids, error = parse_open_ids(await request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+
+    sql, args = to_asyncpg(OPEN_MESSAGES_SQL, {"m_ids": m_ids, "us_id": us_id})
+    try:
+        rows = await db_pool.fetch(sql, *args)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({"results": [dict(row) for row in rows]}), 200
+
+# Nearby messages route, same query engine as app.py (nearby.py)
+@app.route("/messages/nearby", methods=["GET"])
+async def nearby_messages():
+    params, error = parse_nearby_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    sql, args = to_asyncpg(NEARBY_MESSAGES_SQL, dict(params, locked_text=LOCKED_MESSAGE_TEXT))
+
+    try:
+        rows = await db_pool.fetch(sql, *args)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify([dict(row) for row in rows])
+
+
+# Run server (development only, use hypercorn for load tests / production)
+
+if __name__ == "__main__":
+    app.run(port=5001, debug=True)
@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A small thread-safe in-process cache with a per-entry time to live and
+    least-recently-used eviction once `maxsize` entries are stored.
+
+    If `max_bytes` is given, entries are also evicted once the estimated
+    memory of all values (as reported by `sizeof`) goes over it.
+
+    Hit/miss/eviction counters are kept so the effect of a cache can be
+    inspected while the API is under load (see the /stats route).
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, max_bytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()  # key -> (value, deadline, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Returns the cached value for `key`, or `default` if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, deadline, size = entry
+            if deadline <= time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores `value` under `key`. `ttl` (seconds) overrides the default time
+        to live; a ttl of zero or less means the value is not cached at all.
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        size = self.sizeof(value) if self.sizeof else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+
+            self._entries[key] = (value, time.monotonic() + ttl, size)
+            self._bytes += size
+
+            while len(self._entries) > self.maxsize or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Removes a single key from the cache (no error if it is missing)."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def invalidate_where(self, predicate):
+        """Removes every entry for which predicate(key, value) is true."""
+        with self._lock:
+            stale = [key for key, (value, _, _) in self._entries.items() if predicate(key, value)]
+            for key in stale:
+                self._bytes -= self._entries.pop(key)[2]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            }
@@ -0,0 +1,288 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from metrics import POOL_WAIT, REGISTRY, TimingCursor
+
+# -------------------------------------------------------------------
+# SHARED CONNECTION POOL MANAGER
+#
+# Used by app.py, api_check_my_location.py, api_endpint_for_etl.py and the poll
+# module instead of one psycopg2 SimpleConnectionPool each (which is not thread
+# safe and raises "connection pool exhausted" as soon as all connections are out).
+#
+#   - thread safe and bounded (maxconn)
+#   - requests wait in a queue for a free connection, up to `timeout` seconds,
+#     then PoolTimeout is raised (the apps turn it into a 503)
+#   - connections idle for more than `health_check_after` seconds are checked
+#     with SELECT 1 before they are handed out, dead ones are replaced, and
+#     connections older than `max_lifetime` are recycled
+#   - checkout with `with pool.connection() as conn:` always gives the connection
+#     back (rolled back if a transaction was left open), so leaks are impossible
+#   - metrics(): connections in use, waiting requests, wait times, ...
+#     (also exported on /metrics, with a histogram of the checkout wait times)
+
+DEFAULT_MINCONN = 1
+DEFAULT_MAXCONN = 10
+DEFAULT_TIMEOUT = 10  # seconds a request may wait for a connection
+DEFAULT_HEALTH_CHECK_AFTER = 30  # seconds idle before a connection is checked
+DEFAULT_MAX_LIFETIME = 30 * 60  # seconds
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the pool's timeout."""
+
+
+class ConnectionPool:
+
+    def __init__(self, minconn=DEFAULT_MINCONN, maxconn=DEFAULT_MAXCONN, timeout=DEFAULT_TIMEOUT,
+                 health_check_after=DEFAULT_HEALTH_CHECK_AFTER, max_lifetime=DEFAULT_MAX_LIFETIME,
+                 **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.max_lifetime = max_lifetime
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, returned_at), most recently returned on the right
+        self._created = {}  # id(conn) -> creation time
+        self._size = 0  # open connections, idle + in use (+ being opened)
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        # metrics
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+        self._recycled = 0
+
+        for _ in range(minconn):
+            with self._cond:
+                self._size += 1
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(**self.connect_kwargs)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        """Closes a connection that won't go back to the pool (caller holds no lock)."""
+        self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._created.get(id(conn), 0) > self.max_lifetime:
+            return False
+        if time.monotonic() - returned_at > self.health_check_after:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def getconn(self, timeout=None):
+        """
+        Checks a connection out of the pool, waiting up to `timeout` seconds
+        (the pool's default if None). Prefer the connection() context manager.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+
+        with self._cond:
+            if self._closed:
+                raise PoolTimeout("connection pool is closed")
+
+            self._waiting += 1
+            try:
+                while not self._idle and self._size >= self.maxconn:
+                    waited = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        if not self._idle and self._size >= self.maxconn:
+                            self._timeouts += 1
+                            raise PoolTimeout(
+                                f"no database connection available after {timeout} s "
+                                f"({self._in_use} in use, {self._waiting - 1} waiting)"
+                            )
+            finally:
+                self._waiting -= 1
+
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn, returned_at = None, None
+                self._size += 1
+
+            self._in_use += 1
+            self._checkouts += 1
+            wait_time = time.monotonic() - start
+            if waited:
+                self._waits += 1
+                self._wait_time_total += wait_time
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+
+        POOL_WAIT.observe(wait_time, self.connect_kwargs.get("database"))
+
+        try:
+            if conn is not None and not self._is_healthy(conn, returned_at):
+                self._discard(conn)
+                with self._cond:
+                    self._recycled += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def putconn(self, conn):
+        """Gives a connection back to the pool (rolled back if a transaction is still open)."""
+        keep = not conn.closed and not self._closed
+        if keep and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                keep = False
+
+        if not keep:
+            self._discard(conn)
+
+        with self._cond:
+            self._in_use -= 1
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._size -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            ...
+        The connection is always returned to the pool, even on errors / early returns.
+        """
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "maxconn": self.maxconn,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time_total_s": round(self._wait_time_total, 4),
+                "wait_time_max_s": round(self._wait_time_max, 4),
+                "timeouts": self._timeouts,
+                "recycled": self._recycled,
+            }
+
+
+# One pool per database, shared by every module of the process that uses it
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_config, minconn=DEFAULT_MINCONN, maxconn=DEFAULT_MAXCONN, **options):
+    """
+    Returns the shared pool for a DB_CONFIG dictionary, creating it on first use.
+    Rows are returned as dictionaries (RealDictCursor) like before, by a cursor
+    that also records the query times for /metrics (metrics.TimingCursor).
+    """
+    key = tuple(sorted(db_config.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(
+                minconn=minconn,
+                maxconn=maxconn,
+                cursor_factory=TimingCursor,
+                **options,
+                **db_config,
+            )
+            _pools[key] = pool
+        return pool
+
+
+def all_pool_metrics():
+    """Metrics of every pool in this process, keyed by database name."""
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {dict(key)["database"]: pool.metrics() for key, pool in pools}
+
+
+POOL_GAUGES = (
+    ("size", "Open connections, idle and in use."),
+    ("in_use", "Connections checked out of the pool."),
+    ("idle", "Connections waiting in the pool."),
+    ("waiting", "Requests waiting for a connection."),
+)
+POOL_COUNTERS = (
+    ("checkouts", "Connections handed out by the pool."),
+    ("timeouts", "Requests that got no connection in time (503)."),
+    ("recycled", "Dead or too old connections that were replaced."),
+)
+
+
+def collect_pool_metrics():
+    """Lines for /metrics with the current state of every pool (see metrics.Registry)."""
+    pools = all_pool_metrics()
+    lines = []
+    for key, documentation in POOL_GAUGES:
+        name = f"coordinote_db_pool_{key}"
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+        lines += [f'{name}{{database="{database}"}} {values[key]}' for database, values in pools.items()]
+    for key, documentation in POOL_COUNTERS:
+        name = f"coordinote_db_pool_{key}_total"
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} counter"]
+        lines += [f'{name}{{database="{database}"}} {values[key]}' for database, values in pools.items()]
+    return lines
+
+
+REGISTRY.register_collector(collect_pool_metrics)
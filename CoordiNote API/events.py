@@ -0,0 +1,240 @@
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+# -------------------------------------------------------------------
+# SERVER-SENT EVENTS PER UNIVERSE (Postgres LISTEN/NOTIFY)
+#
+# Triggers from DB/migrations/005_event_notify.sql (once per statement since
+# 011_event_notify_statement.sql) send a NOTIFY on the "coordinote_events"
+# channel when a message is created or a poll vote is recorded. The payload is a
+# small JSON object with its "type" and "uni_id"; bulk inserts send a single
+# "resync" without uni_id instead, for the clients of every universe.
+#
+# Each process holds ONE extra connection that LISTENs on the channel (started
+# with the first subscriber) and fans the events out to the queues of all
+# clients subscribed to that universe. The connection is not taken from the
+# pool because it stays open for the lifetime of the process.
+#
+# Listeners (add_listener) get every event of the channel in the listener thread,
+# for in-process caches that must follow writes made by other workers or by
+# app_async.py (see on_database_event in app.py). They also get the "resync"
+# sent after a reconnect, since invalidations may have been missed meanwhile.
+#
+# Every open stream keeps a worker thread busy, so run the sync app with enough
+# threads (e.g. gunicorn --threads) when many clients keep the map open.
+
+EVENTS_CHANNEL = "coordinote_events"
+SUBSCRIBER_QUEUE_SIZE = 100  # events buffered per client before it is dropped
+KEEPALIVE_INTERVAL = 15  # seconds, comment line so proxies don't close idle streams
+POLL_INTERVAL = 5  # seconds the listener waits on the socket between checks
+RECONNECT_DELAY_MAX = 30  # seconds
+CLIENT_RETRY_MS = 3000  # how long EventSource waits before reconnecting
+INTERNAL_EVENTS = ("sessions_revoked",)  # for the listeners only, never sent to clients (sessions.py)
+
+logger = logging.getLogger(__name__)
+
+
+def format_sse(event_type, data):
+    """One SSE frame: `event:` line, JSON `data:` line and the blank line that ends it."""
+    return f"event: {event_type}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class Subscription:
+    """Queue of one client. `closed` is set when the client fell too far behind."""
+
+    def __init__(self, uni_id, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.uni_id = uni_id
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.closed = False
+
+
+class EventBroker:
+
+    def __init__(self, db_config, channel=EVENTS_CHANNEL):
+        self.db_config = db_config
+        self.channel = channel
+
+        self._lock = threading.Lock()
+        self._subscribers = {}  # uni_id -> set of Subscription
+        self._thread = None
+        self._listeners = []
+
+        # stats
+        self._received = 0
+        self._delivered = 0
+        self._dropped = 0
+        self._reconnects = 0
+
+    # --- subscribers -------------------------------------------------
+
+    def subscribe(self, uni_id):
+        self._start()
+        sub = Subscription(uni_id)
+        with self._lock:
+            self._subscribers.setdefault(uni_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.uni_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.uni_id]
+
+    def stream(self, uni_id):
+        """
+        Generator of SSE text for one client of a universe, use it as the body of a
+        text/event-stream response. It ends when the client is dropped for being
+        too slow; EventSource then reconnects by itself.
+        """
+        sub = self.subscribe(uni_id)
+        try:
+            yield f"retry: {CLIENT_RETRY_MS}\n\n"
+            while not sub.closed:
+                try:
+                    event = sub.queue.get(timeout=KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event["type"], event)
+        finally:
+            self.unsubscribe(sub)
+
+    def _publish(self, event, uni_id=None):
+        """Queues an event for the subscribers of its universe (or of every universe if uni_id is None)."""
+        with self._lock:
+            if uni_id is None:
+                subs = [sub for group in self._subscribers.values() for sub in group]
+            else:
+                subs = list(self._subscribers.get(uni_id, ()))
+
+        for sub in subs:
+            try:
+                sub.queue.put_nowait(event)
+                self._delivered += 1
+            except queue.Full:
+                # The client stopped reading; drop it instead of buffering without limit
+                sub.closed = True
+                self.unsubscribe(sub)
+                self._dropped += 1
+
+    # --- LISTEN connection -------------------------------------------
+
+    def add_listener(self, callback):
+        """Calls callback(event) for every event received, and starts listening."""
+        with self._lock:
+            self._listeners.append(callback)
+        self._start()
+
+    def start(self):
+        """Starts listening if not done yet (e.g. in a worker forked after add_listener)."""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            # A thread started before a fork doesn't run in the child
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen_forever, name="event-listener", daemon=True)
+                self._thread.start()
+
+    def _listen_forever(self):
+        try:
+            self._listen_loop()
+        finally:
+            # Only reached if the loop itself dies: the next subscriber starts a new thread
+            with self._lock:
+                self._thread = None
+
+    def _listen_loop(self):
+        delay = 1
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.db_config)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel};")
+
+                if connected_before:
+                    # Events sent while we were disconnected are lost, clients should reload
+                    self._reconnects += 1
+                    self._notify_listeners({"type": "resync"})
+                    self._publish({"type": "resync"})
+                connected_before = True
+                delay = 1
+
+                while True:
+                    if select.select([conn], [], [], POLL_INTERVAL) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+
+            except Exception:
+                # Not only psycopg2 errors (select on a closed socket raises OSError, ...):
+                # any failure reconnects, otherwise the subscribers would never get an event again
+                logger.exception("Event listener failed, reconnecting in %s s", delay)
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _dispatch(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        if not isinstance(event, dict):
+            return
+        self._received += 1
+        self._notify_listeners(event)
+
+        if event.get("type") in INTERNAL_EVENTS:
+            return
+        try:
+            if event.get("type") == "resync" and event.get("uni_id") is None:
+                uni_id = None  # bulk insert (DB/migrations/011_event_notify_statement.sql): every universe
+            else:
+                uni_id = int(event["uni_id"])
+        except (ValueError, KeyError, TypeError):
+            return
+        self._publish(event, uni_id)
+
+    def _notify_listeners(self, event):
+        with self._lock:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("Event listener callback failed for %s", event.get("type"))
+
+    def stats(self):
+        with self._lock:
+            universes = len(self._subscribers)
+            subscribers = sum(len(subs) for subs in self._subscribers.values())
+        return {
+            "listening": self._thread is not None,
+            "universes": universes,
+            "subscribers": subscribers,
+            "received": self._received,
+            "delivered": self._delivered,
+            "dropped": self._dropped,
+            "reconnects": self._reconnects,
+        }
@@ -0,0 +1,85 @@
+import dataclasses
+import decimal
+import json
+import uuid
+from datetime import date, datetime, time
+
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used instead
+    orjson = None
+
+# -------------------------------------------------------------------
+# FAST JSON RESPONSES
+#
+# jsonify()/app.json use orjson when it is installed (several times faster than
+# the stdlib encoder on the big /messages and /locations payloads), and fall back
+# to the json module otherwise. Both encode the same way:
+#
+#   - datetime/date/time as ISO 8601 ("2026-05-01T12:30:00"), UUIDs as strings
+#   - Decimal as a string, so no precision is lost
+#   - keys keep the order of the query's columns (not sorted)
+#
+# json_fragment() wraps JSON text that is already serialized (e.g. ST_AsGeoJSON)
+# so it is written into the response as is instead of being parsed and encoded
+# again. Without orjson it is parsed once with json.loads, like before.
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def _default(value):
+    """Types neither encoder handles natively."""
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)  # the stdlib encoder only, orjson encodes them itself
+    if hasattr(value, "__html__"):
+        return str(value.__html__())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def json_fragment(text):
+    """Pre-serialized JSON text, embedded into the response without re-parsing it (orjson only)."""
+    if text is None:
+        return None
+    if orjson is not None:
+        return orjson.Fragment(text)
+    return json.loads(text)
+
+
+class OrjsonProvider(JSONProvider):
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS).decode()
+
+    def dumps_bytes(self, obj):
+        return orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # The bytes go straight into the response, without a round trip through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype="application/json")
+
+
+class StdlibProvider(DefaultJSONProvider):
+    default = staticmethod(_default)
+    sort_keys = False
+
+    def dumps_bytes(self, obj):
+        return self.dumps(obj).encode()
+
+
+def install_json_provider(app):
+    """Makes jsonify()/app.json of a Flask app use orjson when available."""
+    app.json_provider_class = OrjsonProvider if orjson is not None else StdlibProvider
+    app.json = app.json_provider_class(app)
+    return app.json
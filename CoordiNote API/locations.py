@@ -0,0 +1,170 @@
+import threading
+
+from flask import Response
+
+from json_provider import json_fragment
+from utils import stream_geojson_featurecollection
+
+# -------------------------------------------------------------------
+# LOCATIONS (POIs) AS GEOJSON
+#
+# Shared by the /locations routes of app.py, api_check_my_location.py and
+# api_endpint_for_etl.py. Two modes:
+#   - default:      rows are fetched and the FeatureCollection is built in Python
+#                   (the geometries stay PostGIS text, see json_fragment)
+#   - ?stream=true: PostGIS builds every Feature as JSON text, rows are read from
+#                   a server-side (named) cursor in chunks and written straight to
+#                   a chunked HTTP response. Geometry is never parsed in Python.
+#
+# Both modes support ?category=<name> and ?bbox=minx,miny,maxx,maxy (lon/lat, EPSG:4326).
+
+STREAM_CHUNK_SIZE = 2000  # rows fetched from the server-side cursor at a time
+
+LOCATION_ROWS_SQL = """
+    SELECT location_id, l_name, category, ST_AsGeoJSON(geom) as geometry
+    FROM locations
+    {where};
+"""
+
+LOCATION_FEATURES_SQL = """
+    SELECT json_build_object(
+        'type', 'Feature',
+        'geometry', ST_AsGeoJSON(geom)::json,
+        'properties', json_build_object(
+            'location_id', location_id,
+            'name', l_name,
+            'category', category
+        )
+    )::text AS feature
+    FROM locations
+    {where};
+"""
+
+
+def parse_location_filters(args):
+    """
+    Reads the optional category and bbox filters from the query string.
+
+    :param args: The request.args of the Flask request.
+    :return: (filters, error)
+    """
+    filters = {"category": args.get("category"), "bbox": None}
+
+    bbox = args.get("bbox")
+    if bbox:
+        try:
+            minx, miny, maxx, maxy = (float(value) for value in bbox.split(","))
+        except ValueError:
+            return None, "bbox must be minx,miny,maxx,maxy"
+        if minx >= maxx or miny >= maxy:
+            return None, "bbox must be minx,miny,maxx,maxy"
+        filters["bbox"] = (minx, miny, maxx, maxy)
+
+    return filters, None
+
+
+def _where(filters):
+    """Builds the WHERE clause and its parameters for the given filters."""
+    # Locations that vanished upstream but still have messages are kept, hidden (migration 010)
+    clauses = ["removed_at IS NULL"]
+    params = {}
+
+    if filters["category"]:
+        clauses.append("category = %(category)s")
+        params["category"] = filters["category"]
+
+    if filters["bbox"]:
+        # && uses the GiST index on geom
+        clauses.append("geom && ST_MakeEnvelope(%(minx)s, %(miny)s, %(maxx)s, %(maxy)s, 4326)")
+        params.update(zip(("minx", "miny", "maxx", "maxy"), filters["bbox"]))
+
+    where = "WHERE " + " AND ".join(clauses)
+    return where, params
+
+
+def fetch_locations_featurecollection(cur, filters):
+    """Fetches the locations and builds the FeatureCollection dictionary in Python."""
+    where, params = _where(filters)
+    cur.execute(LOCATION_ROWS_SQL.format(where=where), params)
+
+    features = []
+    for loc in cur.fetchall():
+        features.append({
+            "type": "Feature",
+            "geometry": json_fragment(loc["geometry"]),  # PostGIS GeoJSON text, written out as is
+            "properties": {
+                "location_id": loc["location_id"],
+                "name": loc["l_name"],
+                "category": loc["category"]
+            }
+        })
+
+    return {"type": "FeatureCollection", "features": features}
+
+
+def stream_locations_response(pool, filters, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    The streamed FeatureCollection as a Flask Response.
+
+    The connection is checked out here, so a PoolTimeout still becomes a 503 before
+    any byte is sent. It is given back when the generator finishes and also by
+    response.call_on_close(), which runs even if the body is never iterated
+    (HEAD request, client gone before the first chunk); the release is idempotent.
+    """
+    conn = pool.getconn()
+    lock = threading.Lock()
+    released = []
+
+    def release():
+        with lock:
+            if released:
+                return
+            released.append(True)
+        pool.putconn(conn)
+
+    try:
+        response = Response(
+            stream_locations_featurecollection(conn, filters, release, chunk_size),
+            mimetype="application/geo+json"
+        )
+        response.call_on_close(release)
+    except Exception:
+        release()
+        raise
+    return response
+
+
+def stream_locations_featurecollection(conn, filters, release, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Generator yielding the FeatureCollection as text, chunk by chunk.
+    Prefer stream_locations_response(), which also releases the connection if
+    the generator never runs.
+
+    :param conn: A pooled connection, it is released with release() once the
+                 stream is finished or the client disconnects.
+    :param release: The function that gives the connection back to the pool.
+    """
+    where, params = _where(filters)
+
+    # Named cursors live on the server, so only chunk_size rows are in memory at a time
+    cur = conn.cursor(name="locations_geojson")
+    cur.itersize = chunk_size
+
+    try:
+        cur.execute(LOCATION_FEATURES_SQL.format(where=where), params)
+
+        def features():
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [row["feature"] for row in rows]
+
+        yield from stream_geojson_featurecollection(features())
+
+    finally:
+        try:
+            cur.close()
+            conn.rollback()  # ends the read-only transaction the named cursor needed
+        finally:
+            release()
@@ -0,0 +1,133 @@
+import math
+import re
+
+from nearby import LOCKED_MESSAGE_TEXT
+
+# -------------------------------------------------------------------
+# DELTA SYNC OF A UNIVERSE'S MESSAGES (GET /messages/changes)
+#
+# Needs DB/migrations/008_message_changes.sql (messages.change_xid + tombstones).
+#
+# The sync token is the xmin of a snapshot taken before the changes are read:
+# every transaction older than it has finished and its writes are in this
+# response. Writes of transactions at or after the token (possibly still
+# running) are returned again by the next sync, so clients must apply changes
+# idempotently, by m_id.
+#
+# A client without a token calls the endpoint without ?since= first, then
+# loads the messages, then syncs with the token it got.
+#
+# Rows have the same fields as /messages/nearby. With ?lat=&lon= the text is
+# only returned for messages within their unlock radius, otherwise it is
+# always locked.
+
+MAX_CHANGES = 1000  # more changes than this: the client should reload instead
+MAX_XID8 = 2 ** 64 - 1  # sync tokens are xid8 values (unsigned 64 bit)
+
+SYNC_TOKEN_SQL = "SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS token;"
+
+CHANGED_MESSAGES_SQL = """
+    WITH me AS (
+        SELECT ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)::geography AS geog
+    )
+    SELECT
+        m.m_id,
+        m.m_type,
+        m.unl_rad,
+        m.view_once,
+        l.location_id,
+        l.l_name AS location_name,
+        ST_Y(l.geom) AS latitude,
+        ST_X(l.geom) AS longitude,
+        d.distance_meters,
+        COALESCE(d.distance_meters <= m.unl_rad, false) AS can_open,
+        CASE
+            WHEN d.distance_meters <= m.unl_rad THEN m.m_txt
+            ELSE %(locked_text)s
+        END AS m_txt
+    FROM messages m
+    CROSS JOIN me
+    LEFT JOIN locations l
+        ON l.location_id = m.location_id
+    CROSS JOIN LATERAL (
+        SELECT ST_Distance(l.geog, me.geog) AS distance_meters
+    ) d
+    WHERE m.uni_id = %(uni_id)s
+      AND m.change_xid >= %(since)s::xid8
+    ORDER BY m.m_id
+    LIMIT %(limit)s + 1;
+"""
+
+DELETED_MESSAGES_SQL = """
+    SELECT m_id
+    FROM message_tombstones
+    WHERE uni_id = %(uni_id)s
+      AND change_xid >= %(since)s::xid8
+    ORDER BY m_id
+    LIMIT %(limit)s + 1;
+"""
+
+
+def parse_changes_args(args):
+    """
+    Validates the query string of a /messages/changes request.
+
+    :param args: The request.args of the request.
+    :return: (params, error) where params is a dict for fetch_message_changes().
+    """
+    try:
+        uni_id = int(args.get("uni_id", ""))
+    except ValueError:
+        return None, "uni_id query parameter required"
+
+    since = args.get("since")
+    # ASCII digits only (str.isdigit() also accepts other scripts) and within xid8,
+    # otherwise the ::xid8 cast fails in Postgres
+    if since is not None and (not re.fullmatch(r"[0-9]+", since) or int(since) > MAX_XID8):
+        return None, "Invalid since token"
+
+    lat, lon = args.get("lat"), args.get("lon")
+    try:
+        lat = float(lat) if lat else None
+        lon = float(lon) if lon else None
+    except ValueError:
+        return None, "lat and lon must be numbers"
+
+    if any(value is not None and not math.isfinite(value) for value in (lat, lon)):
+        return None, "lat and lon must be finite numbers"
+
+    return {"uni_id": uni_id, "since": since, "lat": lat, "lon": lon}, None
+
+
+def fetch_message_changes(cur, uni_id, since, lat=None, lon=None, limit=MAX_CHANGES):
+    """
+    Returns {"changed": [...], "deleted": [m_id, ...], "next_token": "..."}, or
+    {"full_resync": true, "next_token": "..."} when there are too many changes.
+    Without `since` only the token is returned.
+    """
+    # The token must come from a snapshot taken before the reads
+    cur.execute(SYNC_TOKEN_SQL)
+    token = cur.fetchone()["token"]
+
+    if since is None:
+        return {"changed": [], "deleted": [], "next_token": token}
+
+    params = {
+        "uni_id": uni_id,
+        "since": since,
+        "lat": lat,
+        "lon": lon,
+        "limit": limit,
+        "locked_text": LOCKED_MESSAGE_TEXT,
+    }
+
+    cur.execute(CHANGED_MESSAGES_SQL, params)
+    changed = cur.fetchall()
+
+    cur.execute(DELETED_MESSAGES_SQL, params)
+    deleted = [row["m_id"] for row in cur.fetchall()]
+
+    if len(changed) > limit or len(deleted) > limit:
+        return {"full_resync": True, "next_token": token}
+
+    return {"changed": changed, "deleted": deleted, "next_token": token}
@@ -0,0 +1,89 @@
+# -------------------------------------------------------------------
+# OPENING MESSAGES (single and batch)
+#
+# One statement resolves, for every requested m_id: does the message exist,
+# is the user a member of its universe, and for view-once messages whether
+# this is the first view. First views are recorded in `seen` with
+# INSERT ... ON CONFLICT DO NOTHING on UNIQUE(m_id, us_id)
+# (DB/migrations/006_seen_unique.sql): of two parallel taps on the same
+# view-once message only one inserts the row, the other gets "already viewed".
+#
+# Status per message: "opened", "already viewed", "not allowed", "not found".
+# The text is only returned for "opened".
+
+MAX_OPEN_BATCH = 100
+MAX_M_ID = 2 ** 31 - 1  # messages.m_id is an integer (int4), bigger ids can't exist
+
+OPEN_MESSAGES_SQL = """
+    WITH requested AS (
+        SELECT DISTINCT unnest(%(m_ids)s::integer[]) AS m_id
+    ), allowed AS (
+        SELECT m.m_id, m.m_txt, m.view_once
+        FROM requested r
+        JOIN messages m ON m.m_id = r.m_id
+        JOIN user_univ uu ON uu.uni_id = m.uni_id AND uu.us_id = %(us_id)s
+    ), first_view AS (
+        INSERT INTO seen (m_id, us_id)
+        SELECT m_id, %(us_id)s::integer
+        FROM allowed
+        WHERE view_once
+        ON CONFLICT (m_id, us_id) DO NOTHING
+        RETURNING m_id
+    )
+    SELECT
+        r.m_id,
+        CASE
+            WHEN m.m_id IS NULL THEN 'not found'
+            WHEN a.m_id IS NULL THEN 'not allowed'
+            WHEN a.view_once AND fv.m_id IS NULL THEN 'already viewed'
+            ELSE 'opened'
+        END AS status,
+        CASE
+            WHEN a.m_id IS NOT NULL AND (NOT a.view_once OR fv.m_id IS NOT NULL) THEN a.m_txt
+        END AS message
+    FROM requested r
+    LEFT JOIN messages m ON m.m_id = r.m_id
+    LEFT JOIN allowed a ON a.m_id = r.m_id
+    LEFT JOIN first_view fv ON fv.m_id = r.m_id
+    ORDER BY r.m_id;
+"""
+
+# HTTP status of the single-message route per result status
+OPEN_STATUS_CODES = {
+    "opened": 200,
+    "already viewed": 403,
+    "not allowed": 403,
+    "not found": 404,
+}
+
+
+def parse_open_ids(data):
+    """Reads {"m_ids": [...]} from a request body. Returns (m_ids, error)."""
+    if not isinstance(data, dict):
+        return None, "Body must be a JSON object with m_ids"
+
+    m_ids = data.get("m_ids")
+
+    if not isinstance(m_ids, list) or not m_ids:
+        return None, "m_ids must be a non-empty list"
+
+    if len(m_ids) > MAX_OPEN_BATCH:
+        return None, f"At most {MAX_OPEN_BATCH} m_ids per request"
+
+    if not all(isinstance(m_id, int) and not isinstance(m_id, bool) for m_id in m_ids):
+        return None, "m_ids must be integers"
+
+    # Out of the integer range the ::integer[] cast fails in Postgres
+    if not all(1 <= m_id <= MAX_M_ID for m_id in m_ids):
+        return None, f"m_ids must be between 1 and {MAX_M_ID}"
+
+    return m_ids, None
+
+
+def open_messages(cur, us_id, m_ids):
+    """
+    Opens the messages for the user in one round trip and returns one row per
+    distinct m_id (m_id, status, message). The caller commits.
+    """
+    cur.execute(OPEN_MESSAGES_SQL, {"m_ids": list(m_ids), "us_id": us_id})
+    return cur.fetchall()
@@ -0,0 +1,174 @@
+import base64
+import binascii
+import json
+
+# -------------------------------------------------------------------
+# KEYSET PAGINATION FOR GET /messages
+#
+# Pages are read in m_id order with `WHERE uni_id = ... AND m_id > <last m_id>`
+# on the (uni_id, m_id) index (DB/migrations/007_messages_uni_id_m_id.sql), so
+# every page costs the same no matter how deep the client is in the universe,
+# and a response never holds more than `limit` rows.
+#
+# The next cursor is opaque to clients (base64 of the universe + last m_id) and
+# only valid for the universe it was issued for.
+#
+# ?fields=m_id,m_txt,... limits the returned columns; m_id is always included
+# because the cursor is built from it.
+#
+# Without ?cursor=, ?limit= and ?format= the response keeps the shape clients had
+# before pagination: a bare array of every message of the universe (limit None).
+# It is streamed (stream_messages_array), read in keyset chunks of
+# STREAM_CHUNK_SIZE with a pooled connection per chunk, so the process never holds
+# more than one chunk whatever the size of the universe, and it is not cached.
+#
+# ?format=rows returns {"columns": [...], "rows": [[...], ...], "next_cursor": ...}
+# instead of one object per message: rows come from a tuple cursor and go to the
+# encoder as they are, so no dictionary is built per row (and the body is smaller).
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+FORMATS = ("objects", "rows")
+STREAM_CHUNK_SIZE = 1000
+PAGE_ARGS = ("cursor", "limit", "format")  # any of them asks for the paginated response
+
+MESSAGE_FIELDS = (
+    "m_id", "m_type", "unl_rad", "crt_time", "view_once", "m_txt",
+    "creator", "uni_id", "poll", "location_id",
+)
+
+# {columns} only ever comes from MESSAGE_FIELDS; one extra row tells whether there is a next page
+MESSAGES_PAGE_SQL = """
+    SELECT {columns}
+    FROM messages
+    WHERE uni_id = %(uni_id)s
+      AND m_id > %(after)s
+    ORDER BY m_id
+    LIMIT %(limit)s + 1;
+"""
+
+
+def encode_cursor(uni_id, m_id):
+    raw = json.dumps({"u": uni_id, "m": m_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, uni_id):
+    """Returns the last m_id of the previous page, or None if the cursor is invalid."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        # type() and not isinstance(): JSON true/false decode to bool, a subclass of int
+        if data["u"] != uni_id or type(data["m"]) is not int:
+            return None
+        return data["m"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        return None
+
+
+def parse_page_args(args, uni_id):
+    """
+    Validates ?cursor=, ?limit=, ?fields= and ?format= of a GET /messages request.
+
+    :param args: The request.args of the request.
+    :param uni_id: The universe the page is read from (cursors are bound to it).
+    :return: (params, error) where params is a dict for fetch_messages_page(); its
+        limit is None when no pagination argument was given (legacy bare array).
+    """
+    limit = None
+    if any(args.get(name) for name in PAGE_ARGS):
+        try:
+            limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+        except ValueError:
+            return None, "limit must be an integer"
+
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return None, f"limit must be between 1 and {MAX_PAGE_SIZE}"
+
+    after = 0
+    cursor = args.get("cursor")
+    if cursor:
+        after = decode_cursor(cursor, uni_id)
+        if after is None:
+            return None, "Invalid cursor"
+
+    output = args.get("format", "objects")
+    if output not in FORMATS:
+        return None, f"format must be one of {', '.join(FORMATS)}"
+
+    fields = list(MESSAGE_FIELDS)
+    if args.get("fields"):
+        requested = [f.strip() for f in args.get("fields").split(",") if f.strip()]
+        unknown = [f for f in requested if f not in MESSAGE_FIELDS]
+        if unknown:
+            return None, f"Unknown fields: {', '.join(unknown)}"
+        fields = ["m_id"] + [f for f in dict.fromkeys(requested) if f != "m_id"]
+
+    return {"uni_id": uni_id, "after": after, "limit": limit, "fields": fields, "rows": output == "rows"}, None
+
+
+def messages_page_sql(fields):
+    return MESSAGES_PAGE_SQL.format(columns=", ".join(fields))
+
+
+def build_page(rows, uni_id, limit, columns=None):
+    """
+    Turns the (up to limit + 1) fetched rows into the response body.
+    With `columns` the rows are tuples (m_id first) and the body is in the ?format=rows shape.
+    """
+    rows = list(rows)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0] if columns else rows[-1]["m_id"]
+        next_cursor = encode_cursor(uni_id, last)
+    if columns:
+        return {"columns": columns, "rows": rows, "next_cursor": next_cursor}
+    return {"messages": rows, "next_cursor": next_cursor}
+
+
+def fetch_messages_page(cur, uni_id, after, limit, fields, rows=False):
+    """With rows=True, `cur` must return tuples (metrics.TimingTupleCursor)."""
+    cur.execute(messages_page_sql(fields), {"uni_id": uni_id, "after": after, "limit": limit})
+    return build_page(cur.fetchall(), uni_id, limit, columns=fields if rows else None)
+
+
+def _chunk_json(rows, dumps_bytes, first):
+    """The rows as the inside of a JSON array (dumps_bytes(rows) without its brackets)."""
+    return (b"" if first else b",") + dumps_bytes(rows)[1:-1]
+
+
+def stream_messages_array(fetch_chunk, dumps_bytes, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Generator of the unpaginated GET /messages body (a bare JSON array), as bytes.
+
+    :param fetch_chunk: fetch_chunk(after, limit) runs messages_page_sql() on its own
+        pooled connection and returns up to limit + 1 rows (dictionaries).
+    :param dumps_bytes: The JSON encoder of the app (app.json.dumps_bytes).
+    """
+    yield b"["
+    after, first = 0, True
+    while True:
+        rows = fetch_chunk(after, chunk_size)
+        if rows[:chunk_size]:
+            yield _chunk_json(rows[:chunk_size], dumps_bytes, first)
+            first = False
+        if len(rows) <= chunk_size:
+            break
+        after = rows[chunk_size - 1]["m_id"]
+    yield b"]"
+
+
+async def astream_messages_array(fetch_chunk, dumps_bytes, chunk_size=STREAM_CHUNK_SIZE):
+    """stream_messages_array() for app_async.py, fetch_chunk is a coroutine function."""
+    yield b"["
+    after, first = 0, True
+    while True:
+        rows = await fetch_chunk(after, chunk_size)
+        if rows[:chunk_size]:
+            yield _chunk_json(rows[:chunk_size], dumps_bytes, first)
+            first = False
+        if len(rows) <= chunk_size:
+            break
+        after = rows[chunk_size - 1]["m_id"]
+    yield b"]"
@@ -0,0 +1,269 @@
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request
+from psycopg2.extensions import cursor as TupleCursor
+from psycopg2.extras import RealDictCursor
+
+from slow_queries import slow_query_log
+
+# -------------------------------------------------------------------
+# PROMETHEUS METRICS
+#
+# A few counters, gauges and histograms kept in memory and rendered in the
+# Prometheus text format by the /metrics route of app.py:
+#
+#   coordinote_http_request_duration_seconds{route,method,status}
+#   coordinote_http_requests_in_flight
+#   coordinote_http_response_size_bytes{route}
+#   coordinote_db_query_duration_seconds{route}   (TimingCursor, see below)
+#   coordinote_db_pool_wait_seconds{database}     (db.py)
+#   coordinote_db_pool_in_use{database}, ..._timeouts_total, ... (db.py, at scrape time)
+#
+# Recording a value is a lock, a bisect over the buckets and two additions, so the
+# hot path stays cheap. `route` is the url rule (/messages/<int:m_id>/open), never the
+# raw path, so the number of series stays bounded.
+#
+# Values are per process: with several gunicorn workers every worker has its own
+# metrics and a scrape only sees the worker that answered it.
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # bytes
+
+BACKGROUND_ROUTE = "background"  # queries run outside of a request (listener, reaper, ...)
+UNMATCHED_ROUTE = "unmatched"  # requests that didn't match any route (404, 405)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = self.header()
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)  # first bucket with value <= le, len(buckets) = +Inf
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = self.header()
+        names = self.labelnames + ("le",)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (_format_value(bound),))} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics of this process. Collectors are functions called at scrape time that
+    return more lines, for values that already exist elsewhere (pool sizes, ...).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        with self._lock:
+            metrics, collectors = list(self._metrics), list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "coordinote_http_request_duration_seconds",
+    "Time until the response is handed to the server (first byte for streamed responses).",
+    ("route", "method", "status"),
+))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "coordinote_http_requests_in_flight",
+    "Requests currently being handled.",
+))
+RESPONSE_SIZE = REGISTRY.register(Histogram(
+    "coordinote_http_response_size_bytes",
+    "Size of the response bodies (streamed responses are not counted).",
+    ("route",),
+    buckets=SIZE_BUCKETS,
+))
+DB_QUERY_DURATION = REGISTRY.register(Histogram(
+    "coordinote_db_query_duration_seconds",
+    "Time spent in cursor.execute()/executemany(), by the route that ran the query.",
+    ("route",),
+))
+POOL_WAIT = REGISTRY.register(Histogram(
+    "coordinote_db_pool_wait_seconds",
+    "Time spent waiting for a connection from the pool.",
+    ("database",),
+))
+
+
+# Route of the request handled by the current thread, used to label the queries
+_local = threading.local()
+
+
+def current_route():
+    return getattr(_local, "route", None) or BACKGROUND_ROUTE
+
+
+class QueryTimingMixin:
+    """
+    Records how long every query of a cursor takes, and hands the ones over the
+    threshold to the slow-query log (see slow_queries.py).
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(query, vars)
+            failed = False
+            return result
+        finally:
+            duration = time.perf_counter() - start
+            route = current_route()
+            DB_QUERY_DURATION.observe(duration, route)
+            if slow_query_log.enabled and duration >= slow_query_log.threshold:
+                slow_query_log.record(self, query, vars, duration, route, explain=not failed)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            duration = time.perf_counter() - start
+            route = current_route()
+            DB_QUERY_DURATION.observe(duration, route)
+            if slow_query_log.enabled and duration >= slow_query_log.threshold:
+                slow_query_log.record(self, query, None, duration, route, explain=False)
+
+
+class TimingCursor(QueryTimingMixin, RealDictCursor):
+    """The default cursor of the pools (see get_pool in db.py): rows as dictionaries."""
+
+
+class TimingTupleCursor(QueryTimingMixin, TupleCursor):
+    """
+    Rows as plain tuples, for big list responses where building a dictionary per
+    row is measurable: conn.cursor(cursor_factory=TimingTupleCursor)
+    """
+
+
+def instrument_app(app):
+    """Records the request metrics of a Flask app with before/after/teardown request hooks."""
+
+    @app.before_request
+    def start_request_timer():
+        _local.route = request.url_rule.rule if request.url_rule is not None else UNMATCHED_ROUTE
+        g.metrics_started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.get("metrics_started")
+        if started is not None:
+            route = current_route()
+            REQUEST_DURATION.observe(time.perf_counter() - started, route, request.method, response.status_code)
+            if response.content_length is not None:
+                RESPONSE_SIZE.observe(response.content_length, route)
+        return response
+
+    # _local.route is left set on purpose: streamed bodies (/locations?stream=1) run their
+    # queries after the teardown, on the same thread, and the next request overwrites it
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        if g.pop("metrics_started", None) is not None:
+            REQUESTS_IN_FLIGHT.dec()
@@ -0,0 +1,323 @@
+import math
+import threading
+
+from cache import TTLCache
+
+# -------------------------------------------------------------------
+# NEARBY MESSAGES QUERY ENGINE
+#
+# Shared by app.py, api_check_my_location.py and api_endpint_for_etl.py.
+# Needs DB/migrations/001_locations_geography.sql (locations.geog + GiST index).
+#
+# How the query works:
+#   1. The user's position is turned into a geography once (the "me" CTE).
+#   2. Candidate locations are selected with ST_DWithin on the indexed
+#      locations.geog column, so only the locations inside the search radius
+#      are read instead of every message in the universe.
+#   3. Messages are joined on location_id (+ uni_id, indexed).
+#   4. The distance is computed once per candidate (LATERAL) and reused for
+#      the unlock test, the hidden text and the ORDER BY.
+
+DEFAULT_SEARCH_RADIUS = 1000  # meters, radar radius for map visibility
+MAX_SEARCH_RADIUS = 5000
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+LOCKED_MESSAGE_TEXT = "This message is locked. Get closer to read it!"
+
+NEARBY_MESSAGES_SQL = """
+    WITH me AS (
+        SELECT ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)::geography AS geog
+    )
+    SELECT
+        m.m_id,
+        m.m_type,
+        m.unl_rad,
+        m.view_once,
+        l.location_id,
+        l.l_name AS location_name,
+        ST_Y(l.geom) AS latitude,
+        ST_X(l.geom) AS longitude,
+        d.distance_meters,
+        d.distance_meters <= m.unl_rad AS can_open,
+        -- SECURITY SHIELD: Hide actual content if the user is outside the unlock radius
+        CASE
+            WHEN d.distance_meters <= m.unl_rad THEN m.m_txt
+            ELSE %(locked_text)s
+        END AS m_txt
+    FROM me
+    JOIN locations l
+        ON ST_DWithin(l.geog, me.geog, %(radius)s)
+    JOIN messages m
+        ON m.location_id = l.location_id
+        AND m.uni_id = %(uni_id)s
+    CROSS JOIN LATERAL (
+        SELECT ST_Distance(l.geog, me.geog) AS distance_meters
+    ) d
+    ORDER BY d.distance_meters, m.m_id
+    LIMIT %(limit)s;
+"""
+
+
+def parse_nearby_args(args):
+    """
+    Validates the query string of a /messages/nearby request.
+
+    :param args: The request.args of the Flask request.
+    :return: (params, error) where params is a dict for fetch_nearby_messages().
+    """
+    lat = args.get("lat")
+    lon = args.get("lon")
+    uni_id = args.get("uni_id")
+
+    if not lat or not lon or not uni_id:
+        return None, "lat, lon and uni_id are required parameters"
+
+    try:
+        params = {
+            "lat": float(lat),
+            "lon": float(lon),
+            "uni_id": int(uni_id),
+            "radius": float(args.get("radius", DEFAULT_SEARCH_RADIUS)),
+            "limit": int(args.get("limit", DEFAULT_LIMIT)),
+        }
+    except ValueError:
+        return None, "lat, lon, radius, uni_id and limit must be numbers"
+
+    # float() accepts "nan" and "inf", which pass the clamps below and break the cache keys
+    if not all(math.isfinite(params[name]) for name in ("lat", "lon", "radius")):
+        return None, "lat, lon and radius must be finite numbers"
+
+    if not -90 <= params["lat"] <= 90 or not -180 <= params["lon"] <= 180:
+        return None, "lat/lon out of range"
+
+    params["radius"] = min(max(params["radius"], 0), MAX_SEARCH_RADIUS)
+    params["limit"] = min(max(params["limit"], 1), MAX_LIMIT)
+    return params, None
+
+
+def fetch_nearby_messages(cur, lat, lon, uni_id, radius=DEFAULT_SEARCH_RADIUS, limit=DEFAULT_LIMIT):
+    """
+    Runs the nearby query and returns the rows ordered by distance (closest first).
+
+    :param cur: An open cursor (RealDictCursor).
+    :return: List of message rows with distance_meters and can_open.
+    """
+    cur.execute(NEARBY_MESSAGES_SQL, {
+        "lat": lat,
+        "lon": lon,
+        "uni_id": uni_id,
+        "radius": radius,
+        "limit": limit,
+        "locked_text": LOCKED_MESSAGE_TEXT,
+    })
+    return cur.fetchall()
+
+
+# -------------------------------------------------------------------
+# SPATIAL TILE CACHE
+#
+# Mobile clients send almost the same lat/lon on every refresh while walking.
+# Instead of going to PostGIS each time, the candidate messages around a small
+# grid cell are fetched once (search radius + the cell's half diagonal, so they
+# cover any position inside the cell) and cached per (uni_id, cell, radius bucket).
+# The exact distance / unl_rad unlock test then runs in Python against the
+# caller's real position.
+#
+# Distances are computed with the haversine formula (sphere), PostGIS uses the
+# spheroid; the difference is well under 1% (a few centimeters at unlock radii),
+# and candidates are fetched with a margin so no message within radius is missed.
+
+CELL_SIZE_DEG = 0.001  # ~111 m north/south, ~87 m east/west in Lisbon
+RADIUS_BUCKET = 250  # meters, requested radii are rounded up to a multiple of this
+CANDIDATE_MARGIN = 1.01  # covers the sphere vs. spheroid difference
+MAX_CANDIDATES = 5000  # denser cells are only remembered as dense, the query engine is used instead
+
+EARTH_RADIUS = 6371008.8  # meters, mean earth radius
+
+NEARBY_CANDIDATES_SQL = """
+    SELECT
+        m.m_id,
+        m.m_type,
+        m.unl_rad,
+        m.view_once,
+        m.m_txt,
+        l.location_id,
+        l.l_name AS location_name,
+        ST_Y(l.geom) AS latitude,
+        ST_X(l.geom) AS longitude
+    FROM locations l
+    JOIN messages m
+        ON m.location_id = l.location_id
+        AND m.uni_id = %(uni_id)s
+    WHERE ST_DWithin(
+        l.geog,
+        ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)::geography,
+        %(radius)s
+    )
+    LIMIT %(limit)s;
+"""
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between two lat/lon points."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def _estimate_size(entry):
+    """Rough memory footprint of a cached cell in bytes (used for the memory cap)."""
+    size = 500
+    for row in entry["candidates"]:
+        size += 400 + len(row["m_txt"] or "") + len(row["location_name"] or "")
+    return size
+
+
+class NearbyTileCache:
+    """
+    Caches nearby-message candidates per (uni_id, grid cell, radius bucket).
+    Entries are evicted least recently used, by count and by estimated memory.
+
+    Every invalidation bumps a generation counter of the universe. load() reads it
+    before its query and doesn't store the result if it changed in the meantime,
+    so a message committed during a load can't be hidden by the older row set.
+
+    Cells with more than MAX_CANDIDATES candidates are cached as "dense" (no rows):
+    until the entry expires, load() goes straight to the query engine instead of
+    fetching the candidates again only to throw them away.
+
+    Invalidations only reach the cache of this process; call them from the NOTIFY
+    events of events.py (see on_database_event in app.py) so every worker drops the cell.
+    """
+
+    def __init__(self, maxsize=5000, ttl=60, max_bytes=64 * 1024 * 1024):
+        self.cells = TTLCache(maxsize=maxsize, ttl=ttl, max_bytes=max_bytes, sizeof=_estimate_size)
+        self._generations = {}  # uni_id -> number of invalidations so far
+        self._epoch = 0  # number of invalidate_all() calls, part of every universe's generation
+        self._lock = threading.Lock()
+        self.stale_loads = 0
+        self.dense_hits = 0
+
+    def lookup(self, lat, lon, uni_id, radius=DEFAULT_SEARCH_RADIUS, limit=DEFAULT_LIMIT):
+        """
+        Same result as fetch_nearby_messages(), or None on a cache miss
+        (then call load() with a cursor).
+        """
+        entry = self.cells.get(self._key(lat, lon, uni_id, radius))
+        if entry is None or entry["dense"]:
+            return None
+        return _filter_candidates(entry["candidates"], lat, lon, radius, limit)
+
+    def load(self, cur, lat, lon, uni_id, radius=DEFAULT_SEARCH_RADIUS, limit=DEFAULT_LIMIT):
+        """Fetches and caches the candidates of the caller's cell, then answers like lookup()."""
+        key = self._key(lat, lon, uni_id, radius)
+        _, cell_row, cell_col, bucket = key
+
+        entry = self.cells.get(key)
+        if entry is not None and entry["dense"]:
+            self.dense_hits += 1
+            return fetch_nearby_messages(cur, lat, lon, uni_id, radius, limit)
+
+        center_lat = (cell_row + 0.5) * CELL_SIZE_DEG
+        center_lon = (cell_col + 0.5) * CELL_SIZE_DEG
+        half_diagonal = haversine(center_lat, center_lon, cell_row * CELL_SIZE_DEG, cell_col * CELL_SIZE_DEG)
+        fetch_radius = (bucket + half_diagonal) * CANDIDATE_MARGIN
+
+        with self._lock:
+            generation = (self._epoch, self._generations.get(uni_id, 0))
+
+        cur.execute(NEARBY_CANDIDATES_SQL, {
+            "lat": center_lat,
+            "lon": center_lon,
+            "uni_id": uni_id,
+            "radius": fetch_radius,
+            "limit": MAX_CANDIDATES + 1,
+        })
+        candidates = cur.fetchall()
+
+        dense = len(candidates) > MAX_CANDIDATES
+        with self._lock:
+            if (self._epoch, self._generations.get(uni_id, 0)) == generation:
+                self.cells.set(key, {
+                    "center": (center_lat, center_lon),
+                    "fetch_radius": fetch_radius,
+                    "dense": dense,
+                    "candidates": [] if dense else candidates,
+                })
+            else:
+                # Invalidated while the query ran: answer this request, but don't cache it
+                self.stale_loads += 1
+
+        if dense:
+            return fetch_nearby_messages(cur, lat, lon, uni_id, radius, limit)
+        return _filter_candidates(candidates, lat, lon, radius, limit)
+
+    @staticmethod
+    def _key(lat, lon, uni_id, radius):
+        cell_row = math.floor(lat / CELL_SIZE_DEG)
+        cell_col = math.floor(lon / CELL_SIZE_DEG)
+        bucket = max(1, math.ceil(radius / RADIUS_BUCKET)) * RADIUS_BUCKET
+        return (uni_id, cell_row, cell_col, bucket)
+
+    def invalidate_point(self, uni_id, lat, lon):
+        """
+        Drops every cached cell of the universe whose candidate area contains
+        the point, call this after a message is created at (lat, lon).
+        """
+        def covers(key, entry):
+            if key[0] != uni_id:
+                return False
+            center_lat, center_lon = entry["center"]
+            return haversine(center_lat, center_lon, lat, lon) <= entry["fetch_radius"]
+
+        with self._lock:
+            self._generations[uni_id] = self._generations.get(uni_id, 0) + 1
+            return self.cells.invalidate_where(covers)
+
+    def invalidate_universe(self, uni_id):
+        with self._lock:
+            self._generations[uni_id] = self._generations.get(uni_id, 0) + 1
+            return self.cells.invalidate_where(lambda key, entry: key[0] == uni_id)
+
+    def invalidate_all(self):
+        """Drops every cell, when invalidations may have been missed (listener reconnect, bulk insert)."""
+        with self._lock:
+            self._epoch += 1
+            return self.cells.invalidate_where(lambda key, entry: True)
+
+    def stats(self):
+        stats = self.cells.stats()
+        with self._lock:
+            stats["stale_loads"] = self.stale_loads
+            stats["dense_hits"] = self.dense_hits
+        return stats
+
+
+def _filter_candidates(candidates, lat, lon, radius, limit):
+    """Applies the exact radius and unlock test to cached candidates, closest first."""
+    results = []
+    for candidate in candidates:
+        distance = haversine(lat, lon, candidate["latitude"], candidate["longitude"])
+        if distance > radius:
+            continue
+
+        can_open = distance <= candidate["unl_rad"]
+        results.append({
+            "m_id": candidate["m_id"],
+            "m_type": candidate["m_type"],
+            "unl_rad": candidate["unl_rad"],
+            "view_once": candidate["view_once"],
+            "location_id": candidate["location_id"],
+            "location_name": candidate["location_name"],
+            "latitude": candidate["latitude"],
+            "longitude": candidate["longitude"],
+            "distance_meters": distance,
+            "can_open": can_open,
+            "m_txt": candidate["m_txt"] if can_open else LOCKED_MESSAGE_TEXT,
+        })
+
+    results.sort(key=lambda message: (message["distance_meters"], message["m_id"]))
+    return results[:limit]
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from passlib.context import CryptContext
+
+# -------------------------------------------------------------------
+# PASSWORD HASHING OFF THE REQUEST THREAD
+#
+# bcrypt costs hundreds of milliseconds of CPU per hash/verify. Done inline it
+# holds the GIL of the web worker, so a burst of logins slows every other route
+# of that worker down. Here it runs in a separate, bounded pool of processes:
+#
+#   - BCRYPT_ROUNDS is the cost factor of new hashes (env COORDINOTE_BCRYPT_ROUNDS)
+#   - at most MAX_PENDING hash/verify jobs are queued or running per web process;
+#     above that HashingBusy is raised right away (the apps answer 503) instead
+#     of letting requests pile up behind the pool
+#   - verify_and_update() also returns a new hash when the stored one was made
+#     with another cost factor, so hashes are upgraded on the next login
+
+BCRYPT_ROUNDS = int(os.environ.get("COORDINOTE_BCRYPT_ROUNDS", 12))
+HASH_WORKERS = int(os.environ.get("COORDINOTE_HASH_WORKERS", os.cpu_count() or 2))
+MAX_PENDING = int(os.environ.get("COORDINOTE_HASH_MAX_PENDING", HASH_WORKERS * 4))
+
+
+class HashingBusy(Exception):
+    """Too many password hashes are already queued, the client should retry later."""
+
+
+# --- run inside the worker processes ----------------------------------
+
+_contexts = {}
+
+
+def _context(rounds):
+    context = _contexts.get(rounds)
+    if context is None:
+        context = _contexts[rounds] = CryptContext(schemes=["bcrypt"], bcrypt__rounds=rounds)
+    return context
+
+
+def _hash(password, rounds):
+    return _context(rounds).hash(password)
+
+
+def _verify_and_update(password, stored_hash, rounds):
+    # (ok, new_hash) - new_hash is None unless the password is right and the hash is outdated
+    return _context(rounds).verify_and_update(password, stored_hash)
+
+
+# --- used by the web processes -----------------------------------------
+
+class PasswordHasher:
+
+    def __init__(self, rounds=BCRYPT_ROUNDS, workers=HASH_WORKERS, max_pending=MAX_PENDING):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None  # started on first use, not at import time
+
+        # stats
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _reset_executor(self, broken):
+        # A worker process died (killed, out of memory, ...): start a new pool
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+        self._slots.release()
+
+    def _done(self, future, executor):
+        self._release()
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._reset_executor(executor)
+
+    def _submit(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise HashingBusy("password hashing queue is full")
+
+        with self._lock:
+            self._in_flight += 1
+
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(func, *args)
+            except BrokenProcessPool:
+                self._reset_executor(executor)
+                executor = self._get_executor()
+                future = executor.submit(func, *args)
+        except Exception:
+            self._release()
+            raise
+
+        future.add_done_callback(lambda f: self._done(f, executor))
+        return future
+
+    # Blocking versions (Flask): the request thread waits, but the CPU work runs elsewhere
+
+    def hash(self, password):
+        return self._submit(_hash, password, self.rounds).result()
+
+    def verify_and_update(self, password, stored_hash):
+        return self._submit(_verify_and_update, password, stored_hash, self.rounds).result()
+
+    # Awaitable versions (Quart)
+
+    async def hash_async(self, password):
+        return await asyncio.wrap_future(self._submit(_hash, password, self.rounds))
+
+    async def verify_and_update_async(self, password, stored_hash):
+        return await asyncio.wrap_future(self._submit(_verify_and_update, password, stored_hash, self.rounds))
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rounds": self.rounds,
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "in_flight": self._in_flight,
+                "completed": self._completed,
+                "rejected": self._rejected,
+            }
@@ -0,0 +1,101 @@
+import argparse
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+# -------------------------------------------------------------------
+# POLL VOTE COUNTERS
+#
+# poll_option_counts (DB/migrations/004_poll_option_counts.sql) keeps the number
+# of votes per option. The vote statement of the poll module increments it, so
+# results are read from one row per option instead of counting poll_votes.
+#
+# reconcile_poll_counts() recomputes the counters from poll_votes; run this file
+# as a script to do it from the command line:
+#     python poll_counts.py             # every poll
+#     python poll_counts.py --m-id 42   # one poll
+
+DB_CONFIG = {
+    "database": "coordinote_db",
+    "user": "postgres",
+    "password": "postgres",
+    "host": "localhost",
+    "port": "5432"
+}
+
+# Options without a counter row yet (no vote so far) count as 0
+POLL_RESULTS_SQL = """
+    SELECT
+        po.option_id,
+        po.option_text,
+        COALESCE(pc.vote_count, 0) AS vote_count
+    FROM poll_options po
+    LEFT JOIN poll_option_counts pc
+        ON pc.option_id = po.option_id
+    WHERE po.m_id = %s
+    ORDER BY po.option_id;
+"""
+
+# Only counters that are actually wrong are rewritten
+RECONCILE_SQL = """
+    INSERT INTO poll_option_counts (option_id, m_id, vote_count)
+    SELECT po.option_id, po.m_id, COUNT(pv.vote_id)
+    FROM poll_options po
+    LEFT JOIN poll_votes pv ON pv.option_id = po.option_id
+    WHERE %(m_id)s::integer IS NULL OR po.m_id = %(m_id)s::integer
+    GROUP BY po.option_id, po.m_id
+    ON CONFLICT (option_id) DO UPDATE
+        SET vote_count = EXCLUDED.vote_count
+        WHERE poll_option_counts.vote_count <> EXCLUDED.vote_count
+    RETURNING option_id, m_id, vote_count;
+"""
+
+
+def fetch_poll_results(cur, m_id):
+    """Vote count per option of a poll, ordered by option_id."""
+    cur.execute(POLL_RESULTS_SQL, (m_id,))
+    return cur.fetchall()
+
+
+def reconcile_poll_counts(conn, m_id=None):
+    """
+    Recomputes the counters of one poll (or of every poll if m_id is None) from
+    poll_votes and returns the rows that were corrected.
+
+    poll_votes is locked against writes (SHARE mode) for the duration, so a vote
+    can't be counted between the COUNT and the counter update and then get lost.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("LOCK TABLE poll_votes IN SHARE MODE;")
+        cur.execute(RECONCILE_SQL, {"m_id": m_id})
+        fixed = cur.fetchall()
+        conn.commit()
+        return fixed
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        cur.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute poll_option_counts from poll_votes.")
+    parser.add_argument("--m-id", type=int, help="only this poll (default: every poll)")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(cursor_factory=RealDictCursor, **DB_CONFIG)
+    try:
+        fixed = reconcile_poll_counts(conn, args.m_id)
+    finally:
+        conn.close()
+
+    for row in fixed:
+        print(f"poll {row['m_id']}, option {row['option_id']}: vote_count set to {row['vote_count']}")
+    print(f"{len(fixed)} counter(s) corrected")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import logging
+import os
+import threading
+from datetime import datetime
+
+# -------------------------------------------------------------------
+# SESSION HOUSEKEEPING
+#
+# Every login adds a sessions row (72 h expiry). Without cleanup the table and
+# its token index grow forever. Indexes: DB/migrations/009_sessions_housekeeping.sql
+#
+#   - SessionReaper: background thread deleting expired sessions in batches of
+#     REAP_BATCH_SIZE, each in its own short transaction. Rows are picked with
+#     FOR UPDATE SKIP LOCKED, so reapers of several worker processes never wait
+#     on each other (or on a row that is being used).
+#   - enforce_session_cap(): on login only the newest MAX_SESSIONS_PER_USER
+#     sessions of the user are kept; the caller drops the returned tokens from
+#     its session cache.
+#   - notify_sessions_revoked(): logout and the session cap broadcast a
+#     "sessions_revoked" event on the events channel (events.EVENTS_CHANNEL), sent
+#     in the caller's transaction, so every worker and app_async.py drop the
+#     user's cached sessions once the delete is committed.
+#
+# Expiry times are stored as naive UTC (datetime.utcnow()), like in app.py.
+
+REAP_INTERVAL = int(os.environ.get("COORDINOTE_SESSION_REAP_INTERVAL", 300))  # seconds
+REAP_BATCH_SIZE = 1000
+MAX_SESSIONS_PER_USER = int(os.environ.get("COORDINOTE_MAX_SESSIONS_PER_USER", 10))
+
+logger = logging.getLogger(__name__)
+
+REAP_EXPIRED_SQL = """
+    WITH expired AS (
+        SELECT session_id
+        FROM sessions
+        WHERE expires_at < %(now)s
+        ORDER BY expires_at
+        LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    )
+    DELETE FROM sessions s
+    USING expired e
+    WHERE s.session_id = e.session_id;
+"""
+
+# Newest sessions first; everything after the first `keep` goes
+SESSION_CAP_SQL = """
+    WITH surplus AS (
+        SELECT session_id
+        FROM sessions
+        WHERE us_id = %(us_id)s
+        ORDER BY expires_at DESC, session_id DESC
+        OFFSET %(keep)s
+        FOR UPDATE SKIP LOCKED
+    )
+    DELETE FROM sessions s
+    USING surplus x
+    WHERE s.session_id = x.session_id
+    RETURNING s.token;
+"""
+
+SESSIONS_REVOKED_SQL = """
+    SELECT pg_notify('coordinote_events', json_build_object(
+        'type', 'sessions_revoked',
+        'us_id', %(us_id)s::integer
+    )::text);
+"""
+
+
+def reap_expired_sessions(conn, batch_size=REAP_BATCH_SIZE, now=None, max_batches=None):
+    """Deletes expired sessions batch by batch (one commit each) and returns how many were deleted."""
+    now = now or datetime.utcnow()
+    deleted = 0
+    batches = 0
+    cur = conn.cursor()
+    try:
+        while max_batches is None or batches < max_batches:
+            cur.execute(REAP_EXPIRED_SQL, {"now": now, "batch_size": batch_size})
+            count = cur.rowcount
+            conn.commit()
+            deleted += count
+            batches += 1
+            if count < batch_size:
+                break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return deleted
+
+
+def enforce_session_cap(cur, us_id, keep=MAX_SESSIONS_PER_USER):
+    """
+    Deletes all but the newest `keep` sessions of the user, in the caller's
+    transaction. Returns the deleted tokens so they can be removed from caches.
+    """
+    cur.execute(SESSION_CAP_SQL, {"us_id": us_id, "keep": keep})
+    tokens = [row["token"] for row in cur.fetchall()]
+    if tokens:
+        notify_sessions_revoked(cur, us_id)
+    return tokens
+
+
+def notify_sessions_revoked(cur, us_id):
+    """Tells the other processes to drop the user's cached sessions, once the caller commits."""
+    cur.execute(SESSIONS_REVOKED_SQL, {"us_id": us_id})
+
+
+class SessionReaper:
+
+    def __init__(self, pool, interval=REAP_INTERVAL, batch_size=REAP_BATCH_SIZE):
+        self.pool = pool
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # stats
+        self._runs = 0
+        self._deleted = 0
+        self._last_run = None
+        self._errors = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="session-reaper", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        with self.pool.connection() as conn:
+            deleted = reap_expired_sessions(conn, self.batch_size)
+        self._runs += 1
+        self._deleted += deleted
+        self._last_run = datetime.utcnow()
+        return deleted
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                deleted = self.run_once()
+                if deleted:
+                    logger.info("session reaper deleted %d expired sessions", deleted)
+            except Exception:
+                # The database may be down or the pool busy (PoolTimeout), try again next interval
+                self._errors += 1
+                logger.exception("session reaper failed")
+            self._stop.wait(self.interval)
+
+    def stats(self):
+        return {
+            "running": self._thread is not None and not self._stop.is_set(),
+            "interval_s": self.interval,
+            "runs": self._runs,
+            "deleted": self._deleted,
+            "last_run": self._last_run.isoformat() if self._last_run else None,
+            "errors": self._errors,
+        }
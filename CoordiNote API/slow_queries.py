@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR, cursor as plain_cursor
+
+# -------------------------------------------------------------------
+# SLOW-QUERY LOG
+#
+# Opt-in: set COORDINOTE_SLOW_QUERY_MS to a threshold in milliseconds. Every query
+# run through the shared pool (metrics.TimingCursor) that takes longer is recorded
+# with
+#
+#   - its normalized SQL (literals and parameters replaced by ?, whitespace collapsed)
+#     so the same statement groups together whatever the arguments
+#   - a fingerprint of the parameters, never the values themselves (tokens, passwords)
+#   - the duration, the route that ran it and the row count
+#   - for a sampled fraction (COORDINOTE_SLOW_QUERY_EXPLAIN_RATE, default 0.1) the
+#     plan from EXPLAIN (FORMAT JSON), run right after on the same connection with
+#     the same parameters. Without ANALYZE nothing is executed a second time, and
+#     the EXPLAIN runs in a savepoint so a failure can't break the caller's transaction
+#
+# Entries are kept in a ring buffer (COORDINOTE_SLOW_QUERY_BUFFER entries, see the
+# /admin/slow-queries route of app.py) and appended as JSON lines to
+# COORDINOTE_SLOW_QUERY_LOG (default slow_queries.log).
+
+SLOW_QUERY_MS = float(os.environ.get("COORDINOTE_SLOW_QUERY_MS", 0))  # 0 = disabled
+EXPLAIN_RATE = float(os.environ.get("COORDINOTE_SLOW_QUERY_EXPLAIN_RATE", 0.1))
+BUFFER_SIZE = int(os.environ.get("COORDINOTE_SLOW_QUERY_BUFFER", 200))
+LOG_PATH = os.environ.get("COORDINOTE_SLOW_QUERY_LOG", "slow_queries.log")
+
+# Statements EXPLAIN accepts (and that are worth a plan)
+EXPLAINABLE = ("select", "with", "insert", "update", "delete", "values")
+
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s")
+_NUMBERS = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_SPACES = re.compile(r"\s+")
+
+logger = logging.getLogger(__name__)
+
+
+def query_text(query, connection):
+    """The SQL of `query` as a string (it may be bytes or a psycopg2.sql object)."""
+    if isinstance(query, bytes):
+        return query.decode(errors="replace")
+    if hasattr(query, "as_string"):
+        return query.as_string(connection)
+    return str(query)
+
+
+def normalize_sql(sql):
+    sql = _COMMENTS.sub(" ", sql)
+    sql = _STRINGS.sub("?", sql)
+    sql = _PLACEHOLDERS.sub("?", sql)
+    sql = _NUMBERS.sub("?", sql)
+    return _SPACES.sub(" ", sql).strip()
+
+
+def params_fingerprint(params):
+    """Short hash of the parameters: equal arguments give equal fingerprints, but can't be read back."""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        params = sorted(params.items())
+    return hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+
+
+class SlowQueryLog:
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, explain_rate=EXPLAIN_RATE,
+                 buffer_size=BUFFER_SIZE, log_path=LOG_PATH):
+        self.threshold_ms = threshold_ms
+        self.enabled = threshold_ms > 0
+        self.threshold = threshold_ms / 1000  # seconds, compared to the cursor timings
+        self.explain_rate = explain_rate
+        self._entries = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.explained = 0
+
+        if self.enabled and log_path and not logger.handlers:
+            handler = logging.FileHandler(log_path)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+    def record(self, cursor, query, params, duration, route, explain=True):
+        """Called by the cursor for every statement slower than the threshold."""
+        sql = query_text(query, cursor.connection)
+        entry = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "duration_ms": round(duration * 1000, 3),
+            "route": route,
+            "sql": normalize_sql(sql),
+            "params_fingerprint": params_fingerprint(params),
+            "rows": cursor.rowcount,
+            "plan": None,
+        }
+        if explain and random.random() < self.explain_rate:
+            entry["plan"] = self.explain(cursor.connection, sql, params)
+
+        with self._lock:
+            self._entries.append(entry)
+            self.recorded += 1
+            if entry["plan"] is not None:
+                self.explained += 1
+        logger.info(json.dumps(entry, default=str))
+
+    def explain(self, connection, sql, params):
+        if sql.lstrip().split(None, 1)[0].lower() not in EXPLAINABLE:
+            return None
+        if connection.closed or connection.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+            return None
+
+        # A plain cursor, so this EXPLAIN isn't timed/recorded itself
+        cur = connection.cursor(cursor_factory=plain_cursor)
+        savepoint = not connection.autocommit
+        try:
+            if savepoint:
+                cur.execute("SAVEPOINT slow_query_explain")
+            try:
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cur.fetchone()[0]
+            except psycopg2.Error:
+                plan = None
+                if savepoint:
+                    cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            if savepoint:
+                cur.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        except psycopg2.Error:
+            return None
+        finally:
+            cur.close()
+
+    def entries(self, limit=None):
+        """The recorded slow queries, newest first."""
+        with self._lock:
+            entries = list(self._entries)
+        entries.reverse()
+        return entries[:limit] if limit else entries
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "threshold_ms": self.threshold_ms,
+                "explain_rate": self.explain_rate,
+                "buffered": len(self._entries),
+                "recorded": self.recorded,
+                "explained": self.explained,
+            }
+
+
+# One log per process, used by every pool (see metrics.TimingCursor)
+slow_query_log = SlowQueryLog()
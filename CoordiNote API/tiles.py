@@ -0,0 +1,239 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+# -------------------------------------------------------------------
+# MAPBOX VECTOR TILES (MVT)
+#
+# /tiles/<layer>/<z>/<x>/<y>.pbf serves the map data tile by tile, built by
+# PostGIS with ST_AsMVT / ST_AsMVTGeom, so the map only downloads what is in view.
+#
+# Layers:
+#   - locations: the ETL POIs, optionally ?category=<name>
+#   - messages:  message points of one universe, ?uni_id=<id> (no message text)
+#
+# Tiles are cached on disk in <cache dir>/tiles/<layer>/<scope>/<z>/<x>/<y>.pbf
+# where scope is the category ("all" without filter) or the uni_id. A disk cache
+# is used so the ETL (a separate process) can invalidate it: load_to_postgis
+# removes the directories of the categories it reloads, and creating a message
+# removes the directory of its universe.
+#
+# Safety and bounds of the disk cache:
+#   - ?category= must be a short slug (a-z, 0-9, _), and only the categories of
+#     CACHED_CATEGORIES get cache directories; other slugs are built but not stored,
+#     so arbitrary query strings can't create directory trees. Every path is also
+#     checked to stay inside the cache directory.
+#   - tiles older than TILE_TTL are ignored, and every SWEEP_EVERY writes expired
+#     tiles are deleted and the oldest ones too while the cache is over MAX_BYTES
+#   - invalidate() first writes a new generation token (<layer>/<scope>.generation,
+#     the ETL does the same) and then removes the tiles. put() gets the token read
+#     before the tile was built and drops the tile if it changed, so a tile built
+#     from data older than a message commit can't be written back after it.
+
+CACHE_DIR = os.environ.get(
+    "COORDINOTE_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache")
+)
+TILE_CACHE_DIR = os.path.join(CACHE_DIR, "tiles")
+
+MAX_ZOOM = 22
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+CATEGORY_PATTERN = re.compile(r"^[a-z0-9_]{1,32}$")
+# Categories loaded by the ETL (TARGETS in ETL/etl_full_automatic.py)
+CACHED_CATEGORIES = frozenset(os.environ.get("COORDINOTE_TILE_CATEGORIES", "metro,bus_stop").split(","))
+
+TILE_TTL = int(os.environ.get("COORDINOTE_TILE_TTL", 24 * 3600))  # seconds
+MAX_BYTES = int(os.environ.get("COORDINOTE_TILE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+SWEEP_EVERY = 500  # tile writes between two sweeps of the cache directory
+
+LOCATIONS_TILE_SQL = """
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom
+    ),
+    features AS (
+        SELECT
+            ST_AsMVTGeom(ST_Transform(l.geom, 3857), bounds.geom, %(extent)s, %(buffer)s, true) AS geom,
+            l.location_id,
+            l.l_name AS name,
+            l.category
+        FROM locations l, bounds
+        WHERE l.geom && ST_Transform(bounds.geom, 4326)
+        AND l.removed_at IS NULL
+        AND (%(category)s::text IS NULL OR l.category = %(category)s)
+    )
+    SELECT ST_AsMVT(features, 'locations', %(extent)s, 'geom') AS tile
+    FROM features;
+"""
+
+MESSAGES_TILE_SQL = """
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom
+    ),
+    features AS (
+        SELECT
+            ST_AsMVTGeom(ST_Transform(l.geom, 3857), bounds.geom, %(extent)s, %(buffer)s, true) AS geom,
+            m.m_id,
+            m.m_type,
+            m.unl_rad,
+            m.view_once,
+            l.location_id
+        FROM messages m
+        JOIN locations l ON l.location_id = m.location_id
+        CROSS JOIN bounds
+        WHERE m.uni_id = %(uni_id)s
+        AND l.geom && ST_Transform(bounds.geom, 4326)
+    )
+    SELECT ST_AsMVT(features, 'messages', %(extent)s, 'geom') AS tile
+    FROM features;
+"""
+
+LAYERS = ("locations", "messages")
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def valid_category(category):
+    return category is None or CATEGORY_PATTERN.match(category) is not None
+
+
+def cacheable_scope(layer, scope):
+    """Message tiles are cached per universe, location tiles only for the known categories."""
+    return layer == "messages" or scope == "all" or scope in CACHED_CATEGORIES
+
+
+def fetch_tile(cur, layer, z, x, y, category=None, uni_id=None):
+    """Builds one tile with PostGIS and returns it as bytes (empty tiles are b"")."""
+    params = {
+        "z": z, "x": x, "y": y,
+        "extent": TILE_EXTENT,
+        "buffer": TILE_BUFFER,
+        "category": category,
+        "uni_id": uni_id,
+    }
+    cur.execute(LOCATIONS_TILE_SQL if layer == "locations" else MESSAGES_TILE_SQL, params)
+    tile = cur.fetchone()["tile"]
+    return bytes(tile) if tile is not None else b""
+
+
+class TileCache:
+    """Tiles cached as files, one directory per (layer, scope)."""
+
+    def __init__(self, directory=TILE_CACHE_DIR, ttl=TILE_TTL, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.root = os.path.realpath(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _safe(self, *parts):
+        """Joins a path under the cache directory, refusing anything that would leave it."""
+        path = os.path.realpath(os.path.join(self.root, *(str(part) for part in parts)))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"tile cache path outside of {self.root}")
+        return path
+
+    def _path(self, layer, scope, z, x, y):
+        return self._safe(layer, scope, z, x, f"{y}.pbf")
+
+    def _generation_path(self, layer, scope):
+        return self._safe(layer, f"{scope}.generation")
+
+    def generation(self, layer, scope):
+        """Token of the current cache generation of a scope, pass it to put()."""
+        try:
+            with open(self._generation_path(layer, scope)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def get(self, layer, scope, z, x, y):
+        if not cacheable_scope(layer, scope):
+            return None
+        path = self._path(layer, scope, z, x, y)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, layer, scope, z, x, y, tile, generation):
+        """Stores a tile built after generation() returned `generation`, unless the scope was invalidated since."""
+        if not cacheable_scope(layer, scope) or self.generation(layer, scope) != generation:
+            return
+
+        path = self._path(layer, scope, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a half written tile
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(tile)
+        os.replace(tmp_path, path)
+
+        # invalidate() changes the token before removing the tiles: if it ran while
+        # this tile was being written, the tile may have survived the removal
+        if self.generation(layer, scope) != generation:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            self._writes += 1
+            sweep = self._writes % SWEEP_EVERY == 0
+        if sweep:
+            # Walking the directory takes a while, not on the request thread
+            threading.Thread(target=self.sweep, name="tile-cache-sweep", daemon=True).start()
+
+    def invalidate(self, layer, scope=None):
+        """Removes all cached tiles of a layer, or only of one scope (category / uni_id)."""
+        if scope is not None:
+            generation_path = self._generation_path(layer, scope)
+            os.makedirs(os.path.dirname(generation_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(generation_path), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(uuid.uuid4().hex)
+            os.replace(tmp_path, generation_path)
+            shutil.rmtree(self._safe(layer, scope), ignore_errors=True)
+        else:
+            shutil.rmtree(self._safe(layer), ignore_errors=True)
+
+    def sweep(self):
+        """Deletes expired tiles, then the oldest ones while the cache is bigger than max_bytes."""
+        now = time.time()
+        tiles = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith(".pbf"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                    if now - stat.st_mtime > self.ttl:
+                        os.remove(path)
+                    else:
+                        tiles.append((stat.st_mtime, stat.st_size, path))
+                except FileNotFoundError:
+                    continue
+
+        total = sum(size for _, size, _ in tiles)
+        tiles.sort()
+        for _, size, path in tiles:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,14 +1,23 @@
-def format_geojson_feature(row, geometry_column="geom"):
+from json_provider import json_fragment
+
+
+def format_geojson_feature(row, geometry_column="geom", geometry_text=False):
     """
     Converts a single database row into a GeoJSON Feature.
 
     :param row: Dictionary representing a single row from a database query.
     :param geometry_column: The name of the column containing the geometry in GeoJSON Binary format (default: "geom").
+    :param geometry_text: True if the geometry column is GeoJSON text (ST_AsGeoJSON); it is then
+                          embedded into the response as is, without being parsed (see json_provider.py).
     :return: A GeoJSON Feature dictionary.
     """
+    geometry = row.get(geometry_column)
+    if geometry_text:
+        geometry = json_fragment(geometry)
+
     geojson = {
         "type": "Feature",
-        "geometry": row.get(geometry_column),  # Geometry as GeoJSON
+        "geometry": geometry,  # Geometry as GeoJSON
         "properties": {
             key: value for key, value in row.items() if key != geometry_column
         }
@@ -17,32 +26,53 @@ def format_geojson_feature(row, geometry_column="geom"):
     return geojson
 
 
-def format_geojson_featurecollection(rows, geometry_column="geom"):
+def format_geojson_featurecollection(rows, geometry_column="geom", geometry_text=False):
     """
     Formats a list of database rows as a GeoJSON FeatureCollection.
 
     :param rows: List of dictionaries representing rows from a database query.
     :param geometry_column: The name of the column containing the geometry in GeoJSON Binary format (default: "geom").
+    :param geometry_text: True if the geometry column is GeoJSON text (see format_geojson_feature).
     :return: A GeoJSON FeatureCollection dictionary.
     """
     geojson = {
         "type": "FeatureCollection",
-        "features": [format_geojson_feature(row, geometry_column) for row in rows]
+        "features": [format_geojson_feature(row, geometry_column, geometry_text) for row in rows]
     }
 
     return geojson
 
-def format_geojson(rows, geometry_column="geom"):
+def format_geojson(rows, geometry_column="geom", geometry_text=False):
     """
     Formats a list of database rows as a GeoJSON feature (single row) or FeatureCollection (multiple rows).
 
     :param rows: List of dictionaries representing rows from a database query.
     :param geometry_column: The name of the column containing the geometry in GeoJSON Binary format (default: "geom").
+    :param geometry_text: True if the geometry column is GeoJSON text (see format_geojson_feature).
     :return: A GeoJSON FeatureCollection or a GeoJSON Feature dictionary.
     """
     if len(rows) > 1:
-        geojson = format_geojson_featurecollection(rows, geometry_column)
+        geojson = format_geojson_featurecollection(rows, geometry_column, geometry_text)
     else:
-        geojson = format_geojson_feature(rows[0], geometry_column)
+        geojson = format_geojson_feature(rows[0], geometry_column, geometry_text)
     
     return geojson
+
+def stream_geojson_featurecollection(feature_chunks):
+    """
+    Streams a GeoJSON FeatureCollection as text, without building it in memory.
+
+    :param feature_chunks: Iterable of lists of Features that are already serialized as JSON text
+                           (e.g. built by PostGIS with json_build_object / ST_AsGeoJSON).
+    :return: A generator of strings which together form the FeatureCollection.
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+
+    first = True
+    for chunk in feature_chunks:
+        if not chunk:
+            continue
+        yield ("" if first else ",") + ",".join(chunk)
+        first = False
+
+    yield "]}"
@@ -0,0 +1,81 @@
+import hashlib
+import os
+import tempfile
+import uuid
+
+from cache import TTLCache
+from tiles import CACHE_DIR
+
+# -------------------------------------------------------------------
+# DATASET VERSIONS (for ETag / 304 responses)
+#
+# Read-heavy endpoints return the same payload to everyone until the data
+# changes. Each dataset has a version token that is replaced whenever it is
+# written to:
+#   - "locations"          by load_to_postgis in the ETL
+#   - "universes"          by universe creation in app.py
+#   - "messages.<uni_id>"  by message creation in app.py
+#
+# The tokens are small files in <cache dir>/versions, so they are shared by all
+# API worker processes and the ETL, and can be read without a database query.
+# A random token (instead of a counter) means two writers can never produce
+# the same version by accident.
+
+VERSION_DIR = os.path.join(CACHE_DIR, "versions")
+
+
+class DatasetVersions:
+
+    def __init__(self, directory=VERSION_DIR):
+        self.directory = directory
+
+    def current(self, name):
+        """Returns the version token of a dataset (a dataset without a token gets one)."""
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                token = f.read().strip()
+            if token:
+                return token
+        except FileNotFoundError:
+            pass
+        return self.bump(name)
+
+    def bump(self, name):
+        """Gives the dataset a new version token, call this after every write to it."""
+        os.makedirs(self.directory, exist_ok=True)
+        token = uuid.uuid4().hex
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+        return token
+
+
+def make_etag(name, variant, token):
+    """Strong ETag for one variant (e.g. query parameters) of a dataset version."""
+    return hashlib.sha1(f"{name}|{variant}|{token}".encode()).hexdigest()
+
+
+class ResponseBodyCache:
+    """
+    Serialized response bodies per (dataset, variant), each stored with the
+    version token it was built from. A body is only reused while the dataset
+    still has that token.
+    """
+
+    def __init__(self, maxsize=1000, ttl=3600, max_bytes=128 * 1024 * 1024):
+        self.bodies = TTLCache(maxsize=maxsize, ttl=ttl, max_bytes=max_bytes,
+                               sizeof=lambda entry: len(entry[1]))
+
+    def get(self, name, variant, token):
+        entry = self.bodies.get((name, variant))
+        if entry is None or entry[0] != token:
+            return None
+        return entry[1]
+
+    def set(self, name, variant, token, body):
+        self.bodies.set((name, variant), (token, body))
+
+    def stats(self):
+        return self.bodies.stats()
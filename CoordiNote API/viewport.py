@@ -0,0 +1,138 @@
+import math
+
+# -------------------------------------------------------------------
+# MESSAGES IN THE MAP VIEWPORT (/messages/bbox)
+#
+# The map only shows one rectangle, so the query is an envelope test on the
+# indexed locations.geom (GiST, DB/migrations/001_locations_geography.sql) joined
+# to the messages of the universe on (location_id, uni_id), also indexed.
+#
+# The response stays small however dense the universe is:
+#   - from POINTS_MIN_ZOOM on, single messages are returned (no text, it depends
+#     on the user's position: /messages/nearby and /open decide that), at most
+#     MAX_POINTS of them
+#   - below that zoom, or when the viewport holds more than MAX_POINTS messages,
+#     messages are grouped in PostGIS on a grid of ~GRID_CELL_PIXELS screen pixels
+#     (ST_SnapToGrid) and one cluster per cell is returned: count + centroid
+#
+# The grid is anchored at 0/0 and its cell size only depends on the zoom, so the
+# clusters don't jump around while the map is panned, and the envelope is widened
+# to whole cells so the counts at the edges of the viewport are complete.
+
+POINTS_MIN_ZOOM = 15
+MAX_ZOOM = 22
+MAX_POINTS = 500
+GRID_CELL_PIXELS = 64  # cluster cell size on screen
+MAX_CELLS = 2500  # cells per response, bigger viewports get coarser cells
+TILE_SIZE = 256  # pixels per web map tile
+
+VIEWPORT_POINTS_SQL = """
+    SELECT
+        m.m_id,
+        m.m_type,
+        m.unl_rad,
+        m.view_once,
+        l.location_id,
+        l.l_name AS location_name,
+        ST_Y(l.geom) AS latitude,
+        ST_X(l.geom) AS longitude
+    FROM locations l
+    JOIN messages m
+        ON m.location_id = l.location_id
+        AND m.uni_id = %(uni_id)s
+    WHERE l.geom && ST_MakeEnvelope(%(minx)s, %(miny)s, %(maxx)s, %(maxy)s, 4326)
+    LIMIT %(limit)s;
+"""
+
+VIEWPORT_CLUSTERS_SQL = """
+    SELECT
+        count(*) AS count,
+        avg(ST_Y(l.geom)) AS latitude,
+        avg(ST_X(l.geom)) AS longitude,
+        CASE WHEN count(*) = 1 THEN min(m.m_id) END AS m_id
+    FROM locations l
+    JOIN messages m
+        ON m.location_id = l.location_id
+        AND m.uni_id = %(uni_id)s
+    WHERE l.geom && ST_MakeEnvelope(%(minx)s, %(miny)s, %(maxx)s, %(maxy)s, 4326)
+    GROUP BY ST_SnapToGrid(l.geom, 0, 0, %(cell_x)s, %(cell_y)s);
+"""
+
+
+def parse_bbox_args(args):
+    """
+    Validates the query string of a /messages/bbox request.
+
+    :param args: The request.args of the Flask request.
+    :return: (params, error) where params is a dict for fetch_viewport_messages().
+    """
+    names = ("uni_id", "minx", "miny", "maxx", "maxy", "zoom")
+    if any(not args.get(name) for name in names):
+        return None, "uni_id, minx, miny, maxx, maxy and zoom are required parameters"
+
+    try:
+        params = {name: float(args.get(name)) for name in names}
+        params["uni_id"] = int(args.get("uni_id"))
+    except ValueError:
+        return None, "uni_id, minx, miny, maxx, maxy and zoom must be numbers"
+
+    if not (-180 <= params["minx"] < params["maxx"] <= 180 and -90 <= params["miny"] < params["maxy"] <= 90):
+        return None, "bbox must be minx < maxx (longitudes) and miny < maxy (latitudes)"
+
+    if not 0 <= params["zoom"] <= MAX_ZOOM:
+        return None, f"zoom must be between 0 and {MAX_ZOOM}"
+
+    return params, None
+
+
+def grid_cell_size(zoom, miny, maxy):
+    """
+    Cell size in degrees (x, y) for a zoom level: GRID_CELL_PIXELS at the equator,
+    narrowed in latitude so cells look square on the (Web Mercator) map.
+    """
+    cell_x = 360 / (TILE_SIZE * 2 ** math.floor(zoom)) * GRID_CELL_PIXELS
+    # Rounded to whole degrees so the grid stays the same while panning
+    band = min(abs(round((miny + maxy) / 2)), 85)
+    return cell_x, cell_x * math.cos(math.radians(band))
+
+
+def _snap_to_cells(low, high, size):
+    """Widens [low, high] to whole cells of ST_SnapToGrid (cells are centered on multiples of size)."""
+    return (math.floor(low / size + 0.5) - 0.5) * size, (math.ceil(high / size - 0.5) + 0.5) * size
+
+
+def fetch_viewport_clusters(cur, uni_id, minx, miny, maxx, maxy, zoom):
+    cell_x, cell_y = grid_cell_size(zoom, miny, maxy)
+    # Viewports much bigger than a screen at this zoom: double the cells until they fit
+    while ((maxx - minx) / cell_x) * ((maxy - miny) / cell_y) > MAX_CELLS:
+        cell_x, cell_y = cell_x * 2, cell_y * 2
+
+    minx, maxx = _snap_to_cells(minx, maxx, cell_x)
+    miny, maxy = _snap_to_cells(miny, maxy, cell_y)
+
+    cur.execute(VIEWPORT_CLUSTERS_SQL, {
+        "uni_id": uni_id,
+        "minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy,
+        "cell_x": cell_x, "cell_y": cell_y,
+    })
+    return {"mode": "clusters", "cell": [cell_x, cell_y], "clusters": cur.fetchall()}
+
+
+def fetch_viewport_messages(cur, uni_id, minx, miny, maxx, maxy, zoom):
+    """
+    Returns {"mode": "points", "messages": [...]} or {"mode": "clusters", "cell": [x, y],
+    "clusters": [{"count", "latitude", "longitude", "m_id" (single messages only)}]}.
+
+    :param cur: An open cursor (RealDictCursor).
+    """
+    if zoom >= POINTS_MIN_ZOOM:
+        cur.execute(VIEWPORT_POINTS_SQL, {
+            "uni_id": uni_id,
+            "minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy,
+            "limit": MAX_POINTS + 1,
+        })
+        messages = cur.fetchall()
+        if len(messages) <= MAX_POINTS:
+            return {"mode": "points", "messages": messages}
+
+    return fetch_viewport_clusters(cur, uni_id, minx, miny, maxx, maxy, zoom)
@@ -0,0 +1,24 @@
+-- -------------------------------------------------------
+-- 001: geography column + spatial indexes for the nearby query
+--
+-- /messages/nearby used to cast locations.geom to geography on every row,
+-- which can't use an index. The geography is now stored (generated from geom,
+-- so the ETL keeps writing geom only) and indexed with GiST.
+-- -------------------------------------------------------
+
+BEGIN;
+
+ALTER TABLE locations
+    ADD COLUMN IF NOT EXISTS geog geography
+    GENERATED ALWAYS AS (geom::geography) STORED;
+
+CREATE INDEX IF NOT EXISTS locations_geog_gist ON locations USING GIST (geog);
+CREATE INDEX IF NOT EXISTS locations_geom_gist ON locations USING GIST (geom);
+
+-- Messages are looked up by location (joined from the spatial candidates) within a universe
+CREATE INDEX IF NOT EXISTS messages_location_uni_idx ON messages (location_id, uni_id);
+
+COMMIT;
+
+ANALYZE locations;
+ANALYZE messages;
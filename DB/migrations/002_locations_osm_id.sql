@@ -0,0 +1,20 @@
+-- -------------------------------------------------------
+-- 002: OpenStreetMap element id on locations
+--
+-- The ETL's incremental load mode matches rows on the OSM element
+-- (osm_type + osm_id) instead of deleting and re-inserting whole categories,
+-- so location_id (referenced by messages.location_id) stays stable.
+--
+-- Rows loaded before this migration have no osm_id; the first incremental
+-- run replaces them once, after that rows are updated in place.
+-- -------------------------------------------------------
+
+BEGIN;
+
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS osm_type text;
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS osm_id bigint;
+
+CREATE UNIQUE INDEX IF NOT EXISTS locations_osm_element_key ON locations (osm_type, osm_id);
+CREATE INDEX IF NOT EXISTS locations_category_idx ON locations (category);
+
+COMMIT;
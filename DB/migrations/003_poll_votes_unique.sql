@@ -0,0 +1,23 @@
+-- -------------------------------------------------------
+-- 003: one vote per user and poll
+--
+-- The poll module records a vote with a single
+-- INSERT ... ON CONFLICT (us_id, m_id) DO NOTHING, so the database
+-- (not a SELECT before the INSERT) guarantees a user votes only once,
+-- even when two of their requests arrive at the same time.
+--
+-- Duplicate votes from before this migration are removed first,
+-- keeping each user's earliest vote.
+-- -------------------------------------------------------
+
+BEGIN;
+
+DELETE FROM poll_votes pv
+USING poll_votes earlier
+WHERE pv.us_id = earlier.us_id
+  AND pv.m_id = earlier.m_id
+  AND pv.vote_id > earlier.vote_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS poll_votes_us_id_m_id_key ON poll_votes (us_id, m_id);
+
+COMMIT;
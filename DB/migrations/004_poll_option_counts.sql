@@ -0,0 +1,32 @@
+-- -------------------------------------------------------
+-- 004: per-option vote counters
+--
+-- /poll/results used to COUNT(*) every vote of the poll on each request.
+-- poll_option_counts holds the running total per option instead. The poll
+-- module increments it in the same statement (and transaction) that records
+-- the vote, so reading results costs one row per option.
+--
+-- If the counters ever drift (votes deleted by hand, restored backups, ...)
+-- recompute them from poll_votes with:
+--     python "CoordiNote API/poll_counts.py" [--m-id ...]
+-- -------------------------------------------------------
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS poll_option_counts (
+    option_id integer PRIMARY KEY REFERENCES poll_options (option_id) ON DELETE CASCADE,
+    m_id integer NOT NULL,
+    vote_count bigint NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS poll_option_counts_m_id_idx ON poll_option_counts (m_id);
+
+-- Backfill from the existing votes
+INSERT INTO poll_option_counts (option_id, m_id, vote_count)
+SELECT po.option_id, po.m_id, COUNT(pv.vote_id)
+FROM poll_options po
+LEFT JOIN poll_votes pv ON pv.option_id = po.option_id
+GROUP BY po.option_id, po.m_id
+ON CONFLICT (option_id) DO UPDATE SET vote_count = EXCLUDED.vote_count;
+
+COMMIT;
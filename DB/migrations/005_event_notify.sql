@@ -0,0 +1,61 @@
+-- -------------------------------------------------------
+-- 005: NOTIFY on new messages and poll votes
+--
+-- The API streams these to the clients of a universe as Server-Sent Events
+-- (GET /universes/<uni_id>/events, see "CoordiNote API/events.py"), so the
+-- map gets new markers and poll updates pushed instead of polling.
+--
+-- Payloads are small JSON objects on the "coordinote_events" channel and are
+-- only delivered when the writing transaction commits. The message text is
+-- never included (it may be locked for the receiver).
+-- -------------------------------------------------------
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION notify_message_created() RETURNS trigger AS $$
+DECLARE
+    loc record;
+BEGIN
+    SELECT ST_Y(geom) AS latitude, ST_X(geom) AS longitude
+    INTO loc
+    FROM locations
+    WHERE location_id = NEW.location_id;
+
+    PERFORM pg_notify('coordinote_events', json_build_object(
+        'type', 'message',
+        'uni_id', NEW.uni_id,
+        'm_id', NEW.m_id,
+        'm_type', NEW.m_type,
+        'unl_rad', NEW.unl_rad,
+        'view_once', NEW.view_once,
+        'location_id', NEW.location_id,
+        'latitude', loc.latitude,
+        'longitude', loc.longitude
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS messages_notify_insert ON messages;
+CREATE TRIGGER messages_notify_insert
+    AFTER INSERT ON messages
+    FOR EACH ROW EXECUTE FUNCTION notify_message_created();
+
+CREATE OR REPLACE FUNCTION notify_poll_vote() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('coordinote_events', json_build_object(
+        'type', 'vote',
+        'uni_id', (SELECT uni_id FROM messages WHERE m_id = NEW.m_id),
+        'm_id', NEW.m_id,
+        'option_id', NEW.option_id
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS poll_votes_notify_insert ON poll_votes;
+CREATE TRIGGER poll_votes_notify_insert
+    AFTER INSERT ON poll_votes
+    FOR EACH ROW EXECUTE FUNCTION notify_poll_vote();
+
+COMMIT;
@@ -0,0 +1,22 @@
+-- -------------------------------------------------------
+-- 006: a message is seen once per user
+--
+-- Opening messages ("CoordiNote API/message_open.py") records first views
+-- with INSERT ... ON CONFLICT (m_id, us_id) DO NOTHING, so a view-once
+-- message can't be read twice by two parallel requests.
+--
+-- Duplicate rows from before this migration are removed first, keeping
+-- one row per (m_id, us_id).
+-- -------------------------------------------------------
+
+BEGIN;
+
+DELETE FROM seen s
+USING seen other
+WHERE s.m_id = other.m_id
+  AND s.us_id = other.us_id
+  AND s.ctid > other.ctid;
+
+CREATE UNIQUE INDEX IF NOT EXISTS seen_m_id_us_id_key ON seen (m_id, us_id);
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- -------------------------------------------------------
+-- 007: index for paging through a universe's messages
+--
+-- GET /messages reads pages with
+--     WHERE uni_id = ? AND m_id > <cursor> ORDER BY m_id LIMIT n
+-- ("CoordiNote API/messages_page.py"); this index serves that as one
+-- range scan in order, without sorting the universe.
+-- -------------------------------------------------------
+
+CREATE INDEX IF NOT EXISTS messages_uni_id_m_id_idx ON messages (uni_id, m_id);
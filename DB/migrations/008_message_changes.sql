@@ -0,0 +1,69 @@
+-- -------------------------------------------------------
+-- 008: change log for delta sync of messages
+--
+-- GET /messages/changes?uni_id=&since=<token> returns only the messages
+-- created or updated, and the ids of the messages deleted, since the
+-- client's last sync ("CoordiNote API/message_changes.py").
+--
+--   messages.change_xid      transaction that last wrote the row
+--                            (set on insert and on every update)
+--   message_tombstones       one row per deleted message, written by a trigger
+--
+-- Transaction ids are used instead of a plain sequence so that a write that
+-- commits late can't be skipped: the sync token is the oldest transaction
+-- still running when the changes were read, and the next sync starts there.
+-- Needs PostgreSQL 13+ (xid8, pg_current_xact_id).
+-- -------------------------------------------------------
+
+BEGIN;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS change_xid xid8;
+UPDATE messages SET change_xid = pg_current_xact_id() WHERE change_xid IS NULL;
+ALTER TABLE messages ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+ALTER TABLE messages ALTER COLUMN change_xid SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS messages_uni_id_change_xid_idx ON messages (uni_id, change_xid);
+
+CREATE OR REPLACE FUNCTION messages_touch_change_xid() RETURNS trigger AS $$
+BEGIN
+    NEW.change_xid := pg_current_xact_id();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS messages_change_xid_update ON messages;
+CREATE TRIGGER messages_change_xid_update
+    BEFORE UPDATE ON messages
+    FOR EACH ROW EXECUTE FUNCTION messages_touch_change_xid();
+
+CREATE TABLE IF NOT EXISTS message_tombstones (
+    m_id integer PRIMARY KEY,
+    uni_id integer NOT NULL,
+    change_xid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+    deleted_at timestamp NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS message_tombstones_uni_id_change_xid_idx ON message_tombstones (uni_id, change_xid);
+
+-- A deleted message, or a message moved to another universe, disappears from
+-- its (old) universe
+CREATE OR REPLACE FUNCTION messages_write_tombstone() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' OR OLD.uni_id IS DISTINCT FROM NEW.uni_id THEN
+        INSERT INTO message_tombstones (m_id, uni_id)
+        VALUES (OLD.m_id, OLD.uni_id)
+        ON CONFLICT (m_id) DO UPDATE
+            SET uni_id = EXCLUDED.uni_id,
+                change_xid = EXCLUDED.change_xid,
+                deleted_at = EXCLUDED.deleted_at;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS messages_tombstone ON messages;
+CREATE TRIGGER messages_tombstone
+    AFTER DELETE OR UPDATE OF uni_id ON messages
+    FOR EACH ROW EXECUTE FUNCTION messages_write_tombstone();
+
+COMMIT;
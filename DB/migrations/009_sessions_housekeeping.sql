@@ -0,0 +1,18 @@
+-- -------------------------------------------------------
+-- 009: indexes for session lookups and expiry
+--
+--   sessions_token_key        token lookup of every authenticated request;
+--                             us_id and expires_at are INCLUDEd so the lookup
+--                             is an index-only scan
+--   sessions_expires_at_idx   the session reaper deletes expired sessions
+--                             in small batches, oldest first
+--   sessions_us_id_idx        per-user session cap enforced on login
+--
+-- Expired sessions are deleted by the API ("CoordiNote API/sessions.py").
+-- The first run after this migration may delete a large backlog; it does
+-- so in batches and doesn't block logins.
+-- -------------------------------------------------------
+
+CREATE UNIQUE INDEX IF NOT EXISTS sessions_token_key ON sessions (token) INCLUDE (us_id, expires_at);
+CREATE INDEX IF NOT EXISTS sessions_expires_at_idx ON sessions (expires_at);
+CREATE INDEX IF NOT EXISTS sessions_us_id_idx ON sessions (us_id, expires_at);
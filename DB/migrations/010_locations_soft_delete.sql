@@ -0,0 +1,19 @@
+-- -------------------------------------------------------
+-- 010: soft delete of locations that vanished from OpenStreetMap
+--
+-- The ETL's incremental load used to DELETE locations that were no longer
+-- returned by Overpass, which left messages.location_id pointing at removed
+-- rows (or failed on the foreign key). Locations that messages still refer to
+-- are now only marked with removed_at: the POI disappears from /locations and
+-- the location tiles, the messages keep their place. A location that comes
+-- back upstream gets removed_at cleared again.
+-- -------------------------------------------------------
+
+BEGIN;
+
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS removed_at timestamp;
+
+-- Lookup of the messages of a location when deciding between delete and soft delete
+CREATE INDEX IF NOT EXISTS messages_location_id_idx ON messages (location_id);
+
+COMMIT;
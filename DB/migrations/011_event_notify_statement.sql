@@ -0,0 +1,94 @@
+-- -------------------------------------------------------
+-- 011: one NOTIFY trigger call per statement instead of per row
+--
+-- The row triggers of 005 ran a locations lookup and queued a notification for
+-- every inserted row, so a bulk INSERT (benchmarks/generate_dataset.py writes a
+-- million messages in one statement) queued a million notifications in the
+-- writing transaction and flooded every listening API process.
+--
+-- The triggers now fire once per statement and read the inserted rows from a
+-- transition table (PostgreSQL 10+). Up to NOTIFY_ROWS_MAX rows the same events
+-- as before are sent, one per row; above that a single
+-- {"type": "resync"} without uni_id is sent and the clients of every universe
+-- reload (see _dispatch in "CoordiNote API/events.py").
+-- -------------------------------------------------------
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION notify_rows_max() RETURNS integer AS $$
+    SELECT 100;  -- NOTIFY_ROWS_MAX
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION notify_messages_created() RETURNS trigger AS $$
+DECLARE
+    msg record;
+BEGIN
+    IF (SELECT count(*) FROM (SELECT 1 FROM new_messages LIMIT notify_rows_max() + 1) n) > notify_rows_max() THEN
+        PERFORM pg_notify('coordinote_events', json_build_object('type', 'resync')::text);
+        RETURN NULL;
+    END IF;
+
+    FOR msg IN
+        SELECT m.uni_id, m.m_id, m.m_type, m.unl_rad, m.view_once, m.location_id,
+               ST_Y(l.geom) AS latitude, ST_X(l.geom) AS longitude
+        FROM new_messages m
+        LEFT JOIN locations l ON l.location_id = m.location_id
+    LOOP
+        PERFORM pg_notify('coordinote_events', json_build_object(
+            'type', 'message',
+            'uni_id', msg.uni_id,
+            'm_id', msg.m_id,
+            'm_type', msg.m_type,
+            'unl_rad', msg.unl_rad,
+            'view_once', msg.view_once,
+            'location_id', msg.location_id,
+            'latitude', msg.latitude,
+            'longitude', msg.longitude
+        )::text);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS messages_notify_insert ON messages;
+CREATE TRIGGER messages_notify_insert
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_messages_created();
+
+CREATE OR REPLACE FUNCTION notify_poll_votes() RETURNS trigger AS $$
+DECLARE
+    vote record;
+BEGIN
+    IF (SELECT count(*) FROM (SELECT 1 FROM new_votes LIMIT notify_rows_max() + 1) n) > notify_rows_max() THEN
+        PERFORM pg_notify('coordinote_events', json_build_object('type', 'resync')::text);
+        RETURN NULL;
+    END IF;
+
+    FOR vote IN
+        SELECT m.uni_id, v.m_id, v.option_id
+        FROM new_votes v
+        JOIN messages m ON m.m_id = v.m_id
+    LOOP
+        PERFORM pg_notify('coordinote_events', json_build_object(
+            'type', 'vote',
+            'uni_id', vote.uni_id,
+            'm_id', vote.m_id,
+            'option_id', vote.option_id
+        )::text);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS poll_votes_notify_insert ON poll_votes;
+CREATE TRIGGER poll_votes_notify_insert
+    AFTER INSERT ON poll_votes
+    REFERENCING NEW TABLE AS new_votes
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_poll_votes();
+
+-- The row-level functions of 005 are no longer used
+DROP FUNCTION IF EXISTS notify_message_created();
+DROP FUNCTION IF EXISTS notify_poll_vote();
+
+COMMIT;
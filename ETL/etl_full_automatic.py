@@ -1,10 +1,19 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
 import time
+import uuid
 import requests
 import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import Point
 from sqlalchemy import create_engine, text
 from geoalchemy2 import Geometry
+from concurrent.futures import ThreadPoolExecutor
 
 # -------------------------------------------------------
 # CONFIGURATION
@@ -16,7 +25,42 @@ DB_PORT = "5432"
 DB_NAME = "coordinote_share"
 TABLE_NAME = "locations"
 
-TRUNCATE_BEFORE_LOAD = True
+STAGING_TABLE_NAME = "locations_staging"
+
+# "incremental": upsert on the OSM element id, location_id stays stable (default)
+# "replace":     delete the refreshed categories and load them again
+LOAD_MODE = "incremental"
+TRUNCATE_BEFORE_LOAD = True  # only used by the "replace" mode
+LEGACY_MATCH_DISTANCE = 25  # meters, rows without osm_id are matched to an OSM element this close
+
+# How rows are written to PostGIS:
+# "copy":       COPY FROM STDIN with hex EWKB geometries, streamed in chunks (fast)
+# "to_postgis": GeoPandas/GeoAlchemy batched INSERTs
+LOAD_STRATEGY = "copy"
+COPY_CHUNK_SIZE = 10000  # rows converted to COPY text at a time
+COPY_READ_SIZE = 64 * 1024  # bytes sent to the server per read
+
+# Cache directory shared with the API (vector tiles etc.), cleared for the reloaded categories
+CACHE_DIR = os.environ.get(
+    "COORDINOTE_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache")
+)
+TILE_CACHE_DIR = os.path.join(CACHE_DIR, "tiles")
+VERSION_DIR = os.path.join(CACHE_DIR, "versions")
+
+# Overpass API: categories are fetched in parallel (at most MAX_CONCURRENT_REQUESTS at a time)
+# and failed requests are retried with exponential backoff + jitter
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+MAX_CONCURRENT_REQUESTS = 4
+REQUEST_TIMEOUT = 90  # seconds
+MAX_RETRIES = 3
+BACKOFF_BASE = 5  # seconds, doubled on every retry
+BACKOFF_MAX = 60  # seconds
+
+# Overpass responses are cached on disk, so reruns (and tests) replay locally
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_DIR = os.path.join(CACHE_DIR, "overpass")
+RESPONSE_CACHE_MAX_AGE = 24 * 3600  # seconds, None = never expires
 
 # Define the categories and their specific OpenStreetMap queries
 # You can easily add more categories here in the future!
@@ -29,10 +73,59 @@ TARGETS = {
 # EXTRACT + TRANSFORM 
 
 
+def overpass_cache_path(full_query):
+    # Responses are cached on disk under the hash of the exact query
+    query_hash = hashlib.sha256(f"{OVERPASS_URL}\n{full_query}".encode()).hexdigest()
+    return os.path.join(RESPONSE_CACHE_DIR, f"{query_hash}.json")
+
+def read_cached_response(full_query):
+    path = overpass_cache_path(full_query)
+    try:
+        if RESPONSE_CACHE_MAX_AGE is not None and time.time() - os.path.getmtime(path) > RESPONSE_CACHE_MAX_AGE:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_cached_response(full_query, data_json):
+    os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=RESPONSE_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data_json, f)
+    os.replace(tmp_path, overpass_cache_path(full_query))
+
+def download_overpass(category, full_query):
+    if USE_RESPONSE_CACHE:
+        data_json = read_cached_response(full_query)
+        if data_json is not None:
+            print(f"Using cached Overpass response for '{category}'.")
+            return data_json
+
+    data_json = None
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = requests.get(OVERPASS_URL, params={'data': full_query}, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status() 
+            data_json = response.json()
+            break
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Warning: API connection failed for '{category}' (Attempt {attempt + 1}/{MAX_RETRIES}) - Error: {e}")
+            if attempt < MAX_RETRIES - 1:
+                # Exponential backoff with full jitter, so parallel workers don't retry in lockstep
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                print(f"Waiting {delay:.1f} seconds before retrying '{category}'...")
+                time.sleep(delay)
+            else:
+                raise Exception(f"Failed to fetch {category} data.")
+
+    if USE_RESPONSE_CACHE and data_json:
+        write_cached_response(full_query, data_json)
+    return data_json
+
 def fetch_osm_data(category, target_query):
     print(f"\nFetching '{category}' locations via OpenStreetMap...")
 
-    overpass_url = "http://overpass-api.de/api/interpreter"
     full_query = f"""
     [out:json];
     area[name="Lisboa"]->.searchArea;
@@ -40,22 +133,7 @@ def fetch_osm_data(category, target_query):
     out center;
     """
 
-    max_retries = 3
-    data_json = None
-    
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(overpass_url, params={'data': full_query}, timeout=90)
-            response.raise_for_status() 
-            data_json = response.json()
-            break
-        except requests.exceptions.RequestException as e:
-            print(f"Warning: API connection failed (Attempt {attempt + 1}/{max_retries}) - Error: {e}")
-            if attempt < max_retries - 1:
-                print("Waiting 5 seconds before retrying...")
-                time.sleep(5)
-            else:
-                raise Exception(f"Failed to fetch {category} data.")
+    data_json = download_overpass(category, full_query)
 
     if not data_json:
         return gpd.GeoDataFrame() # Return empty if nothing found
@@ -76,7 +154,13 @@ def fetch_osm_data(category, target_query):
             lon = element.get('lon')
             
         if lon and lat:
-            records.append({'l_name': name, 'category': category, 'geom': Point(lon, lat)})
+            records.append({
+                'l_name': name,
+                'category': category,
+                'osm_type': element.get('type'),  # node / way / relation
+                'osm_id': element.get('id'),
+                'geom': Point(lon, lat)
+            })
 
     if not records:
         print(f"No records found for {category}.")
@@ -89,11 +173,13 @@ def fetch_osm_data(category, target_query):
 def extract_transform():
     all_dataframes = []
     
-    # Loop through each target category and fetch its data
-    for category, query in TARGETS.items():
-        gdf = fetch_osm_data(category, query)
-        if not gdf.empty:
-            all_dataframes.append(gdf)
+    # Fetch the categories concurrently, results are kept in TARGETS order
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        futures = [executor.submit(fetch_osm_data, category, query) for category, query in TARGETS.items()]
+        for future in futures:
+            gdf = future.result()
+            if not gdf.empty:
+                all_dataframes.append(gdf)
             
     if not all_dataframes:
         raise Exception("No data could be retrieved for any category.")
@@ -108,6 +194,230 @@ def extract_transform():
 # LOAD
 # -------------------------------------------------------
 
+COPY_COLUMNS = ["l_name", "category", "osm_type", "osm_id"]
+
+def copy_text_value(value):
+    # Escapes one value for COPY's text format (None / NaN -> \N)
+    if value is None or (isinstance(value, float) and value != value):
+        return "\\N"
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # ids become floats in pandas when a column has missing values
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+def copy_lines(gdf):
+    # Yields the COPY lines, COPY_CHUNK_SIZE rows at a time. Geometries are
+    # converted to hex EWKB (with SRID) for each chunk in one vectorized call.
+    for start in range(0, len(gdf), COPY_CHUNK_SIZE):
+        chunk = gdf.iloc[start:start + COPY_CHUNK_SIZE]
+        geoms = shapely.to_wkb(
+            shapely.set_srid(chunk.geometry.values, 4326), hex=True, include_srid=True
+        )
+        columns = [chunk[column].tolist() if column in chunk else [None] * len(chunk) for column in COPY_COLUMNS]
+
+        lines = []
+        for i, geom in enumerate(geoms):
+            values = [copy_text_value(column[i]) for column in columns]
+            values.append(copy_text_value(geom))
+            lines.append("\t".join(values) + "\n")
+        yield "".join(lines)
+
+class CopyStream:
+    # Minimal file-like object for copy_expert: read() pulls more lines from the
+    # generator only when needed, so the full COPY text is never held in memory
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buffer = self.buffer, ""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+def copy_dataframe(connection, gdf, table_name):
+    # Bulk load with COPY FROM STDIN on the same (transactional) connection
+    columns = ", ".join(COPY_COLUMNS + ["geom"])
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table_name} ({columns}) FROM STDIN",
+            CopyStream(copy_lines(gdf)),
+            size=COPY_READ_SIZE
+        )
+    finally:
+        cursor.close()
+
+def write_dataframe(connection, gdf, table_name, strategy=None):
+    strategy = strategy or LOAD_STRATEGY
+    if strategy == "copy":
+        copy_dataframe(connection, gdf, table_name)
+    else:
+        gdf.to_postgis(
+            name=table_name,
+            con=connection,
+            if_exists="append",
+            index=False,
+            dtype={'geom': Geometry('POINT', srid=4326)}
+        )
+
+def load_replace(connection, gdf):
+    # Old behaviour: delete the refreshed categories and append everything again
+    # (location_id changes on every run)
+    if TRUNCATE_BEFORE_LOAD:
+        # Dynamically get the list of categories we are updating
+        categories_to_delete = list(TARGETS.keys())
+        print(f"Removing old records for {categories_to_delete} from the database...")
+        
+        # Delete only the categories we are currently updating
+        connection.execute(
+            text(f"DELETE FROM {TABLE_NAME} WHERE category = ANY(:categories);"),
+            {"categories": categories_to_delete}
+        )
+
+    print("Loading new data into PostGIS...")
+    write_dataframe(connection, gdf, TABLE_NAME)
+    return {"inserted": len(gdf), "updated": 0, "unchanged": 0, "removed": "all"}
+
+def load_incremental(connection, gdf):
+    # Rows are matched on the OSM element (osm_type + osm_id), so existing rows keep
+    # their location_id and only the rows that really changed are written.
+    # Needs DB/migrations/002_locations_osm_id.sql and 010_locations_soft_delete.sql
+    categories = sorted(gdf["category"].unique())
+
+    print("Staging new data...")
+    connection.execute(text(f"""
+        CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE_NAME} (
+            l_name text,
+            category text,
+            osm_type text,
+            osm_id bigint,
+            geom geometry(Point, 4326)
+        );
+        TRUNCATE {STAGING_TABLE_NAME};
+    """))
+    write_dataframe(connection, gdf, STAGING_TABLE_NAME)
+
+    # The same OSM element can be returned twice (e.g. by two queries), keep one
+    staged = f"""
+        SELECT DISTINCT ON (osm_type, osm_id) l_name, category, osm_type, osm_id, geom
+        FROM {STAGING_TABLE_NAME}
+        ORDER BY osm_type, osm_id, category
+    """
+
+    total = connection.execute(text(f"SELECT count(*) FROM ({staged}) s;")).scalar()
+
+    # Rows loaded before osm_id existed get the id of the OSM element at the same place
+    # (same category and name, within LEGACY_MATCH_DISTANCE meters), so they keep their
+    # location_id and their messages instead of being replaced. Each element and each
+    # legacy row is matched at most once, closest first.
+    backfilled = connection.execute(text(f"""
+        WITH candidates AS (
+            SELECT
+                l.location_id,
+                s.osm_type,
+                s.osm_id,
+                ST_Distance(l.geom::geography, s.geom::geography) AS distance
+            FROM {TABLE_NAME} l
+            JOIN ({staged}) s
+                ON s.category = l.category
+                AND s.l_name IS NOT DISTINCT FROM l.l_name
+                AND ST_DWithin(l.geom::geography, s.geom::geography, :match_distance)
+            WHERE l.osm_id IS NULL
+            AND l.category = ANY(:categories)
+            AND NOT EXISTS (
+                SELECT 1 FROM {TABLE_NAME} t
+                WHERE t.osm_type = s.osm_type AND t.osm_id = s.osm_id
+            )
+        ),
+        per_element AS (
+            SELECT DISTINCT ON (osm_type, osm_id) *
+            FROM candidates
+            ORDER BY osm_type, osm_id, distance, location_id
+        ),
+        per_location AS (
+            SELECT DISTINCT ON (location_id) *
+            FROM per_element
+            ORDER BY location_id, distance
+        )
+        UPDATE {TABLE_NAME} l
+        SET osm_type = p.osm_type, osm_id = p.osm_id
+        FROM per_location p
+        WHERE l.location_id = p.location_id;
+    """), {"categories": categories, "match_distance": LEGACY_MATCH_DISTANCE}).rowcount
+    if backfilled:
+        print(f"Matched {backfilled} legacy locations to their OSM element.")
+
+    updated = connection.execute(text(f"""
+        UPDATE {TABLE_NAME} l
+        SET l_name = s.l_name, category = s.category, geom = s.geom, removed_at = NULL
+        FROM ({staged}) s
+        WHERE l.osm_type = s.osm_type AND l.osm_id = s.osm_id
+        AND (
+            l.l_name IS DISTINCT FROM s.l_name
+            OR l.category IS DISTINCT FROM s.category
+            OR l.geom IS DISTINCT FROM s.geom
+            OR l.removed_at IS NOT NULL
+        );
+    """)).rowcount
+
+    inserted = connection.execute(text(f"""
+        INSERT INTO {TABLE_NAME} (l_name, category, osm_type, osm_id, geom)
+        SELECT l_name, category, osm_type, osm_id, geom
+        FROM ({staged}) s
+        ON CONFLICT (osm_type, osm_id) DO NOTHING;
+    """)).rowcount
+
+    # Only categories that actually returned data are cleaned up, so a failed or
+    # empty download never wipes a whole category. Locations that messages refer to
+    # are only marked as removed (hidden from /locations and the tiles), the others
+    # are deleted.
+    vanished = f"""
+        l.category = ANY(:categories)
+        AND NOT EXISTS (
+            SELECT 1 FROM {STAGING_TABLE_NAME} s
+            WHERE s.osm_type = l.osm_type AND s.osm_id = l.osm_id
+        )
+    """
+    referenced = "EXISTS (SELECT 1 FROM messages m WHERE m.location_id = l.location_id)"
+
+    soft_removed = connection.execute(text(f"""
+        UPDATE {TABLE_NAME} l
+        SET removed_at = now()
+        WHERE {vanished}
+        AND l.removed_at IS NULL
+        AND {referenced};
+    """), {"categories": categories}).rowcount
+
+    removed = soft_removed + connection.execute(text(f"""
+        DELETE FROM {TABLE_NAME} l
+        WHERE {vanished}
+        AND NOT {referenced};
+    """), {"categories": categories}).rowcount
+
+    connection.execute(text(f"TRUNCATE {STAGING_TABLE_NAME};"))
+
+    return {
+        "inserted": inserted,
+        "updated": updated,
+        "unchanged": total - inserted - updated,
+        "removed": removed,
+    }
+
 def load_to_postgis(gdf):
     print("\nConnecting to the database...")
     engine = create_engine(
@@ -115,29 +425,48 @@ def load_to_postgis(gdf):
     )
 
     try:
+        # Everything happens in one transaction, readers see the old or the new data
         with engine.begin() as connection:
-            if TRUNCATE_BEFORE_LOAD:
-                # Dynamically get the list of categories we are updating
-                categories_to_delete = tuple(TARGETS.keys())
-                print(f"Removing old records for {categories_to_delete} from the database...")
-                
-                # Delete only the categories we are currently updating
-                delete_query = f"DELETE FROM {TABLE_NAME} WHERE category IN {categories_to_delete};"
-                connection.execute(text(delete_query))
-
-            print("Loading new data into PostGIS...")
-            
-            gdf.to_postgis(
-                name=TABLE_NAME,
-                con=connection,
-                if_exists="append",
-                index=False,
-                dtype={'geom': Geometry('POINT', srid=4326)}
-            )
+            if LOAD_MODE == "incremental":
+                counts = load_incremental(connection, gdf)
+            else:
+                counts = load_replace(connection, gdf)
+
         print("SUCCESS! Data has been successfully loaded into your SQL table!")
+        print(
+            f"Inserted: {counts['inserted']}, updated: {counts['updated']}, "
+            f"unchanged: {counts['unchanged']}, removed: {counts['removed']}"
+        )
+
+        if counts["inserted"] or counts["updated"] or counts["removed"]:
+            invalidate_location_tiles(TARGETS.keys())
+            bump_dataset_version("locations")
+        return counts
     except Exception as e:
         print(f"Error occurred while loading to database: {e}")
 
+def invalidate_location_tiles(categories):
+    # The API caches the 'locations' vector tiles per category ('all' = no category filter).
+    # Like TileCache.invalidate(): a new generation token first, so the API drops tiles
+    # it was building from the old data, then the tiles themselves
+    layer_dir = os.path.join(TILE_CACHE_DIR, "locations")
+    os.makedirs(layer_dir, exist_ok=True)
+    for scope in list(categories) + ["all"]:
+        fd, tmp_path = tempfile.mkstemp(dir=layer_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp_path, os.path.join(layer_dir, f"{scope}.generation"))
+        shutil.rmtree(os.path.join(layer_dir, scope), ignore_errors=True)
+    print(f"Cleared cached map tiles for {list(categories)}.")
+
+def bump_dataset_version(name):
+    # New version token for the API's ETag / cached responses (see versions.py in the API)
+    os.makedirs(VERSION_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=VERSION_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(tmp_path, os.path.join(VERSION_DIR, name))
+
 # -------------------------------------------------------
 # MAIN ETL
 # -------------------------------------------------------
@@ -6,6 +6,9 @@
 // ── Configuration ──
 const API = 'http://localhost:5000';
 const LISBON = [38.7169, -9.1393];
+const NEARBY_RADIUS = 1000; // meters, same default as /messages/nearby
+const VIEWPORT_DEBOUNCE_MS = 250; // wait for the map to stop moving before /messages/bbox
+const SYNC_MOVE_THRESHOLD = 20; // meters moved since the last full load before a delta sync is no longer enough
 const USE_API = false; 
 
 // ── Global Variables ──
@@ -13,7 +16,10 @@ let map;
 let currentUser = null;
 let allMessages = [];
 let messageMarkers = [];
+let markersById = {}; // m_id -> marker, so delta sync can patch single markers
+let syncState = null; // { uniId, token, lat, lng } of the last /messages/changes sync
 let poiMarkers = [];
+let poiTileLayer = null; // vector tiles from /tiles/locations (only what is in view)
 let selectedLocation = null;
 let currentMsgType = 'text';
 let allUniverses = [];
@@ -21,6 +27,12 @@ let allPOIs = [];
 let isRegisterMode = false;  
 let hiddenUniverses = []; // universes the user has "left"
 let messageCircles = {}; // saves circles per m_id
+let eventSource = null; // live events (SSE) of the selected universe
+let eventsUniId = null;
+let detailMessageId = null; // m_id shown in the side panel, re-rendered when its poll gets votes
+let viewportLayer = null; // clusters / messages of /messages/bbox for the visible map area
+let viewportTimer = null;
+let viewportRequest = null; // AbortController of the running /messages/bbox request
 
 // 
 //  START APP (when page loads)
@@ -267,6 +279,7 @@ function setupEventListeners() {
   if (universeDropdown) {
     universeDropdown.addEventListener('change', (e) => {
       filterMessagesByUniverse(e.target.value);
+      subscribeUniverseEvents(e.target.value);
     });
   }
 
@@ -322,6 +335,8 @@ function initMap() {
 
   // Click to select location
   map.on('click', onMapClick);
+  // Messages of the visible area (clusters when zoomed out), reloaded after every move/zoom
+  map.on('moveend', scheduleViewportLoad);
   // User location pin
 if (navigator.geolocation) {
   navigator.geolocation.getCurrentPosition(pos => {
@@ -396,18 +411,46 @@ function locateUser() {
 // 
 async function loadMessages() {
   if (!map) return;
+  scheduleViewportLoad();
   if (USE_API && currentUser.location) {
     try {
       const { lat, lng } = currentUser.location;
       const uniId = document.getElementById('universeDropdown')?.value;
+      const headers = { 'Authorization': currentUser.token };
+
+      // Universe already synced: only fetch what changed and patch the markers.
+      // Unlocked texts and the radar depend on where the full load was done, so
+      // after moving more than SYNC_MOVE_THRESHOLD the whole list is reloaded
+      const moved = syncState ? map.distance([lat, lng], [syncState.lat, syncState.lng]) : 0;
+      if (syncState && syncState.uniId === uniId && moved <= SYNC_MOVE_THRESHOLD) {
+        const res = await fetch(
+          `${API}/messages/changes?uni_id=${uniId}&since=${syncState.token}&lat=${lat}&lon=${lng}`,
+          { headers }
+        );
+        const data = await res.json();
+        if (res.ok && !data.full_resync) {
+          applyMessageChanges(data);
+          syncState.token = data.next_token;
+          updateStats();
+          subscribeUniverseEvents(uniId);
+          return;
+        }
+      }
+
+      // Full load. The sync token is fetched first, so nothing written in between is missed
+      const tokenRes = await fetch(`${API}/messages/changes?uni_id=${uniId}`, { headers });
+      const tokenData = await tokenRes.json();
+
       const res = await fetch(
         `${API}/messages/nearby?lat=${lat}&lon=${lng}&uni_id=${uniId}`,
-        { headers: { 'Authorization': currentUser.token } }
+        { headers }
       );
       const data = await res.json();
       allMessages = data || [];
       renderMessageMarkers(allMessages);
+      syncState = tokenRes.ok ? { uniId, token: tokenData.next_token, lat, lng } : null;
       updateStats();
+      subscribeUniverseEvents(uniId);
       return;
     } catch (err) {
       console.warn('API not reachable, using demo data');
@@ -419,42 +462,223 @@ async function loadMessages() {
   updateStats();
 }
 
-function renderMessageMarkers(messages) {
-  messageMarkers.forEach(m => map.removeLayer(m));
-  messageMarkers = [];
+// 
+//  VIEWPORT MESSAGES (/messages/bbox)
+//  Zoomed out the server sends one cluster per grid cell (count + centroid), so the
+//  number of markers stays small however many messages the universe has
+// 
+function scheduleViewportLoad() {
+  clearTimeout(viewportTimer);
+  viewportTimer = setTimeout(loadViewportMessages, VIEWPORT_DEBOUNCE_MS);
+}
 
-  messages.forEach(msg => {
-    if (!msg.latitude || !msg.longitude) return;
-   const marker = L.marker([msg.latitude, msg.longitude], {
-  icon: L.divIcon({
-    html: `<div style="font-size:1.4rem">${typeIcon(msg.m_type)}</div>`,
-    className: '',
-    iconSize: [30, 30],
-    iconAnchor: [15, 15]
-  })
-}).addTo(map);
-
-    // Popup
+async function loadViewportMessages() {
+  if (!USE_API || !map || !currentUser?.token) return;
+  const uniId = document.getElementById('universeDropdown')?.value;
+  if (!uniId || uniId === 'all') return;
+
+  const bounds = map.getBounds();
+  const params = new URLSearchParams({
+    uni_id: uniId,
+    minx: Math.max(bounds.getWest(), -180),
+    miny: Math.max(bounds.getSouth(), -90),
+    maxx: Math.min(bounds.getEast(), 180),
+    maxy: Math.min(bounds.getNorth(), 90),
+    zoom: map.getZoom()
+  });
+
+  // Only the answer for the latest viewport matters
+  if (viewportRequest) viewportRequest.abort();
+  viewportRequest = new AbortController();
+
+  try {
+    const res = await fetch(`${API}/messages/bbox?${params}`, {
+      headers: { 'Authorization': currentUser.token },
+      signal: viewportRequest.signal
+    });
+    if (!res.ok) return;
+    renderViewport(await res.json());
+  } catch (err) {
+    if (err.name !== 'AbortError') console.warn('Viewport messages not loaded', err);
+  }
+}
+
+function renderViewport(data) {
+  if (!viewportLayer) viewportLayer = L.layerGroup().addTo(map);
+  viewportLayer.clearLayers();
+
+  if (data.mode === 'clusters') {
+    data.clusters.forEach(cluster => {
+      const size = Math.min(56, 26 + Math.round(Math.log2(cluster.count) * 4));
+      const marker = L.marker([cluster.latitude, cluster.longitude], {
+        icon: L.divIcon({
+          html: `<div class="message-cluster" style="width:${size}px;height:${size}px;line-height:${size}px">${cluster.count}</div>`,
+          className: '',
+          iconSize: [size, size],
+          iconAnchor: [size / 2, size / 2]
+        })
+      });
+      // Zoom into the cluster
+      marker.on('click', () => map.setView([cluster.latitude, cluster.longitude], Math.min(map.getZoom() + 2, map.getMaxZoom())));
+      viewportLayer.addLayer(marker);
+    });
+    return;
+  }
+
+  // Single messages. The ones of the radar (markersById) are drawn already, with their text
+  data.messages.forEach(msg => {
+    if (markersById[msg.m_id]) return;
+    const marker = L.marker([msg.latitude, msg.longitude], {
+      icon: L.divIcon({
+        html: `<div style="font-size:1.4rem;opacity:0.6">${typeIcon(msg.m_type)}</div>`,
+        className: '',
+        iconSize: [30, 30],
+        iconAnchor: [15, 15]
+      })
+    });
     marker.bindPopup(`
-      <div style="font-family:'DM Sans',sans-serif;min-width:180px">
+      <div style="font-family:'DM Sans',sans-serif;min-width:160px">
         <div style="font-size:0.7rem;color:#6b7280;margin-bottom:4px">
           ${typeIcon(msg.m_type)} ${msg.m_type?.toUpperCase()}
         </div>
-        <div style="font-size:0.72rem;color:#6b7280">
-          by ${msg.creator_name || 'unknown'}
-           </div>
-    <div style="font-size:0.75rem;color:#6b7280;margin-top:4px">
-      🔍 Click for details
+        <div style="font-size:0.75rem;color:#6b7280">
+          📍 ${msg.location_name || 'Unknown place'} · get closer to read it
         </div>
       </div>
     `);
+    viewportLayer.addLayer(marker);
+  });
+}
 
-    marker.on('click', () => {
-      marker.openPopup();
-      showMessageDetail(msg);
-    });
+// 
+//  LIVE EVENTS (Server-Sent Events from /universes/<uni_id>/events)
+//  New messages and poll votes are pushed, so the map doesn't need to poll
+// 
+function subscribeUniverseEvents(uniId) {
+  // "All universes": nothing consumes a single universe's stream, close it
+  if (!uniId || uniId === 'all') {
+    if (eventSource) eventSource.close();
+    eventSource = null;
+    eventsUniId = null;
+    return;
+  }
+  if (!USE_API || uniId === eventsUniId) return;
+
+  if (eventSource) eventSource.close();
+  eventsUniId = uniId;
+
+  // EventSource can't send headers, the token goes in the query string
+  eventSource = new EventSource(
+    `${API}/universes/${uniId}/events?token=${encodeURIComponent(currentUser.token)}`
+  );
+
+  eventSource.addEventListener('message', e => onMessageEvent(JSON.parse(e.data)));
+  eventSource.addEventListener('vote', e => onVoteEvent(JSON.parse(e.data)));
+  // Events were missed on the server side, reload everything once
+  eventSource.addEventListener('resync', () => loadMessages());
+}
+
+function onMessageEvent(ev) {
+  if (allMessages.some(m => m.m_id === ev.m_id)) return;
+  if (ev.latitude == null || ev.longitude == null) return;
+
+  const distance = currentUser?.location
+    ? map.distance([currentUser.location.lat, currentUser.location.lng], [ev.latitude, ev.longitude])
+    : undefined;
+
+  // The event has no text: a message we can already open is fetched with the others
+  if (distance !== undefined && distance <= ev.unl_rad) {
+    loadMessages();
+    return;
+  }
 
-    messageMarkers.push(marker);
+  const msg = { ...ev, distance, can_open: false };
+  allMessages.push(msg);
+  addMessageMarker(msg); // only the new marker, the others stay as they are
+  updateStats();
+}
+
+function onVoteEvent(ev) {
+  const msg = allMessages.find(m => m.m_id === ev.m_id);
+  if (!msg) return;
+  msg.vote_counts = msg.vote_counts || {};
+  msg.vote_counts[ev.option_id] = (msg.vote_counts[ev.option_id] || 0) + 1;
+  if (detailMessageId === msg.m_id) showMessageDetail(msg);
+}
+
+// New votes of a poll answer from the pushed counts (answers from the API carry their option_id)
+function answerVotes(msg, answer) {
+  return answer?.option_id != null ? (msg.vote_counts?.[answer.option_id] || 0) : null;
+}
+
+function renderMessageMarkers(messages) {
+  messageMarkers.forEach(m => map.removeLayer(m));
+  messageMarkers = [];
+  markersById = {};
+
+  messages.forEach(msg => {
+    if (!msg.latitude || !msg.longitude) return;
+    addMessageMarker(msg);
+  });
+}
+
+function addMessageMarker(msg) {
+  const marker = L.marker([msg.latitude, msg.longitude], {
+    icon: L.divIcon({
+      html: `<div style="font-size:1.4rem">${typeIcon(msg.m_type)}</div>`,
+      className: '',
+      iconSize: [30, 30],
+      iconAnchor: [15, 15]
+    })
+  }).addTo(map);
+
+  // Popup
+  marker.bindPopup(`
+    <div style="font-family:'DM Sans',sans-serif;min-width:180px">
+      <div style="font-size:0.7rem;color:#6b7280;margin-bottom:4px">
+        ${typeIcon(msg.m_type)} ${msg.m_type?.toUpperCase()}
+      </div>
+      <div style="font-size:0.72rem;color:#6b7280">
+        by ${msg.creator_name || 'unknown'}
+      </div>
+      <div style="font-size:0.75rem;color:#6b7280;margin-top:4px">
+        🔍 Click for details
+      </div>
+    </div>
+  `);
+
+  marker.on('click', () => {
+    marker.openPopup();
+    showMessageDetail(msg);
+  });
+
+  messageMarkers.push(marker);
+  markersById[msg.m_id] = marker;
+}
+
+function removeMessageMarker(mId) {
+  const marker = markersById[mId];
+  if (!marker) return;
+  map.removeLayer(marker);
+  messageMarkers = messageMarkers.filter(m => m !== marker);
+  delete markersById[mId];
+}
+
+// Patches allMessages and the markers with a /messages/changes response, by m_id
+function applyMessageChanges({ changed, deleted }) {
+  deleted.forEach(mId => {
+    allMessages = allMessages.filter(m => m.m_id !== mId);
+    removeMessageMarker(mId);
+  });
+
+  changed.forEach(msg => {
+    allMessages = allMessages.filter(m => m.m_id !== msg.m_id);
+    removeMessageMarker(msg.m_id);
+
+    // Messages out of the radar radius (or moved away) just disappear
+    if (msg.distance_meters == null || msg.distance_meters > NEARBY_RADIUS) return;
+    allMessages.push(msg);
+    if (msg.latitude && msg.longitude) addMessageMarker(msg);
   });
 }
 
@@ -464,6 +688,7 @@ function showMessageDetail(msg) {
   const panelBody = document.getElementById('panelBody');
 
   if (!panel || !panelBody) return;
+  detailMessageId = msg.m_id;
 
   if (panelBadge) {
     panelBadge.textContent = msg.m_type.toUpperCase();
@@ -502,6 +727,7 @@ function showMessageDetail(msg) {
 
     if (!locked && msg.question_text) {
       const answers = msg.answers || ['Yes 👍', 'No 👎'];
+      const totalVotes = Object.values(msg.vote_counts || {}).reduce((sum, n) => sum + n, 0);
       body += `
         <div style="font-weight:600;margin-bottom:10px;font-size:0.95rem">
           ${msg.question_text}
@@ -510,10 +736,15 @@ function showMessageDetail(msg) {
           ${answers.map(a => `
             <button style="background:#1e2030;border:1px solid #2d3048;
                            border-radius:8px;padding:10px;color:white;cursor:pointer">
-              ${a}
+              ${a?.option_text ?? a}${answerVotes(msg, a) ? ` · +${answerVotes(msg, a)}` : ''}
             </button>
           `).join('')}
         </div>
+        ${totalVotes ? `
+          <div style="font-size:0.75rem;color:#6b7280;margin-top:6px">
+            🗳️ ${totalVotes} new vote${totalVotes === 1 ? '' : 's'} since you opened the map
+          </div>
+        ` : ''}
       `;
     }
 
@@ -535,6 +766,7 @@ function showMessageDetail(msg) {
 }
 
 function closeSidePanel() {
+  detailMessageId = null;
   const panel = document.getElementById('sidePanel');
   if (panel) panel.classList.remove('active');
 }
@@ -672,9 +904,14 @@ function toggleLayer(layer) {
     if (btnPOIs?.classList.contains('active')) {
       poiMarkers.forEach(m => map.removeLayer(m));
       poiMarkers = [];
+      if (poiTileLayer) map.removeLayer(poiTileLayer);
       btnPOIs.classList.remove('active');
     } else {
-      renderPOIMarkers(allPOIs);
+      if (USE_API && L.vectorGrid) {
+        renderPOITiles();
+      } else {
+        renderPOIMarkers(allPOIs);
+      }
       if (btnPOIs) btnPOIs.classList.add('active');
     }
   }
@@ -709,6 +946,38 @@ function renderPOIMarkers(pois) {
     poiMarkers.push(marker);
   });
 }
+// POIs as vector tiles: the browser only downloads the tiles in view
+function renderPOITiles() {
+  if (!poiTileLayer) {
+    poiTileLayer = L.vectorGrid.protobuf(`${API}/tiles/locations/{z}/{x}/{y}.pbf`, {
+      interactive: true,
+      getFeatureId: f => f.properties.location_id,
+      vectorTileLayerStyles: {
+        locations: props => {
+          const style = getPOIStyle(props.category);
+          return { radius: 6, fill: true, fillColor: style.color, fillOpacity: 0.9, color: 'white', weight: 1 };
+        }
+      }
+    });
+
+    poiTileLayer.on('click', e => {
+      const props = e.layer.properties;
+      const style = getPOIStyle(props.category);
+      L.popup()
+        .setLatLng(e.latlng)
+        .setContent(`
+          <div style="font-family:'DM Sans',sans-serif">
+            <div style="font-size:1rem;margin-bottom:4px">${style.icon}</div>
+            <div style="font-size:0.85rem;font-weight:600">${props.name}</div>
+            <div style="font-size:0.7rem;color:#6b7280">${props.category?.replace(/_/g,' ')}</div>
+          </div>
+        `)
+        .openOn(map);
+    });
+  }
+  poiTileLayer.addTo(map);
+}
+
 // 
 //  CREATE MESSAGE
 //
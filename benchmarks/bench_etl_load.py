@@ -0,0 +1,93 @@
+"""
+Benchmark of the ETL load strategies: GeoPandas to_postgis vs. COPY FROM STDIN.
+
+Builds synthetic POI GeoDataFrames over Lisbon and writes them into a scratch
+table (bench_locations) with etl_full_automatic.write_dataframe().
+
+Usage:
+    python benchmarks/bench_etl_load.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+from sqlalchemy import create_engine, text
+
+from common import BENCH_DB_CONFIG, LISBON_BBOX, save_results
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ETL"))
+from etl_full_automatic import write_dataframe  # noqa: E402
+
+STRATEGIES = ("to_postgis", "copy")
+
+
+def synthetic_locations(n, seed=42):
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = LISBON_BBOX
+    return gpd.GeoDataFrame(
+        {
+            "l_name": [f"Bench stop {i}" for i in range(n)],
+            "category": "bench",
+            "osm_type": "node",
+            "osm_id": np.arange(1, n + 1, dtype="int64"),
+        },
+        geometry=gpd.points_from_xy(rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)),
+        crs="EPSG:4326",
+    ).rename_geometry("geom")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    cfg = BENCH_DB_CONFIG
+    engine = create_engine(
+        f"postgresql://{cfg['user']}:{cfg['password']}@{cfg['host']}:{cfg['port']}/{cfg['database']}"
+    )
+
+    with engine.begin() as connection:
+        connection.execute(text("""
+            DROP TABLE IF EXISTS bench_locations;
+            CREATE TABLE bench_locations (
+                location_id serial PRIMARY KEY,
+                l_name text,
+                category text,
+                osm_type text,
+                osm_id bigint,
+                geom geometry(Point, 4326)
+            );
+        """))
+
+    results = []
+    for size in args.sizes:
+        gdf = synthetic_locations(size)
+        row = {"rows": size}
+
+        for strategy in STRATEGIES:
+            with engine.begin() as connection:
+                connection.execute(text("TRUNCATE bench_locations;"))
+
+            start = time.perf_counter()
+            with engine.begin() as connection:
+                write_dataframe(connection, gdf, "bench_locations", strategy=strategy)
+            elapsed = time.perf_counter() - start
+
+            row[f"{strategy}_seconds"] = round(elapsed, 3)
+            row[f"{strategy}_rows_per_second"] = round(size / elapsed)
+            print(f"{size:>9} rows  {strategy:<10} {elapsed:8.2f} s  ({size / elapsed:,.0f} rows/s)")
+
+        row["speedup"] = round(row["to_postgis_seconds"] / row["copy_seconds"], 2)
+        results.append(row)
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE bench_locations;"))
+
+    save_results("etl_load", results)
+
+
+if __name__ == "__main__":
+    main()
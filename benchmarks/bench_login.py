@@ -0,0 +1,123 @@
+"""
+Login throughput benchmark.
+
+Registers --users test users once (--setup), then runs a login burst against a
+running API (--clients concurrent clients logging in as fast as they can) while
+a probe client requests a cheap route (GET /) every 50 ms. Reports:
+  - login throughput and latency percentiles
+  - 503 responses (hashing queue full, see "CoordiNote API/passwords.py")
+  - latency of the probe during the burst, i.e. how much logins slow other routes
+
+Compare runs with different settings of the server, e.g.
+    COORDINOTE_BCRYPT_ROUNDS=12 COORDINOTE_HASH_WORKERS=4 gunicorn -w 2 --threads 16 -b :5000 app:app
+
+Usage:
+    python benchmarks/bench_login.py --setup --users 200
+    python benchmarks/bench_login.py --users 200 --clients 100 --duration 30
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+from common import save_results, summarize
+
+PASSWORD = "bench-password"
+PROBE_INTERVAL = 0.05  # seconds
+
+
+def username(i):
+    return f"bench_login_{i}"
+
+
+async def register_users(session, base_url, n):
+    created = 0
+    for i in range(n):
+        body = {"username": username(i), "password": PASSWORD, "repeat_password": PASSWORD}
+        async with session.post(f"{base_url}/users/register", json=body) as res:
+            await res.read()
+            created += res.status < 300
+    print(f"Registered {created} of {n} users (existing users are skipped by the database)")
+
+
+async def login_client(session, base_url, client_id, n_users, deadline, timings, statuses):
+    i = client_id
+    while time.monotonic() < deadline:
+        body = {"username": username(i % n_users), "password": PASSWORD}
+        start = time.perf_counter()
+        try:
+            async with session.post(f"{base_url}/users/login", json=body) as res:
+                await res.read()
+                statuses[res.status] = statuses.get(res.status, 0) + 1
+                if res.status == 200:
+                    timings.append((time.perf_counter() - start) * 1000)
+                elif res.status == 503:
+                    await asyncio.sleep(0.1)  # like a client honoring Retry-After, but shorter
+        except aiohttp.ClientError as e:
+            statuses[type(e).__name__] = statuses.get(type(e).__name__, 0) + 1
+        i += 1
+
+
+async def probe(session, base_url, deadline, timings):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            async with session.get(f"{base_url}/") as res:
+                await res.read()
+            timings.append((time.perf_counter() - start) * 1000)
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(PROBE_INTERVAL)
+
+
+async def run(args):
+    connector = aiohttp.TCPConnector(limit=args.clients + 1)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        if args.setup:
+            await register_users(session, args.url, args.users)
+            return None
+
+        login_timings, probe_timings, statuses = [], [], {}
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(
+            probe(session, args.url, deadline, probe_timings),
+            *(login_client(session, args.url, i, args.users, deadline, login_timings, statuses)
+              for i in range(args.clients)),
+        )
+        elapsed = time.monotonic() - started
+
+    results = {
+        "clients": args.clients,
+        "duration": args.duration,
+        "logins_per_second": round(len(login_timings) / elapsed, 1),
+        "login": summarize(login_timings),
+        "probe": summarize(probe_timings),
+        "statuses": {str(k): v for k, v in statuses.items()},
+    }
+    print(f"logins: {results['logins_per_second']} /s, p50 {results['login'].get('p50_ms')} ms, "
+          f"p99 {results['login'].get('p99_ms')} ms")
+    print(f"probe GET / during the burst: p50 {results['probe'].get('p50_ms')} ms, "
+          f"p99 {results['probe'].get('p99_ms')} ms")
+    print(f"status codes: {results['statuses']}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--setup", action="store_true", help="only register the test users")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if results is not None:
+        save_results("login", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Before/after benchmark of the /messages/nearby query.
+
+Seeds a scratch schema (bench_nearby) with synthetic locations and messages
+spread over Lisbon, then runs EXPLAIN (ANALYZE, BUFFERS) and a timing loop for:
+  - before: the old query (3x ST_Distance, geom::geography cast per row, no index)
+  - after:  nearby.NEARBY_MESSAGES_SQL with DB/migrations/001_locations_geography.sql applied
+
+Usage:
+    python benchmarks/bench_nearby.py --messages 1000000 --locations 100000
+"""
+import argparse
+import json
+import os
+import random
+
+from common import BENCH_DB_CONFIG, LISBON_BBOX, connect, save_results, summarize, time_calls
+from nearby import LOCKED_MESSAGE_TEXT, NEARBY_MESSAGES_SQL
+
+MIGRATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DB", "migrations", "001_locations_geography.sql")
+
+OLD_NEARBY_SQL = """
+    SELECT
+        m.m_id, m.m_type, m.unl_rad, m.view_once, l.location_id, l.l_name as location_name,
+        ST_Distance(l.geom::geography, ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)::geography) as distance_meters,
+        CASE WHEN ST_Distance(l.geom::geography, ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)::geography) <= m.unl_rad
+            THEN true ELSE false END as can_open,
+        CASE WHEN ST_Distance(l.geom::geography, ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)::geography) <= m.unl_rad
+            THEN m.m_txt ELSE %(locked_text)s END as m_txt
+    FROM messages m
+    JOIN locations l ON m.location_id = l.location_id
+    WHERE m.uni_id = %(uni_id)s
+    AND ST_DWithin(l.geom::geography, ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326)::geography, %(radius)s);
+"""
+
+
+def seed(cur, n_locations, n_messages, n_universes):
+    minx, miny, maxx, maxy = LISBON_BBOX
+    print(f"Seeding {n_locations} locations and {n_messages} messages in {n_universes} universes...")
+    cur.execute("DROP SCHEMA IF EXISTS bench_nearby CASCADE; CREATE SCHEMA bench_nearby;")
+    cur.execute("SET search_path = bench_nearby, public;")
+    cur.execute("""
+        CREATE TABLE locations (location_id serial PRIMARY KEY, l_name text, category text, geom geometry(Point, 4326));
+        CREATE TABLE messages (
+            m_id serial PRIMARY KEY, m_type text, unl_rad integer NOT NULL DEFAULT 30,
+            view_once boolean, m_txt text, uni_id integer, location_id integer
+        );
+    """)
+    cur.execute("""
+        INSERT INTO locations (l_name, category, geom)
+        SELECT 'poi ' || i, 'bench',
+               ST_SetSRID(ST_MakePoint(%s + random() * %s, %s + random() * %s), 4326)
+        FROM generate_series(1, %s) i;
+    """, (minx, maxx - minx, miny, maxy - miny, n_locations))
+    cur.execute("""
+        INSERT INTO messages (m_type, unl_rad, view_once, m_txt, uni_id, location_id)
+        SELECT 'text', 20 + (random() * 80)::int, random() < 0.2, md5(i::text),
+               1 + (random() * (%s - 1))::int, 1 + (random() * (%s - 1))::int
+        FROM generate_series(1, %s) i;
+    """, (n_universes, n_locations, n_messages))
+    cur.execute("ANALYZE locations; ANALYZE messages;")
+
+
+def explain(cur, sql, params):
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+    plan = cur.fetchone()["QUERY PLAN"]
+    return plan[0] if isinstance(plan, list) else json.loads(plan)[0]
+
+
+def run_variant(cur, name, sql, queries, repeat):
+    plan = explain(cur, sql, queries[0])
+    print(f"\n== {name}: planning {plan['Planning Time']:.2f} ms, execution {plan['Execution Time']:.2f} ms")
+    positions = iter(queries * (repeat // len(queries) + 1))
+    timings = time_calls(lambda: (cur.execute(sql, next(positions)), cur.fetchall()), repeat)
+    stats = summarize(timings)
+    print(f"   {repeat} runs: {stats}")
+    return {"explain": plan, "timings": stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--locations", type=int, default=100_000)
+    parser.add_argument("--universes", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--radius", type=float, default=1000)
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"Using database {BENCH_DB_CONFIG['database']} on {BENCH_DB_CONFIG['host']}")
+    conn = connect()
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    seed(cur, args.locations, args.messages, args.universes)
+
+    minx, miny, maxx, maxy = LISBON_BBOX
+    rng = random.Random(42)
+    queries = [{
+        "lat": rng.uniform(miny, maxy),
+        "lon": rng.uniform(minx, maxx),
+        "uni_id": rng.randint(1, args.universes),
+        "radius": args.radius,
+        "limit": args.limit,
+        "locked_text": LOCKED_MESSAGE_TEXT,
+    } for _ in range(20)]
+
+    results = {"messages": args.messages, "locations": args.locations, "universes": args.universes}
+    results["before"] = run_variant(cur, "before", OLD_NEARBY_SQL, queries, args.repeat)
+
+    with open(MIGRATION) as f:
+        cur.execute(f.read())
+    results["after"] = run_variant(cur, "after", NEARBY_MESSAGES_SQL, queries, args.repeat)
+
+    speedup = results["before"]["timings"]["p50_ms"] / results["after"]["timings"]["p50_ms"]
+    print(f"\np50 speedup: {speedup:.1f}x")
+    results["p50_speedup"] = round(speedup, 2)
+
+    save_results("nearby", results)
+    cur.execute("DROP SCHEMA bench_nearby CASCADE;")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
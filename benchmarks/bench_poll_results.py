@@ -0,0 +1,117 @@
+"""
+Benchmark of /poll/results on a poll with 1M votes.
+
+Seeds a scratch schema (bench_polls) with one poll of 5 options and its votes,
+then times:
+  - before: COUNT(pv.vote_id) over poll_votes grouped per option (old query)
+  - after:  poll_counts.POLL_RESULTS_SQL on poll_option_counts
+            (DB/migrations/004_poll_option_counts.sql applied)
+  - reconcile: poll_counts.reconcile_poll_counts() for the poll
+
+Usage:
+    python benchmarks/bench_poll_results.py --votes 1000000
+"""
+import argparse
+import os
+import time
+
+from common import BENCH_DB_CONFIG, connect, save_results, summarize, time_calls
+from poll_counts import POLL_RESULTS_SQL, reconcile_poll_counts
+
+MIGRATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DB", "migrations", "004_poll_option_counts.sql")
+
+POLL_ID = 1
+
+OLD_RESULTS_SQL = """
+    SELECT
+        po.option_id,
+        po.option_text,
+        COUNT(pv.vote_id) AS vote_count
+    FROM poll_options po
+    LEFT JOIN poll_votes pv
+        ON po.option_id = pv.option_id
+    WHERE po.m_id = %s
+    GROUP BY po.option_id
+    ORDER BY po.option_id;
+"""
+
+
+def seed(cur, n_votes, n_options):
+    print(f"Seeding a poll with {n_options} options and {n_votes} votes...")
+    cur.execute("DROP SCHEMA IF EXISTS bench_polls CASCADE; CREATE SCHEMA bench_polls;")
+    cur.execute("SET search_path = bench_polls, public;")
+    cur.execute("""
+        CREATE TABLE poll_options (option_id serial PRIMARY KEY, m_id integer NOT NULL, option_text text);
+        CREATE TABLE poll_votes (
+            vote_id serial PRIMARY KEY, option_id integer NOT NULL, us_id integer NOT NULL, m_id integer NOT NULL
+        );
+        CREATE UNIQUE INDEX poll_votes_us_id_m_id_key ON poll_votes (us_id, m_id);
+        CREATE INDEX poll_votes_option_id_idx ON poll_votes (option_id);
+    """)
+    cur.execute("""
+        INSERT INTO poll_options (m_id, option_text)
+        SELECT %s, 'option ' || i FROM generate_series(1, %s) i;
+    """, (POLL_ID, n_options))
+    # One vote per user, options skewed a bit so the counts differ
+    cur.execute("""
+        INSERT INTO poll_votes (option_id, us_id, m_id)
+        SELECT 1 + floor(power(random(), 1.5) * %s)::int, i, %s
+        FROM generate_series(1, %s) i;
+    """, (n_options, POLL_ID, n_votes))
+    cur.execute("ANALYZE poll_options; ANALYZE poll_votes;")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--votes", type=int, default=1_000_000)
+    parser.add_argument("--options", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"Using database {BENCH_DB_CONFIG['database']} on {BENCH_DB_CONFIG['host']}")
+    conn = connect()
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    seed(cur, args.votes, args.options)
+    results = {"votes": args.votes, "options": args.options}
+
+    def run(name, sql):
+        cur.execute(sql, (POLL_ID,))
+        rows = cur.fetchall()
+        stats = summarize(time_calls(lambda: (cur.execute(sql, (POLL_ID,)), cur.fetchall()), args.repeat))
+        print(f"\n== {name}: {stats}")
+        return rows, stats
+
+    before_rows, results["before"] = run("before", OLD_RESULTS_SQL)
+
+    with open(MIGRATION) as f:
+        cur.execute(f.read())
+    after_rows, results["after"] = run("after", POLL_RESULTS_SQL)
+
+    # Both queries must agree on every count
+    assert [dict(r) for r in before_rows] == [dict(r) for r in after_rows], "counters differ from poll_votes"
+
+    # Reconcile after breaking one counter
+    conn.autocommit = False
+    cur.execute("SET search_path = bench_polls, public;")
+    cur.execute("UPDATE poll_option_counts SET vote_count = 0 WHERE option_id = 1;")
+    conn.commit()
+    start = time.perf_counter()
+    fixed = reconcile_poll_counts(conn, POLL_ID)
+    results["reconcile_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    results["reconcile_fixed"] = len(fixed)
+    print(f"\n== reconcile: {results['reconcile_ms']} ms, {len(fixed)} counter(s) corrected")
+
+    speedup = results["before"]["p50_ms"] / results["after"]["p50_ms"]
+    print(f"\np50 speedup: {speedup:.1f}x")
+    results["p50_speedup"] = round(speedup, 2)
+
+    save_results("poll_results", results)
+    conn.autocommit = True
+    cur.execute("DROP SCHEMA bench_polls CASCADE;")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+# Make the API modules importable ("CoordiNote API" has a space, so it isn't a package)
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CoordiNote API")
+sys.path.insert(0, API_DIR)
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Benchmarks always run against a local scratch database, never the real one
+BENCH_DB_CONFIG = {
+    "database": os.environ.get("BENCH_DATABASE", "coordinote_bench"),
+    "user": os.environ.get("BENCH_USER", "postgres"),
+    "password": os.environ.get("BENCH_PASSWORD", "postgres"),
+    "host": os.environ.get("BENCH_HOST", "localhost"),
+    "port": os.environ.get("BENCH_PORT", "5432"),
+}
+
+# Lisbon bounding box (lon/lat), used to spread synthetic points realistically
+LISBON_BBOX = (-9.23, 38.69, -9.09, 38.80)
+
+
+def connect(cursor_factory=RealDictCursor):
+    return psycopg2.connect(cursor_factory=cursor_factory, **BENCH_DB_CONFIG)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (pct between 0 and 100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(timings_ms):
+    """Returns count/mean/p50/p95/p99/max for a list of durations in milliseconds."""
+    if not timings_ms:
+        return {"count": 0}
+    return {
+        "count": len(timings_ms),
+        "mean_ms": round(sum(timings_ms) / len(timings_ms), 3),
+        "p50_ms": round(percentile(timings_ms, 50), 3),
+        "p95_ms": round(percentile(timings_ms, 95), 3),
+        "p99_ms": round(percentile(timings_ms, 99), 3),
+        "max_ms": round(max(timings_ms), 3),
+    }
+
+
+def time_calls(func, repeat):
+    """Calls func() `repeat` times and returns the durations in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_results(name, results):
+    """Writes results to benchmarks/results/<name>-<git revision>.json and returns the path."""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{name}-{git_revision()}.json")
+    with open(path, "w") as f:
+        json.dump({"benchmark": name, "revision": git_revision(), "results": results}, f, indent=2, default=str)
+    print(f"Results written to {path}")
+    return path
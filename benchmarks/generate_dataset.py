@@ -0,0 +1,235 @@
+"""
+Synthetic Lisbon dataset for load tests and benchmarks.
+
+Bulk-loads users, universes, memberships, locations, messages and sessions into
+the benchmark database. The database needs the CoordiNote schema first, e.g.
+    createdb coordinote_bench
+    pg_restore --schema-only -d coordinote_bench shared_coordinote.sql
+    for f in DB/migrations/*.sql; do psql -d coordinote_bench -f "$f"; done
+
+Everything is generated in SQL (INSERT ... SELECT generate_series), so a few
+million rows load in seconds. Points are spread like a real city: most around
+a few hotspots (Baixa, Alfama, Bairro Alto, Belem, Parque das Nacoes), the
+rest uniformly over the Lisbon bounding box.
+
+Users are bench_user_<i> with the password --password. User i is a member of
+--universes-per-user universes, (i + k * stride) % universes for k = 0, 1, ...,
+so load tests know the memberships of every user without asking the API.
+A manifest with the ids is written to benchmarks/results/dataset.json.
+
+Usage:
+    python benchmarks/generate_dataset.py --reset --users 10000 --universes 200 \
+        --messages 1000000 --sessions 50000 --locations 50000
+"""
+import argparse
+import json
+import os
+import time
+
+from passlib.hash import bcrypt
+
+from common import BENCH_DB_CONFIG, LISBON_BBOX, RESULTS_DIR, connect
+
+MANIFEST_PATH = os.path.join(RESULTS_DIR, "dataset.json")
+
+DEFAULT_PASSWORD = "bench-password"
+
+# (lon, lat, spread in degrees, share of the clustered points)
+HOTSPOTS = [
+    (-9.1365, 38.7101, 0.004, 0.30),  # Baixa / Chiado
+    (-9.1300, 38.7118, 0.003, 0.15),  # Alfama
+    (-9.1445, 38.7135, 0.003, 0.15),  # Bairro Alto
+    (-9.2060, 38.6970, 0.005, 0.20),  # Belem
+    (-9.0940, 38.7630, 0.006, 0.20),  # Parque das Nacoes
+]
+CLUSTERED_SHARE = 0.7
+
+APP_TABLES = ("seen", "poll_votes", "poll_options", "messages", "sessions", "user_univ", "universes", "users")
+
+UNIVERSE_STRIDE_SQL = "greatest(1, %(universes)s / %(per_user)s)"
+
+
+def timed(label, cur, sql, params=None):
+    start = time.perf_counter()
+    cur.execute(sql, params)
+    print(f"  {label:<12} {cur.rowcount:>10} rows  {time.perf_counter() - start:7.2f} s")
+
+
+def reset(cur):
+    print("Truncating the application tables...")
+    cur.execute(f"TRUNCATE {', '.join(APP_TABLES)} CASCADE;")
+    cur.execute("DELETE FROM locations WHERE category = 'bench';")
+
+
+def random_point_sql():
+    """SQL expression of a random point: clustered around a hotspot or uniform over Lisbon."""
+    minx, miny, maxx, maxy = LISBON_BBOX
+    cases, lower = [], 0.0
+    for lon, lat, spread, share in HOTSPOTS:
+        upper = lower + share * CLUSTERED_SHARE
+        cases.append(
+            f"WHEN r < {upper} THEN ST_MakePoint({lon} + {spread} * g1, {lat} + {spread} * g2)"
+        )
+        lower = upper
+    uniform = f"ST_MakePoint({minx} + random() * {maxx - minx}, {miny} + random() * {maxy - miny})"
+    return f"ST_SetSRID(CASE {' '.join(cases)} ELSE {uniform} END, 4326)"
+
+
+def generate(cur, args):
+    print(f"Generating into {BENCH_DB_CONFIG['database']} on {BENCH_DB_CONFIG['host']}...")
+    params = {
+        "users": args.users,
+        "universes": args.universes,
+        "per_user": min(args.universes_per_user, args.universes),
+        "messages": args.messages,
+        "sessions": args.sessions,
+        "locations": args.locations,
+        "pwd": bcrypt.hash(args.password),
+    }
+
+    timed("users", cur, """
+        INSERT INTO users (us_name, pwd)
+        SELECT 'bench_user_' || i, %(pwd)s
+        FROM generate_series(0, %(users)s - 1) i;
+    """, params)
+
+    timed("universes", cur, """
+        INSERT INTO universes (uni_name, access, descri)
+        SELECT 'bench_universe_' || j, random() < 0.2, 'Synthetic universe ' || j
+        FROM generate_series(0, %(universes)s - 1) j;
+    """, params)
+
+    # Index -> id maps, so the SQL below doesn't look rows up by name
+    cur.execute("""
+        CREATE TEMP TABLE bench_user_ids AS
+        SELECT substr(us_name, 12)::int AS i, us_id FROM users WHERE us_name LIKE 'bench\\_user\\_%';
+        CREATE UNIQUE INDEX ON bench_user_ids (i);
+        CREATE TEMP TABLE bench_universe_ids AS
+        SELECT substr(uni_name, 16)::int AS j, uni_id FROM universes WHERE uni_name LIKE 'bench\\_universe\\_%';
+        CREATE UNIQUE INDEX ON bench_universe_ids (j);
+    """)
+
+    timed("memberships", cur, f"""
+        INSERT INTO user_univ (us_id, uni_id)
+        SELECT u.us_id, un.uni_id
+        FROM bench_user_ids u
+        CROSS JOIN generate_series(0, %(per_user)s - 1) k
+        JOIN bench_universe_ids un ON un.j = (u.i + k * {UNIVERSE_STRIDE_SQL}) %% %(universes)s
+        ON CONFLICT DO NOTHING;
+    """, params)
+
+    timed("locations", cur, f"""
+        INSERT INTO locations (l_name, category, geom)
+        SELECT 'Bench spot ' || n, 'bench', {random_point_sql()}
+        FROM (
+            SELECT n, random() AS r,
+                   -- approximately normal offsets (sum of uniforms)
+                   (random() + random() + random() - 1.5) AS g1,
+                   (random() + random() + random() - 1.5) AS g2
+            FROM generate_series(1, %(locations)s) n
+        ) p;
+    """, params)
+
+    cur.execute("""
+        CREATE TEMP TABLE bench_location_ids AS
+        SELECT row_number() OVER (ORDER BY location_id) - 1 AS n, location_id
+        FROM locations WHERE category = 'bench';
+        CREATE UNIQUE INDEX ON bench_location_ids (n);
+    """)
+    cur.execute("SELECT count(*) AS n FROM bench_location_ids;")
+    params["location_count"] = cur.fetchone()["n"]
+
+    # Creator = random user, universe = one of the creator's universes, location = random bench spot
+    timed("messages", cur, f"""
+        INSERT INTO messages (m_type, unl_rad, crt_time, view_once, m_txt, creator, uni_id, location_id)
+        SELECT
+            CASE WHEN random() < 0.15 THEN 'poll' ELSE 'text' END,
+            20 + (random() * 80)::int,
+            now() - random() * interval '90 days',
+            random() < 0.1,
+            'Synthetic message ' || g.n || ' ' || md5(g.n::text),
+            u.us_id,
+            un.uni_id,
+            l.location_id
+        FROM (
+            SELECT n,
+                   floor(random() * %(users)s)::int AS i,
+                   floor(random() * %(per_user)s)::int AS k,
+                   floor(random() * %(location_count)s)::int AS loc
+            FROM generate_series(1, %(messages)s) n
+        ) g
+        JOIN bench_user_ids u ON u.i = g.i
+        JOIN bench_universe_ids un ON un.j = (g.i + g.k * {UNIVERSE_STRIDE_SQL}) %% %(universes)s
+        JOIN bench_location_ids l ON l.n = g.loc;
+    """, params)
+
+    # Mostly valid sessions, some expired (like a table the reaper hasn't cleaned yet)
+    timed("sessions", cur, """
+        INSERT INTO sessions (us_id, token, expires_at)
+        SELECT u.us_id, gen_random_uuid()::text,
+               (now() AT TIME ZONE 'utc') + (random() * 96 - 24) * interval '1 hour'
+        FROM (
+            SELECT floor(random() * %(users)s)::int AS i
+            FROM generate_series(1, %(sessions)s)
+        ) g
+        JOIN bench_user_ids u ON u.i = g.i;
+    """, params)
+
+    print("Analyzing...")
+    for table in APP_TABLES + ("locations",):
+        cur.execute(f"ANALYZE {table};")
+
+    cur.execute("SELECT us_id FROM bench_user_ids ORDER BY i;")
+    user_ids = [row["us_id"] for row in cur.fetchall()]
+    cur.execute("SELECT uni_id FROM bench_universe_ids ORDER BY j;")
+    universe_ids = [row["uni_id"] for row in cur.fetchall()]
+
+    return {
+        "database": BENCH_DB_CONFIG["database"],
+        "users": args.users,
+        "universes": args.universes,
+        "universes_per_user": params["per_user"],
+        "universe_stride": max(1, args.universes // params["per_user"]),
+        "messages": args.messages,
+        "sessions": args.sessions,
+        "locations": params["location_count"],
+        "username_prefix": "bench_user_",
+        "password": args.password,
+        "first_us_id": user_ids[0] if user_ids else None,
+        "universe_ids": universe_ids,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--universes", type=int, default=200)
+    parser.add_argument("--universes-per-user", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--sessions", type=int, default=50_000)
+    parser.add_argument("--locations", type=int, default=50_000)
+    parser.add_argument("--password", default=DEFAULT_PASSWORD)
+    parser.add_argument("--reset", action="store_true", help="truncate the application tables first")
+    args = parser.parse_args()
+
+    conn = connect()
+    cur = conn.cursor()
+    try:
+        if args.reset:
+            reset(cur)
+        manifest = generate(cur, args)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Manifest written to {MANIFEST_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+End-to-end load test with simulated walking clients.
+
+Needs a dataset from generate_dataset.py (reads benchmarks/results/dataset.json)
+and a running API on that database, e.g.
+    cd "CoordiNote API" && gunicorn -w 4 --threads 8 -b :5000 app:app
+
+Every virtual client logs in as a random bench user, starts somewhere in
+Lisbon (mostly around the hotspots) and walks at ~1.4 m/s. Between think times
+it calls one route:
+    /messages/nearby         around its position, in one of its universes
+    /messages                one page of a universe
+    /messages/<id>/open      a message it saw nearby
+    /locations               POIs in a ~1 km box around it
+    /users/login             again, like an app restart
+
+Throughput, status codes and p50/p95/p99 are reported per route and saved to
+benchmarks/results/load_test-<git revision>.json, so runs at different
+commits can be compared.
+
+Usage:
+    python benchmarks/load_test.py --clients 200 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+import aiohttp
+
+from common import LISBON_BBOX, save_results, summarize
+from generate_dataset import CLUSTERED_SHARE, HOTSPOTS, MANIFEST_PATH
+
+WALKING_SPEED = 1.4  # m/s
+METERS_PER_DEG_LAT = 111_320
+BOX_HALF_SIZE_DEG = 0.005  # ~500 m around the client for /locations
+
+# route name -> share of the requests
+ROUTE_MIX = {
+    "nearby": 0.5,
+    "messages": 0.15,
+    "open": 0.15,
+    "locations": 0.1,
+    "login": 0.1,
+}
+
+
+class Stats:
+
+    def __init__(self):
+        self.timings = {route: [] for route in ROUTE_MIX}
+        self.statuses = {route: {} for route in ROUTE_MIX}
+
+    def record(self, route, status, elapsed_ms):
+        self.timings[route].append(elapsed_ms)
+        self.statuses[route][status] = self.statuses[route].get(status, 0) + 1
+
+
+def start_position(rng):
+    if rng.random() < CLUSTERED_SHARE:
+        lon, lat, spread, _ = rng.choices(HOTSPOTS, weights=[h[3] for h in HOTSPOTS])[0]
+        return lat + rng.gauss(0, spread / 2), lon + rng.gauss(0, spread / 2)
+    minx, miny, maxx, maxy = LISBON_BBOX
+    return rng.uniform(miny, maxy), rng.uniform(minx, maxx)
+
+
+def walk(lat, lon, seconds, rng):
+    meters = WALKING_SPEED * seconds
+    heading = rng.uniform(0, 2 * math.pi)
+    lat += meters * math.cos(heading) / METERS_PER_DEG_LAT
+    lon += meters * math.sin(heading) / (METERS_PER_DEG_LAT * math.cos(math.radians(lat)))
+    return lat, lon
+
+
+async def request(session, stats, route, method, url, **kwargs):
+    start = time.perf_counter()
+    try:
+        async with session.request(method, url, **kwargs) as res:
+            body = await res.read()
+            status = res.status
+    except aiohttp.ClientError as e:
+        body, status = None, type(e).__name__
+    stats.record(route, status, (time.perf_counter() - start) * 1000)
+    return status, body
+
+
+async def login(session, stats, base_url, username, password):
+    status, body = await request(session, stats, "login", "POST", f"{base_url}/users/login",
+                                 json={"username": username, "password": password})
+    return json.loads(body)["token"] if status == 200 else None
+
+
+async def virtual_client(session, base_url, manifest, args, deadline, stats, rng):
+    i = rng.randrange(manifest["users"])
+    username = f"{manifest['username_prefix']}{i}"
+    universes = [
+        manifest["universe_ids"][(i + k * manifest["universe_stride"]) % manifest["universes"]]
+        for k in range(manifest["universes_per_user"])
+    ]
+
+    token = None
+    while token is None and time.monotonic() < deadline:
+        token = await login(session, stats, base_url, username, manifest["password"])
+        if token is None:
+            await asyncio.sleep(1)
+
+    lat, lon = start_position(rng)
+    seen_m_ids = []
+    routes, weights = list(ROUTE_MIX), list(ROUTE_MIX.values())
+
+    while time.monotonic() < deadline:
+        think = rng.uniform(0, args.think_time)
+        await asyncio.sleep(think)
+        lat, lon = walk(lat, lon, think, rng)
+
+        headers = {"Authorization": token}
+        uni_id = rng.choice(universes)
+        route = rng.choices(routes, weights=weights)[0]
+
+        if route == "nearby":
+            status, body = await request(
+                session, stats, route, "GET",
+                f"{base_url}/messages/nearby?lat={lat}&lon={lon}&uni_id={uni_id}", headers=headers)
+            if status == 200:
+                seen_m_ids = [m["m_id"] for m in json.loads(body)][:50]
+
+        elif route == "messages":
+            await request(session, stats, route, "GET",
+                          f"{base_url}/messages?uni_id={uni_id}&limit=50", headers=headers)
+
+        elif route == "open":
+            if not seen_m_ids:
+                continue
+            await request(session, stats, route, "POST",
+                          f"{base_url}/messages/{rng.choice(seen_m_ids)}/open", headers=headers)
+
+        elif route == "locations":
+            bbox = f"{lon - BOX_HALF_SIZE_DEG},{lat - BOX_HALF_SIZE_DEG},{lon + BOX_HALF_SIZE_DEG},{lat + BOX_HALF_SIZE_DEG}"
+            await request(session, stats, route, "GET", f"{base_url}/locations?bbox={bbox}")
+
+        else:
+            token = await login(session, stats, base_url, username, manifest["password"]) or token
+
+
+async def run(args, manifest):
+    stats = Stats()
+    connector = aiohttp.TCPConnector(limit=args.clients)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(*(
+            virtual_client(session, args.url, manifest, args, deadline, stats, random.Random(args.seed + n))
+            for n in range(args.clients)
+        ))
+        elapsed = time.monotonic() - started
+
+    per_route = {}
+    print(f"\n{'route':<10} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  statuses")
+    for route in ROUTE_MIX:
+        result = summarize(stats.timings[route])
+        result["throughput_rps"] = round(len(stats.timings[route]) / elapsed, 1)
+        result["statuses"] = {str(k): v for k, v in stats.statuses[route].items()}
+        per_route[route] = result
+        print(f"{route:<10} {result['throughput_rps']:>8} {result.get('p50_ms', '-'):>9} "
+              f"{result.get('p95_ms', '-'):>9} {result.get('p99_ms', '-'):>9}  {result['statuses']}")
+
+    all_timings = [t for timings in stats.timings.values() for t in timings]
+    total = summarize(all_timings)
+    total["throughput_rps"] = round(len(all_timings) / elapsed, 1)
+    print(f"{'total':<10} {total['throughput_rps']:>8} {total.get('p50_ms', '-'):>9} "
+          f"{total.get('p95_ms', '-'):>9} {total.get('p99_ms', '-'):>9}")
+
+    return {"routes": per_route, "total": total}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--think-time", type=float, default=2.0, help="max seconds between requests")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    results = asyncio.run(run(args, manifest))
+    results["settings"] = {
+        "url": args.url,
+        "clients": args.clients,
+        "duration": args.duration,
+        "think_time": args.think_time,
+        "dataset": {k: manifest[k] for k in ("users", "universes", "messages", "sessions", "locations")},
+    }
+    save_results("load_test", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Load test comparing the sync Flask app (app.py) with the async app (app_async.py).
+
+Simulates many concurrent, slow mobile clients. Each virtual client logs in once,
+then loops over /messages/nearby (walking around a start point), GET /messages
+and /messages/<id>/open with some think time between requests. Reports
+throughput and latency percentiles per server.
+
+Start both servers against the same database first, e.g.
+    cd "CoordiNote API"
+    gunicorn -w 4 --threads 8 -b :5000 app:app
+    hypercorn -w 1 -b :5001 app_async:app
+
+Usage:
+    python benchmarks/load_test_async.py --username marie_tr --password ... --uni-id 400000 \
+        --clients 300 --duration 60
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import aiohttp
+
+from common import LISBON_BBOX, save_results, summarize
+
+DEFAULT_TARGETS = {
+    "sync": "http://localhost:5000",
+    "async": "http://localhost:5001",
+}
+
+
+async def login(session, base_url, username, password):
+    async with session.post(f"{base_url}/users/login", json={"username": username, "password": password}) as res:
+        res.raise_for_status()
+        return (await res.json())["token"]
+
+
+async def virtual_client(session, base_url, token, args, deadline, timings, errors, rng):
+    minx, miny, maxx, maxy = LISBON_BBOX
+    lat, lon = rng.uniform(miny, maxy), rng.uniform(minx, maxx)
+    headers = {"Authorization": token}
+
+    while time.monotonic() < deadline:
+        # Walk a few meters between refreshes
+        lat += rng.uniform(-0.0002, 0.0002)
+        lon += rng.uniform(-0.0002, 0.0002)
+
+        choice = rng.random()
+        if choice < 0.7:
+            method, path = "GET", f"/messages/nearby?lat={lat}&lon={lon}&uni_id={args.uni_id}"
+        elif choice < 0.9:
+            method, path = "GET", f"/messages?uni_id={args.uni_id}&limit=100"
+        else:
+            method, path = "POST", f"/messages/{rng.choice(args.m_ids)}/open"
+
+        start = time.perf_counter()
+        try:
+            async with session.request(method, base_url + path, headers=headers) as res:
+                await res.read()
+                if res.status >= 500:
+                    errors.append(res.status)
+        except aiohttp.ClientError as e:
+            errors.append(type(e).__name__)
+        timings.append((time.perf_counter() - start) * 1000)
+
+        # Think time of a mobile client
+        await asyncio.sleep(rng.uniform(0, args.think_time))
+
+
+async def run_target(name, base_url, args):
+    connector = aiohttp.TCPConnector(limit=args.clients)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        token = await login(session, base_url, args.username, args.password)
+
+        timings, errors = [], []
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(*(
+            virtual_client(session, base_url, token, args, deadline, timings, errors, random.Random(i))
+            for i in range(args.clients)
+        ))
+        elapsed = time.monotonic() - started
+
+    result = summarize(timings)
+    result["throughput_rps"] = round(len(timings) / elapsed, 1)
+    result["errors"] = len(errors)
+    print(f"{name:>6}: {result['throughput_rps']} req/s, p50 {result['p50_ms']} ms, "
+          f"p99 {result['p99_ms']} ms, errors {result['errors']}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--uni-id", type=int, required=True)
+    parser.add_argument("--m-ids", type=int, nargs="+", default=[700000])
+    parser.add_argument("--clients", type=int, default=300)
+    parser.add_argument("--duration", type=float, default=60, help="seconds per server")
+    parser.add_argument("--think-time", type=float, default=1.0, help="max seconds between requests")
+    parser.add_argument("--sync-url", default=DEFAULT_TARGETS["sync"])
+    parser.add_argument("--async-url", default=DEFAULT_TARGETS["async"])
+    args = parser.parse_args()
+
+    results = {"clients": args.clients, "duration": args.duration}
+    for name, url in (("sync", args.sync_url), ("async", args.async_url)):
+        results[name] = asyncio.run(run_target(name, url, args))
+
+    save_results("load_async_vs_sync", results)
+
+
+if __name__ == "__main__":
+    main()